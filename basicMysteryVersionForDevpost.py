@@ -13,34 +13,76 @@ TWITCH_CLIENT_ID = 'your_twitch_client_id'
 TWITCH_LOGIN = 'your_twitch_login'
 API_KEY = 'your_openai_api_key'
 TWITCH_CHANNEL = 'your_channel_name' 
+OPENAI_API_URL = 'https://api.openai.com/v1/chat/completions'
+SEND_DELAY = 2  # Seconds between chat messages, to avoid rate limits
+PHASE_DELAY = 10  # Seconds between the sections of a mystery
+GUESS_WINDOW = 60  # Seconds chat has to guess the murderer
+TIME_SCALE = 1.0  # Multiplies the delays above; the load tests shrink it so a whole mystery takes seconds
+MAX_MESSAGE_BYTES = 490  # Twitch's limit is 500 characters; we use 490 UTF-8 bytes to be safe.
 
 # Game state variables
 game_state = None
 suspect_count = {}
 murderer_name = ''  # Store the murderer's name for comparison
 
+SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+|(?<=[.!?]["\')\u201d\u2019])\s+')
+
+def pack_message(message):
+    """Pack the sentences of a message, across line breaks, into as few chat messages as possible.
+
+    Returns the messages encoded as UTF-8. A message only ends mid-sentence when the sentence
+    doesn't fit in a message of its own. Splits the same way as the enhanced bot's pack_message.
+    """
+    encoded = []
+    current = []  # Encoded sentences and words of the chat message being filled
+    size = 0
+
+    def flush():
+        nonlocal current, size
+        if current:
+            encoded.append(b' '.join(current))
+        current, size = [], 0
+
+    def add(piece):
+        nonlocal size
+        if current and size + 1 + len(piece) <= MAX_MESSAGE_BYTES:
+            current.append(piece)
+            size += 1 + len(piece)
+        else:
+            flush()
+            current.append(piece)
+            size = len(piece)
+
+    for paragraph in message.split("\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        for sentence in SENTENCE_BREAK.split(paragraph):
+            piece = sentence.encode("utf-8")
+            if len(piece) <= MAX_MESSAGE_BYTES:
+                add(piece)
+                continue
+            # A sentence too long for one message is packed word by word instead
+            for word in piece.split(b' '):
+                while len(word) > MAX_MESSAGE_BYTES:
+                    # No space found, split at the byte limit without cutting a character in half
+                    cut = MAX_MESSAGE_BYTES
+                    while word[cut] & 0xC0 == 0x80:
+                        cut -= 1
+                    flush()
+                    encoded.append(word[:cut])
+                    word = word[cut:]
+                if word:
+                    add(word)
+    flush()
+    return encoded
+
 def send_message(sock, message):
     """Send a message to the Twitch chat with clean formatting."""
-    max_length = 490  # Twitch's limit is 500; we use 490 to be safe.
-    lines = message.split("\n")
-    for line in lines:
-        line = line.strip()
-        if line:
-            while len(line) > 0:
-                if len(line) <= max_length:
-                    send_line = line
-                    line = ''
-                else:
-                    # Find the last space before max_length to avoid splitting words
-                    split_index = line.rfind(' ', 0, max_length)
-                    if split_index == -1:
-                        # No space found, split at max_length
-                        split_index = max_length
-                    send_line = line[:split_index]
-                    line = line[split_index:].lstrip()
-                print(f"Sending message to chat: {send_line}")
-                sock.send(f"PRIVMSG #{TWITCH_CHANNEL} :{send_line}\r\n".encode("utf-8"))
-                time.sleep(2)  # Delay to avoid rate limits
+    for send_line in pack_message(message):
+        print(f"Sending message to chat: {send_line.decode('utf-8')}")
+        sock.send(f"PRIVMSG #{TWITCH_CHANNEL} :".encode("utf-8") + send_line + b"\r\n")
+        time.sleep(SEND_DELAY * TIME_SCALE)  # Delay to avoid rate limits
 
 def connect_to_twitch():
     """Connect to the Twitch IRC server and authenticate the bot."""
@@ -88,7 +130,7 @@ def fetch_mystery_from_chatgpt():
     try:
         print("Sending request to ChatGPT API...")
         response = requests.post(
-            'https://api.openai.com/v1/chat/completions',
+            OPENAI_API_URL,
             headers=headers,
             json=data
         )
@@ -134,7 +176,7 @@ def receive_messages(sock):
         try:
             response = sock.recv(2048).decode("utf-8")
             if response.startswith("PING"):
-                sock.send("PONG\n".encode("utf-8"))
+                sock.send("PONG :tmi.twitch.tv\r\n".encode("utf-8"))
             else:
                 for line in response.strip().split("\r\n"):
                     if "PRIVMSG" in line:
@@ -168,22 +210,22 @@ def start_mystery(sock):
     if backstory and murder and clues and reveal and suspects and murderer:
         murderer_name = murderer.lower()
         send_message(sock, f"Backstory: {backstory}")
-        time.sleep(10)
+        time.sleep(PHASE_DELAY * TIME_SCALE)
 
         send_message(sock, f"The Murder: {murder}")
-        time.sleep(10)
+        time.sleep(PHASE_DELAY * TIME_SCALE)
 
         send_message(sock, f"Suspects: {suspects}")
-        time.sleep(10)
+        time.sleep(PHASE_DELAY * TIME_SCALE)
 
         send_message(sock, f"Clue Phase: {clues}")
-        time.sleep(10)
+        time.sleep(PHASE_DELAY * TIME_SCALE)
 
         # Include the list of suspects when asking for guesses
-        send_message(sock, f"Guess who the murderer is from the suspects listed! You have 60 seconds to submit your guesses.")
+        send_message(sock, f"Guess who the murderer is from the suspects listed! You have {GUESS_WINDOW} seconds to submit your guesses.")
         game_state = 'guessing'
-        # Schedule the reveal in 60 seconds
-        threading.Timer(60, poll_chat_for_reveal, args=(sock, reveal)).start()
+        # Schedule the reveal once the guessing window closes
+        threading.Timer(GUESS_WINDOW * TIME_SCALE, poll_chat_for_reveal, args=(sock, reveal)).start()
     else:
         send_message(sock, "An error occurred fetching the mystery. Try again later.")
         game_state = None
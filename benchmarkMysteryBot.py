@@ -0,0 +1,1402 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import hmac
+import http.client
+import http.server
+import logging
+import json
+import os
+import random
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import enhancedMysteryVersionWithEventsub as bot
+
+# Benchmark configuration
+BENCH_CHANNEL = "benchchannel"
+BENCH_LINES = 20000  # Chat lines the fake server sends per run
+BENCH_RATE = 2000  # Chat lines per second
+BENCH_PROBE_EVERY = 2000  # Send a "!mystery" probe (which makes the bot reply) every N lines
+BENCH_TOKENS_PER_SEC = 40  # Generation speed of the fake OpenAI server
+BENCH_WEBHOOK_RATE = 1000  # EventSub notifications per second
+BENCH_WEBHOOK_SECONDS = 10  # Length of the notification burst
+BENCH_WEBHOOK_RETRIES = 0.05  # Share of notifications delivered twice, like Twitch's retries
+BENCH_WEBHOOK_DEADLINE = 2.0  # Seconds after which Twitch would give up on a response and retry
+BENCH_WEBHOOK_MIN_RATE = 0.95  # Share of BENCH_WEBHOOK_RATE the webhook has to keep up with, or the benchmark fails
+BENCH_PHASE_GAMES = 200  # Mysteries running at once in the phase scheduler benchmark
+BENCH_PHASE_SCALE = 0.01  # TIME_SCALE for the phase scheduler benchmark, so a mystery lasts about a second
+BENCH_JOURNAL_GAMES = 200  # Games taking guesses when the journal benchmark restarts the bot
+BENCH_JOURNAL_GUESSES = 100000  # Guesses tallied, and so journaled, before the restart
+BENCH_HEDGE_GENERATIONS = 200  # Mysteries generated per mode in the hedging benchmark
+BENCH_HEDGE_DELAY = 0.5  # GENERATION_HEDGE_DELAY for the hedging benchmark
+BENCH_LEADERBOARD_VIEWERS = 100000  # Distinct viewers in the leaderboard benchmark
+BENCH_LEADERBOARD_GAMES = 3000  # Reveals recorded in the leaderboard benchmark
+BENCH_LEADERBOARD_BASELINE_GAMES = 300  # Reveals written with a transaction each, for comparison
+BENCH_RECONNECT_GUESSES = 1000  # Guesses sent before each connection failure in the reconnect benchmark
+BENCH_RECONNECT_PING = 0.5  # IRC_PING_INTERVAL and IRC_PONG_TIMEOUT for the reconnect benchmark
+BENCH_STARTUP_CHANNELS = 10  # Channels joined by the bot in the startup benchmark
+BENCH_STARTUP_LATENCY = 0.1  # Seconds each fake Twitch API call, and the JOIN confirmation, take
+BENCH_STARTUP_RUNS = 3  # Cold starts per mode; the median is reported
+BENCH_TOKEN_CALLERS = 50  # Threads needing the app token at the moment it expires
+BENCH_TOKEN_LATENCY = 0.2  # Seconds the fake Twitch auth server takes to hand out a token
+BENCH_TOKEN_LIFETIME = 2.0  # expires_in of the fake tokens, in seconds
+BENCH_GUESS_RATE = 10000  # Guesses per second chat sends in the guess tally benchmark
+BENCH_GUESS_SECONDS = 10  # Length of the guessing window, so BENCH_GUESS_RATE * BENCH_GUESS_SECONDS guesses
+BENCH_GUESS_SPAM = 0.9  # Share of guesses that are unique strings, the rest go to a few real suspects
+BENCH_GUESS_THREADS = 4  # Threads voting at once in the concurrency check
+BENCH_TRACE_CHANNEL = "tracechannel"  # Channel the traced mystery is played in
+BENCH_TRACE_SPANS = 100000  # Spans timed to measure the cost of one span
+BENCH_TRACE_SCALE = 0.02  # TIME_SCALE for the traced mystery
+BENCH_TRACE_TOKENS_PER_SEC = 400  # Generation speed of the fake OpenAI server for the traced mystery
+BENCH_PROFILE_SECONDS = 3  # Length of the chat flood, and of the profile taken during it
+SAMPLE_MYSTERY = (
+    "Backstory: Lord Ashford has gathered his family at Ravenscroft Manor to announce changes to his will. "
+    "A storm has cut the manor off from the village.\n\n"
+    "The Murder: Just after midnight Lord Ashford is found in the library, poisoned. His brandy glass is still warm.\n\n"
+    "Suspects: Lady Margaret Ashford, his wife; James Thorne, the butler; Dr. Eleanor Voss, the family physician; "
+    "Colonel Arthur Reed, an old friend.\n\n"
+    "Clue Phase: The library clock was stopped at 11:40. Mud from the garden was found on the butler's boots. "
+    "The physician's bag was missing a vial of digitalis. The colonel was heard arguing about a debt.\n\n"
+    "Murderer: Dr. Eleanor Voss\n\n"
+    "The Reveal: Dr. Voss took digitalis from her own bag and slipped it into the brandy while checking Lord Ashford's pulse. "
+    "The stopped clock was meant to frame the butler, but she forgot that the clock had been broken for a week."
+)
+
+
+# Fake Twitch IRC server: tracks which connection joined which channel, sends chat to them
+# and records what the bots send back
+class FakeIRCServer:
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        self.clients = []
+        self.members = {}  # Channel -> set of client sockets that joined it
+        self.bot_messages = []  # (time, channel, text) of every PRIVMSG sent by a bot
+        self.pongs = []  # Lines the bots answered our PINGs with
+        self.nicks = {}  # Client socket -> the nick it logged in with
+        self.join_delay = 0  # Seconds before a JOIN is confirmed, like Twitch does
+        self.muted = set()  # Client sockets whose lines are ignored, as if the connection had stalled
+        self.condition = threading.Condition()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    # Function to accept bot connections
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            with self.condition:
+                self.clients.append(client)
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    # Function to read what one bot sends
+    def serve(self, client):
+        buffer = b""
+        while True:
+            try:
+                data = client.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                self.handle(client, line.decode('utf-8', errors='replace').rstrip('\r'))
+        with self.condition:
+            for members in self.members.values():
+                members.discard(client)
+            self.condition.notify_all()
+
+    # Function to act on one command from a bot
+    def handle(self, client, line):
+        command, _, rest = line.partition(' ')
+        with self.condition:
+            if client in self.muted:
+                return
+            if command == 'PING':
+                with contextlib.suppress(OSError):
+                    client.sendall(f"PONG {rest}\r\n".encode('utf-8'))
+            elif command == 'PONG':
+                self.pongs.append(line)
+            elif command == 'NICK':
+                self.nicks[client] = rest.lower()
+            elif command == 'JOIN':
+                for channel in rest.split(','):
+                    self.members.setdefault(channel.lstrip('#'), set()).add(client)
+                nick = self.nicks.get(client, 'justinfan')
+                echo = "".join(f":{nick}!{nick}@{nick}.tmi.twitch.tv JOIN {channel}\r\n" for channel in rest.split(','))
+                threading.Timer(self.join_delay, self.send_quietly, (client, echo.encode('utf-8'))).start()
+            elif command == 'PART':
+                for channel in rest.split(','):
+                    self.members.get(channel.lstrip('#'), set()).discard(client)
+            elif command == 'PRIVMSG':
+                channel, _, text = rest.partition(' :')
+                self.bot_messages.append((time.time(), channel.lstrip('#'), text))
+            self.condition.notify_all()
+
+    # Function to wait until every channel has been joined by a connection; returns False on timeout
+    def wait_for_joins(self, channels, timeout=30, exclude=None):
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: all(self.members.get(channel, set()) - {exclude} for channel in channels), timeout)
+
+    # Function to wait for a bot message in a channel that contains some text
+    def wait_for_message(self, channel, text, timeout=10):
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: any(sent_channel == channel and text in sent_text for _, sent_channel, sent_text in self.bot_messages), timeout)
+
+    # Function to send raw chat lines to every connection in a channel
+    def send_chat(self, channel, data):
+        with self.condition:
+            members = list(self.members.get(channel, ()))
+        for client in members:
+            with contextlib.suppress(OSError):
+                client.sendall(data)
+
+    # Function to send a chat flood to a channel at a fixed rate
+    def flood(self, channel, lines, rate, probe_every=0):
+        batch = max(1, rate // 100)
+        start = time.time()
+        for sent in range(0, lines, batch):
+            payload = []
+            for index in range(sent, min(sent + batch, lines)):
+                user = f"viewer{index % 5000}"
+                text = "!mystery" if probe_every and index % probe_every == 0 else "lady ashford"
+                payload.append(f":{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #{channel} :{text} @{time.time():.6f}\r\n")
+            self.send_chat(channel, "".join(payload).encode('utf-8'))
+            delay = start + (sent + batch) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    # Function to send to a connection that may have closed meanwhile
+    def send_quietly(self, client, data):
+        with contextlib.suppress(OSError):
+            client.sendall(data)
+
+    # Function to send a raw line to every connection
+    def send_all(self, data):
+        with self.condition:
+            clients = list(self.clients)
+        for client in clients:
+            with contextlib.suppress(OSError):
+                client.sendall(data)
+
+    # Function to close every connection, as Twitch does when a server goes away
+    def drop(self):
+        with self.condition:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            with contextlib.suppress(OSError):
+                client.shutdown(socket.SHUT_RDWR)
+                client.close()
+
+    # Function to stop answering and reading the current connections without closing them
+    def stall(self):
+        with self.condition:
+            self.muted.update(self.clients)
+
+    def close(self):
+        with self.condition:
+            clients = list(self.clients)
+        for client in clients:
+            with contextlib.suppress(OSError):
+                client.close()
+        self.listener.close()
+
+
+# Fake OpenAI chat completions endpoint that generates SAMPLE_MYSTERY at a fixed token rate
+class FakeOpenAIHandler(http.server.BaseHTTPRequestHandler):
+    tokens_per_sec = BENCH_TOKENS_PER_SEC
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        tokens = [SAMPLE_MYSTERY[i:i + 4] for i in range(0, len(SAMPLE_MYSTERY), 4)]
+        if body.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for token in tokens:
+                chunk = {'choices': [{'delta': {'content': token}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(1 / self.tokens_per_sec)
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+        time.sleep(len(tokens) / self.tokens_per_sec)
+        payload = json.dumps({'choices': [{'message': {'content': SAMPLE_MYSTERY}}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+# Fake OpenAI server with two models: 'flaky' is usually fast but sometimes very slow or off-format, 'steady' is
+# a little slower but always answers well
+class HedgingOpenAIHandler(http.server.BaseHTTPRequestHandler):
+    rng = random.Random(7)
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with self.lock:
+            roll = self.rng.random()
+        content = SAMPLE_MYSTERY
+        if body.get('model') == 'flaky':
+            time.sleep(3.0 if roll < 0.1 else 0.1)
+            if 0.1 <= roll < 0.2:
+                content = "I'm sorry, but I can't write that mystery."
+        else:
+            time.sleep(0.3)
+        payload = json.dumps({'choices': [{'message': {'content': content}}]}).encode('utf-8')
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The bot cancelled this request
+
+
+# Fake Twitch server handing out numbered app tokens slowly; the API answers 401 to any but the latest token, and
+# to a revoked one
+class TokenAuthHandler(http.server.BaseHTTPRequestHandler):
+    lock = threading.Lock()
+    issued = 0
+    revoked = None
+    lifetime = BENCH_TOKEN_LIFETIME
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        time.sleep(BENCH_TOKEN_LATENCY)
+        with self.lock:
+            TokenAuthHandler.issued += 1
+            token = f"token{TokenAuthHandler.issued}"
+        self.send_json(200, {'access_token': token, 'expires_in': TokenAuthHandler.lifetime, 'token_type': 'bearer'})
+
+    def do_GET(self):
+        token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+        if token != f"token{TokenAuthHandler.issued}" or token == TokenAuthHandler.revoked:
+            self.send_json(401, {'status': 401, 'message': 'Invalid OAuth token'})
+        else:
+            self.send_json(200, {'data': []})
+
+
+# Fake Twitch auth and Helix API answering every call after a fixed delay
+class StartupTwitchHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, data=None):
+        time.sleep(BENCH_STARTUP_LATENCY)
+        payload = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/helix/users':
+            logins = [login for name, login in urllib.parse.parse_qsl(url.query) if name == 'login']
+            self.reply(200, {'data': [{'id': str(1000 + index), 'login': login, 'display_name': login}
+                                      for index, login in enumerate(logins)]})
+        else:
+            self.reply(200, {'data': [], 'pagination': {}})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/oauth2/token'):
+            self.reply(200, {'access_token': 'startup', 'expires_in': 3600, 'token_type': 'bearer'})
+        else:
+            self.reply(202, {'data': []})
+
+    def do_DELETE(self):
+        self.reply(204)
+
+
+# Function to start a local HTTP server on a free port
+def start_http_server(handler):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Function to wrap a chat handler so it records how late each line is processed
+def instrument(handler, lags):
+    def instrumented(line):
+        received = time.time()
+        handler(line.rsplit(" @", 1)[0])
+        if " @" in line:
+            lags.append(received - float(line.rsplit(" @", 1)[1]))
+    return instrumented
+
+
+# Function to point the bot at the fake server with a game that is already taking guesses
+def prepare_bot(server):
+    bot.TWITCH_IRC_SERVER = '127.0.0.1'
+    bot.TWITCH_IRC_PORT = server.port
+    bot.APP_TOKEN.set('benchmark', 3600)
+    game = bot.add_game(BENCH_CHANNEL)
+    game.reset()
+    game.state = 'guessing'
+    for index in range(5000):  # Every viewer FakeIRCServer.flood chats as, so no lookups go to Twitch
+        login = f"viewer{index}"
+        bot.USER_CACHE.put(login, {'id': str(index), 'login': login, 'display_name': login})
+
+
+# Function to run the bot with the thread-per-task engine
+def run_threaded(server, lags):
+    bot.TWITCH_CHANNELS = [BENCH_CHANNEL]
+    bot.process_chat_message = instrument(ORIGINAL_PROCESS_CHAT_MESSAGE, lags)
+    bot.start_chat(daemon=True)
+
+
+# Function to run the bot with the asyncio engine
+def run_async(server, lags):
+    bot.async_process_chat_message = instrument(ORIGINAL_ASYNC_PROCESS_CHAT_MESSAGE, lags)
+
+    threading.Thread(target=asyncio.run, args=(bot.async_receive_messages(),), daemon=True).start()
+
+
+# Function to benchmark one engine and return its measurements
+def benchmark_engine(name, run):
+    server = FakeIRCServer()
+    prepare_bot(server)
+    lags = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        run(server, lags)
+        server.wait_for_joins([BENCH_CHANNEL])
+        start = time.time()
+        server.flood(BENCH_CHANNEL, BENCH_LINES, BENCH_RATE, BENCH_PROBE_EVERY)
+        while len(lags) < BENCH_LINES and time.time() - start < 120:
+            time.sleep(0.05)
+        elapsed = time.time() - start
+    server.close()
+    lags.sort()
+    return {
+        'engine': name,
+        'lines': len(lags),
+        'lines_per_sec': len(lags) / elapsed,
+        'replies_per_sec': len(server.bot_messages) / elapsed,
+        'lag_p50_ms': 1000 * lags[len(lags) // 2] if lags else 0.0,
+        'lag_p99_ms': 1000 * lags[int(len(lags) * 0.99)] if lags else 0.0,
+        'lag_max_ms': 1000 * lags[-1] if lags else 0.0,
+    }
+
+
+# Function to measure how fast the threaded engine gets back into a channel after the connection is lost while
+# chat is guessing, and check nothing the game or the outbound queue held was lost
+def benchmark_reconnect():
+    server = FakeIRCServer()
+    prepare_bot(server)
+    bot.IRC_PING_INTERVAL = bot.IRC_PONG_TIMEOUT = BENCH_RECONNECT_PING
+    game = bot.GAMES[BENCH_CHANNEL]
+    scenarios = [
+        ('closed', server.drop),
+        ('RECONNECT', lambda: server.send_all(b":tmi.twitch.tv RECONNECT\r\n")),
+        ('stalled', server.stall),
+    ]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        run_threaded(server, [])
+        server.wait_for_joins([BENCH_CHANNEL])
+        server.send_all(b"PING :tmi.twitch.tv\r\n")
+        time.sleep(0.2)
+    print(f"PING answered with {server.pongs[0] if server.pongs else None!r}")
+    # Counts of a line said just before the failure and one said during the gap in chat. Neither may be lost; the
+    # first is sent again when nothing came from Twitch after it, since it may not have arrived
+    print(f"{'failure':<12}{'recovered s':>12}{'guesses kept':>14}{'state':>10}{'line before':>13}{'line during':>13}")
+    for name, fail in scenarios:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            server.flood(BENCH_CHANNEL, BENCH_RECONNECT_GUESSES, BENCH_RATE)
+            time.sleep(0.2)
+            tally = dict(game.tally.counts())
+            with server.condition:
+                old = next(iter(server.members[BENCH_CHANNEL]))
+            before = f"said before the failure ({name})"
+            game.say(before).result()
+            start = time.monotonic()
+            fail()
+            during = f"said during the gap ({name})"
+            game.say(during)
+            rejoined = server.wait_for_joins([BENCH_CHANNEL], timeout=10, exclude=old)
+            recovered = time.monotonic() - start
+            server.wait_for_message(BENCH_CHANNEL, during, timeout=5)
+            time.sleep(0.2)
+        with server.condition:
+            received = [text for _, _, text in server.bot_messages]
+        print(f"{name:<12}{recovered if rejoined else float('nan'):>12.2f}{str(game.tally.counts() == tally):>14}"
+              f"{game.state:>10}{received.count(before):>13}{received.count(during):>13}")
+    print(f"reconnects by reason: {dict((reason, count) for (reason,), count in sorted(bot.IRC_RECONNECTS.values.items()))}")
+    server.close()
+
+
+# Function to compare the threaded engine with the asyncio engine
+def benchmark_engines():
+    results = [benchmark_engine('asyncio', run_async), benchmark_engine('threaded', run_threaded)]
+    print(f"{BENCH_LINES} chat lines at {BENCH_RATE}/s, a reply-triggering probe every {BENCH_PROBE_EVERY} lines")
+    print(f"{'engine':<10}{'lines':>8}{'lines/s':>10}{'replies/s':>11}{'p50 lag ms':>12}{'p99 lag ms':>12}{'max lag ms':>12}")
+    for result in results:
+        print(f"{result['engine']:<10}{result['lines']:>8}{result['lines_per_sec']:>10.0f}{result['replies_per_sec']:>11.2f}"
+              f"{result['lag_p50_ms']:>12.1f}{result['lag_p99_ms']:>12.1f}{result['lag_max_ms']:>12.1f}")
+
+
+# Function to compare time to the first chat line with and without streaming completions
+def benchmark_streaming():
+    server = start_http_server(FakeOpenAIHandler)
+    bot.OPENAI_API_URL = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.time()
+        bot.fetch_mystery_from_chatgpt()
+        blocking_total = time.time() - start
+
+        sections = {}
+        start = time.time()
+        bot.stream_mystery_from_chatgpt(lambda label, text: sections.setdefault(label, time.time() - start))
+        streaming_total = time.time() - start
+    server.shutdown()
+    print(f"Fake generation at {BENCH_TOKENS_PER_SEC} tokens/s")
+    print(f"{'mode':<12}{'first line s':>14}{'complete s':>12}")
+    print(f"{'blocking':<12}{blocking_total:>14.2f}{blocking_total:>12.2f}")
+    print(f"{'streaming':<12}{sections.get('Backstory', streaming_total):>14.2f}{streaming_total:>12.2f}")
+    for label, elapsed in sections.items():
+        print(f"  {label:<12}ready after {elapsed:.2f}s")
+
+
+# Function to synthesize a labelled chat recording of guesses for the suspects in SAMPLE_MYSTERY
+def record_guess_chat(count, seed=7):
+    rng = random.Random(seed)
+    suspects = bot.SuspectIndex(bot.parse_mystery_response(SAMPLE_MYSTERY)[2]).suspects
+    noise = ["lol", "PogChamp", "this is so good", "KEKW", "who?", "!mystery", "i have no idea", "first time here", "LUL LUL"]
+    templates = ["{}", "{}!", "{}!!!", "it was {}", "i think {}", "{} did it", "definitely {}", "{}?"]
+    lines = []
+    for _ in range(count):
+        if rng.random() < 0.3:
+            lines.append((rng.choice(noise), None))
+            continue
+        suspect = rng.choice(suspects)
+        words = suspect.replace('.', '').split()
+        variant = rng.choice([suspect, words[-1], ' '.join(words[-2:]), f"{words[0]} {words[-1]}", words[-1][:4]])
+        if rng.random() < 0.15:
+            # Swap two adjacent letters to simulate a typo
+            position = rng.randrange(len(variant) - 1)
+            variant = variant[:position] + variant[position + 1] + variant[position] + variant[position + 2:]
+        if rng.random() < 0.5:
+            variant = variant.lower()
+        lines.append((rng.choice(templates).format(variant), suspect))
+    return lines
+
+
+# Function to compare the indexed suspect matcher with exact string tallying
+def benchmark_matcher():
+    suspects_text = bot.parse_mystery_response(SAMPLE_MYSTERY)[2]
+    lines = record_guess_chat(100000)
+    index = bot.SuspectIndex(suspects_text)
+    by_raw_name = {suspect.lower(): suspect for suspect in index.suspects}
+    matchers = {
+        'exact string': lambda message: by_raw_name.get(message.strip().lower()),
+        'indexed cold': index.match,
+        'indexed warm': index.match,  # Second pass, every distinct line is memoized
+    }
+    print(f"{len(lines)} recorded guesses for {len(index.suspects)} suspects ({len(set(message for message, _ in lines))} distinct lines)")
+    print(f"{'matcher':<14}{'ns/message':>12}{'accuracy':>10}{'matched':>10}")
+    for name, match in matchers.items():
+        start = time.perf_counter()
+        results = [match(message) for message, _ in lines]
+        elapsed = time.perf_counter() - start
+        correct = sum(result == label for result, (_, label) in zip(results, lines))
+        matched = sum(result is not None for result in results)
+        print(f"{name:<14}{1e9 * elapsed / len(lines):>12.0f}{correct / len(lines):>10.1%}{matched:>10}")
+
+
+# Function to synthesize a recorded IRC byte stream: tagged chat with emotes and non-ASCII names plus other commands
+def record_irc_corpus(count, seed=7):
+    rng = random.Random(seed)
+    names = ["viewer", "zoë", "ねこ", "müller", "chat_goblin", "li_wei", "renée"]
+    texts = ["lady ashford", "it was the butler!!", "PogChamp PogChamp", "🔍 voss did it 🔍", "¿quién fue?", "KEKW",
+             "!mystery", "i think colonel reed", "это был дворецкий", "Dr Voss 💉"]
+    lines = []
+    for index in range(count):
+        roll = rng.random()
+        if roll < 0.01:
+            lines.append("PING :tmi.twitch.tv")
+            continue
+        user = f"user{index % 5000}"
+        display_name = rng.choice(names) + str(index % 97)
+        tags = (f"@badge-info=;badges=subscriber/12;color=#1E90FF;display-name={display_name};emotes=;"
+                f"first-msg=0;id={index:08x}-7a1b-4c2d-9e3f-{index:012x};mod=0;room-id=12345;subscriber=1;"
+                f"tmi-sent-ts={1700000000000 + index};turbo=0;user-id={100000 + index % 5000};user-type=")
+        if roll < 0.03:
+            lines.append(f"{tags} :tmi.twitch.tv USERNOTICE #{BENCH_CHANNEL} :Great stream\\sfolks")
+        else:
+            lines.append(f"{tags} :{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #{BENCH_CHANNEL} :{rng.choice(texts)}")
+    return ("\r\n".join(lines) + "\r\n").encode('utf-8')
+
+
+# Function to parse a byte stream the way the bot did before the framer: decode each 2048-byte read,
+# split the str buffer per line, then unescape tags and regex-match every line
+def legacy_parse(corpus):
+    parsed = decode_errors = 0
+    buffer = ""
+    for offset in range(0, len(corpus), 2048):
+        chunk = corpus[offset:offset + 2048]
+        try:
+            buffer += chunk.decode('utf-8')
+        except UnicodeDecodeError:
+            # The bot's receive loop stopped here; carry on so the rest of the corpus is still timed
+            decode_errors += 1
+            buffer += chunk.decode('utf-8', errors='replace')
+        while '\r\n' in buffer:
+            line, buffer = buffer.split('\r\n', 1)
+            if line.startswith('PING'):
+                continue
+            if line.startswith('@'):
+                raw_tags, _, line = line[1:].partition(' ')
+                bot.parse_irc_tags(raw_tags)
+            if "PRIVMSG" in line and re.search(r":(\w+)!.*PRIVMSG #(\w+) :(.*)", line):
+                parsed += 1
+    return parsed, decode_errors
+
+
+# Function to parse a byte stream with the bot's framer and IRCv3 line parser
+def framer_parse(corpus):
+    framer = bot.IRCLineFramer()
+    parsed = 0
+    view = memoryview(corpus)
+    for offset in range(0, len(corpus), bot.IRC_RECV_SIZE):
+        for line in framer.feed(view[offset:offset + bot.IRC_RECV_SIZE]):
+            if line.startswith('PING'):
+                continue
+            if bot.parse_irc_line(line).command == 'PRIVMSG':
+                parsed += 1
+    return parsed, 0
+
+
+# Function to compare the byte framer and line parser with the old decode-and-regex receive path
+def benchmark_parser():
+    corpus = record_irc_corpus(200000)
+    line_count = corpus.count(b'\n')
+    print(f"{line_count} recorded IRC lines, {len(corpus) / 1e6:.1f} MB")
+    print(f"{'parser':<16}{'lines/s':>12}{'PRIVMSG':>10}{'decode errors':>15}")
+    for name, parse in [('regex (str)', legacy_parse), ('framer + parser', framer_parse)]:
+        start = time.perf_counter()
+        parsed, decode_errors = parse(corpus)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<16}{line_count / elapsed:>12,.0f}{parsed:>10}{decode_errors:>15}")
+
+
+# Function to build the headers Twitch signs an EventSub notification with
+def eventsub_headers(message_id, body):
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + f".{time.time_ns() % 10**9:09d}Z"
+    signature = hmac.new(bot.TWITCH_WEBHOOK_SECRET.encode('utf-8'), (message_id + timestamp + body).encode('utf-8'), hashlib.sha256).hexdigest()
+    return {
+        'Content-Type': 'application/json',
+        'Twitch-Eventsub-Message-Id': message_id,
+        'Twitch-Eventsub-Message-Timestamp': timestamp,
+        'Twitch-Eventsub-Message-Signature': f"sha256={signature}",
+        'Twitch-Eventsub-Message-Type': 'notification',
+    }
+
+
+# Function to send a burst of signed notifications to the bot's webhook, some of them twice, as Twitch would
+def benchmark_webhook():
+    game = bot.add_game(BENCH_CHANNEL)
+    game.broadcaster_id = '1000'
+    bot.GAMES_BY_BROADCASTER['1000'] = game
+    bot.IRC_SOCKET, _ = socket.socketpair()
+    handled = []
+    handle_event = bot.EVENTS.handler
+    bot.EVENTS.handler = lambda event: handled.append(handle_event(event))
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)  # Queueing shows up in the response times instead
+    threading.Thread(target=bot.serve_webhooks, args=(bot.create_app(), port), daemon=True).start()
+    local = threading.local()
+
+    # http.client keeps the sender cheap enough to share one process with the server being measured. Response
+    # times count from when Twitch would have sent the notification, so time spent queued for a sender counts too.
+    def deliver(message_id, body, scheduled):
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        local.connection.request('POST', '/webhook', body=body, headers=eventsub_headers(message_id, body))
+        response = local.connection.getresponse()
+        response.read()
+        return response.status, time.monotonic() - scheduled
+
+    total = BENCH_WEBHOOK_RATE * BENCH_WEBHOOK_SECONDS
+    rng = random.Random(7)
+    results = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(50):
+            with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', port)):
+                break
+            time.sleep(0.1)
+        with concurrent.futures.ThreadPoolExecutor(bot.WEBHOOK_THREADS) as pool:
+            start = time.monotonic()
+            for index in range(total):
+                scheduled = start + index / BENCH_WEBHOOK_RATE
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                message_id = str(uuid.uuid4())
+                body = json.dumps({
+                    'subscription': {'type': 'channel.subscribe', 'version': '1'},
+                    'event': {'user_name': f"viewer{index}", 'broadcaster_user_id': '1000', 'broadcaster_user_login': BENCH_CHANNEL},
+                })
+                results.append(pool.submit(deliver, message_id, body, scheduled))
+                if rng.random() < BENCH_WEBHOOK_RETRIES:
+                    results.append(pool.submit(deliver, message_id, body, scheduled))
+            responses = [result.result() for result in results]
+            elapsed = time.monotonic() - start
+        deadline = time.time() + 10
+        while len(handled) < total and time.time() < deadline:
+            time.sleep(0.05)
+    times = sorted(seconds for _, seconds in responses)
+    failed = sum(not 200 <= status < 300 for status, _ in responses)
+    late = sum(seconds > BENCH_WEBHOOK_DEADLINE for seconds in times)
+    achieved = total / elapsed
+    print(f"{total} notifications offered at {BENCH_WEBHOOK_RATE}/s ({len(responses) - total} delivered twice), "
+          f"answered in {elapsed:.1f}s: {achieved:.0f}/s achieved")
+    print(f"response ms: p50 {1000 * times[len(times) // 2]:.1f}, p99 {1000 * times[int(len(times) * 0.99)]:.1f}, max {1000 * times[-1]:.1f}")
+    print(f"non-2xx responses: {failed}; slower than {BENCH_WEBHOOK_DEADLINE:.0f}s (Twitch would retry): {late}")
+    print(f"events handled: {len(handled)} of {total} unique")
+    counts, handling_total, handling_count = bot.WEBHOOK_SECONDS.values[()]
+    print(f"time inside the webhook handler: mean {1000 * handling_total / handling_count:.3f}ms, "
+          f"{counts[0] / handling_count:.1%} under {1000 * bot.WEBHOOK_SECONDS.buckets[0]:.0f}ms")
+    assert achieved >= BENCH_WEBHOOK_RATE * BENCH_WEBHOOK_MIN_RATE, \
+        f"the webhook kept up with {achieved:.0f}/s of the {BENCH_WEBHOOK_RATE}/s offered"
+
+
+# Context manager that sends file descriptor 1 to /dev/null, so worker processes started inside it are quiet
+@contextlib.contextmanager
+def quiet_stdout_fd():
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+# Function to exercise the sharded coordinator against the fake IRC server
+def benchmark_sharding():
+    import shardedMysteryCoordinator as shard
+    shard.SHARD_HOT_CHANNEL_RATE = 100
+    server = FakeIRCServer()
+    channels = [f"shard{index}" for index in range(40)]
+    settings = {'TWITCH_IRC_SERVER': '127.0.0.1', 'TWITCH_IRC_PORT': server.port, 'ACCESS_TOKEN': 'benchmark',
+                'MYSTERY_POOL_SIZE': 0, 'GAME_JOURNAL_FILE': None, 'LEADERBOARD_DB_FILE': None, 'TRACE_FILE': None,
+                'TWITCH_JOIN_RATE_LIMIT': 1000}
+    coordinator = shard.Coordinator(channels, 4, settings)
+    report = []
+    with quiet_stdout_fd():
+        start = time.time()
+        coordinator.start()
+        server.wait_for_joins(channels)
+        report.append(f"{len(channels)} channels joined by 4 workers in {time.time() - start:.2f}s")
+        spread = collections.Counter(coordinator.assignments.values())
+        report.append(f"Channels per worker: {dict(sorted(spread.items()))}")
+
+        # EventSub notifications go from the coordinator to the owning worker over its pipe
+        start = time.time()
+        coordinator.route_event({'subscription': {'type': 'channel.subscribe'},
+                                 'event': {'user_name': 'benchmark', 'broadcaster_user_login': channels[0]}})
+        server.wait_for_message(channels[0], "Thank you @benchmark")
+        report.append(f"Routed notification reached chat in {1000 * (time.time() - start):.1f}ms")
+
+        # Kill the busiest worker and time how long until its channels are joined elsewhere
+        victim = spread.most_common(1)[0][0]
+        orphaned = [channel for channel, owner in coordinator.assignments.items() if owner == victim]
+        with server.condition:
+            victim_sockets = set.intersection(*(server.members[channel] for channel in orphaned))
+        start = time.time()
+        coordinator.workers[victim]['process'].kill()
+        recovered = server.wait_for_joins(orphaned, timeout=30, exclude=next(iter(victim_sockets), None))
+        report.append(f"Worker {victim} killed; its {len(orphaned)} channels were {'re-joined' if recovered else 'NOT re-joined'}"
+                      f" in {time.time() - start:.2f}s")
+
+        # Two busy channels on the same worker: one should be moved to a quieter worker
+        time.sleep(2 * shard.SHARD_HEARTBEAT_INTERVAL)
+        by_worker = collections.defaultdict(list)
+        for channel, owner in coordinator.assignments.items():
+            by_worker[owner].append(channel)
+        hot = max(by_worker.values(), key=len)[:2]
+        floods = [threading.Thread(target=server.flood, args=(channel, 3000, 500)) for channel in hot]
+        for flood in floods:
+            flood.start()
+        for flood in floods:
+            flood.join()
+        moved = [channel for channel in hot if channel in coordinator.pinned]
+        report.append(f"Flooded {hot} at 500 lines/s each; moved to a quieter worker: {moved or 'none'}")
+        for worker in coordinator.workers.values():
+            worker['process'].kill()
+    server.close()
+    print("\n".join(report))
+
+
+# Function to run many mysteries at once and measure the threads they take and how late their phases run
+def benchmark_phases():
+    bot.TIME_SCALE = BENCH_PHASE_SCALE
+    sent = concurrent.futures.Future()
+    sent.set_result(None)
+    bot.Game.say = lambda game, message, priority=bot.PRIORITY_NARRATIVE: sent  # Measure scheduling, not sending
+    mystery = bot.parse_mystery_response(SAMPLE_MYSTERY)
+    bot.open_mystery = lambda game: bot.PendingMystery(mystery)
+    expected = (4 * bot.PHASE_DELAY + bot.GUESS_WINDOW) * BENCH_PHASE_SCALE
+    started, lateness = {}, []
+
+    def reveal(game, reveal):
+        lateness.append(time.monotonic() - started[game.channel] - expected)
+        game.finish()
+
+    bot.poll_chat_for_reveal = reveal
+    baseline = threading.active_count()
+    peak = baseline
+    for index in range(BENCH_PHASE_GAMES):
+        game = bot.add_game(f"phases{index}")
+        game.state = 'starting'
+        started[game.channel] = time.monotonic()
+        bot.SCHEDULER.schedule(0, bot.start_mystery, game)
+    deadline = time.monotonic() + expected + 30
+    while len(lateness) < BENCH_PHASE_GAMES and time.monotonic() < deadline:
+        peak = max(peak, threading.active_count())
+        time.sleep(0.01)
+    lateness.sort()
+    print(f"{BENCH_PHASE_GAMES} mysteries at once, {expected:.2f}s each")
+    print(f"threads before {baseline}, peak while running {peak}")
+    print(f"mysteries finished {len(lateness)}")
+    if lateness:
+        print(f"reveal lateness ms: p50 {1000 * lateness[len(lateness) // 2]:.1f}, "
+              f"p99 {1000 * lateness[int(len(lateness) * 0.99)]:.1f}, max {1000 * lateness[-1]:.1f}")
+
+
+# Function to journal games taking guesses, restart in-process and check every game resumes where it was
+def benchmark_journal():
+    bot.TIME_SCALE = BENCH_PHASE_SCALE
+    sent = concurrent.futures.Future()
+    sent.set_result(None)
+    bot.Game.say = lambda game, message, priority=bot.PRIORITY_NARRATIVE: sent  # Measure the journal, not sending
+    mystery = bot.parse_mystery_response(SAMPLE_MYSTERY)
+    bot.open_mystery = lambda game: bot.PendingMystery(mystery)
+    suspects = list(bot.SuspectIndex(mystery[2]).suspects)
+    rng = random.Random(7)
+    with tempfile.TemporaryDirectory() as directory:
+        journal_file = os.path.join(directory, 'game_journal.jsonl')
+        bot.GAME_JOURNAL = bot.GameJournal(journal_file, bot.GAME_JOURNAL_COMMIT_INTERVAL, bot.GAME_JOURNAL_COMPACT_RECORDS)
+        bot.GAME_JOURNAL.start()
+        games = [bot.add_game(f"journal{index}") for index in range(BENCH_JOURNAL_GAMES)]
+        for game in games:
+            game.guess_window = 3600 / BENCH_PHASE_SCALE  # Keep every game guessing until the restart
+            game.state = 'starting'
+            bot.SCHEDULER.schedule(0, bot.start_mystery, game)
+        while any(game.state != 'guessing' for game in games):
+            time.sleep(0.01)
+
+        start = time.monotonic()
+        for _ in range(BENCH_JOURNAL_GUESSES):
+            rng.choice(games).tally_guess(f"viewer{rng.randrange(20000)}", rng.choice(suspects))
+        tally_seconds = time.monotonic() - start
+        expected = {game.channel: (game.saved_guesses(), game.phase_due) for game in games}  # Counts the queued guesses
+        bot.GAME_JOURNAL.wait_written()
+        records = bot.JOURNAL_RECORDS.values.get((), 0)
+        commits = bot.JOURNAL_COMMIT_SECONDS.values[()][2]
+        journal_bytes = os.path.getsize(journal_file) + os.path.getsize(bot.GAME_JOURNAL.snapshot_file)
+
+        # Simulate a crash: drop every game without journaling anything, then start again from the files
+        for game in games:
+            game.cancel()
+        bot.GAMES.clear()
+        start = time.monotonic()
+        bot.GAME_JOURNAL = bot.GameJournal(journal_file, bot.GAME_JOURNAL_COMMIT_INTERVAL, bot.GAME_JOURNAL_COMPACT_RECORDS)
+        bot.GAME_JOURNAL.start()
+        for channel in expected:
+            bot.add_game(channel)
+        bot.resume_games()
+        resume_seconds = time.monotonic() - start
+        resumed = sum(1 for channel, (guesses, due) in expected.items()
+                      if bot.GAMES[channel].state == 'guessing' and bot.GAMES[channel].guesses == guesses
+                      and bot.GAMES[channel].phase_due == due)
+    print(f"{BENCH_JOURNAL_GAMES} games, {BENCH_JOURNAL_GUESSES} guesses tallied at {BENCH_JOURNAL_GUESSES / tally_seconds:.0f}/s")
+    print(f"journal records {records}, commits {commits} ({records / max(commits, 1):.0f} records per fsync), {journal_bytes} bytes on disk")
+    print(f"restart: replayed and resumed in {resume_seconds * 1000:.0f} ms, {resumed}/{BENCH_JOURNAL_GAMES} games back with the same guesses and reveal time")
+
+
+# Function to compare generating from one flaky backend with hedging it against a steady one
+def benchmark_hedging():
+    server = start_http_server(HedgingOpenAIHandler)
+    bot.OPENAI_API_URL = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    bot.GENERATION_HEDGE_DELAY = BENCH_HEDGE_DELAY
+    modes = [
+        ('flaky only', [{'name': 'flaky', 'model': 'flaky', 'max_tokens': 1500}], 1),
+        ('hedged', [{'name': 'flaky', 'model': 'flaky', 'max_tokens': 1500},
+                    {'name': 'steady', 'model': 'steady', 'max_tokens': 1500}], 2),
+    ]
+    print(f"{BENCH_HEDGE_GENERATIONS} generations per mode, {bot.GENERATION_WORKERS} at a time; hedge after {BENCH_HEDGE_DELAY}s")
+    print(f"{'mode':<12}{'failed':>8}{'p50 s':>8}{'p99 s':>8}{'max s':>8}")
+    for name, backends, max_attempts in modes:
+        bot.MYSTERY_BACKENDS = backends
+        bot.GENERATION_MAX_ATTEMPTS = max_attempts
+        bot.BACKEND_STATS.clear()
+        bot.GENERATION_ATTEMPTS.values.clear()
+
+        def generate():
+            start = time.monotonic()
+            mystery = bot.generate_mystery()
+            return time.monotonic() - start, bool(mystery) and all(mystery)
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            with concurrent.futures.ThreadPoolExecutor(bot.GENERATION_WORKERS) as executor:
+                results = list(executor.map(lambda _: generate(), range(BENCH_HEDGE_GENERATIONS)))
+        latencies = sorted(elapsed for elapsed, valid in results if valid)
+        failed = sum(1 for _, valid in results if not valid)
+        print(f"{name:<12}{failed:>8}{latencies[len(latencies) // 2]:>8.2f}{latencies[int(len(latencies) * 0.99)]:>8.2f}{latencies[-1]:>8.2f}")
+        for (backend, outcome), count in sorted(bot.GENERATION_ATTEMPTS.values.items()):
+            print(f"  {backend:<8}{outcome:<11}{count:>5}")
+        for backend in backends:
+            stats = bot.backend_stats(backend)
+            print(f"  {backend['name']:<8}latency {stats.latency:.2f}s, success {stats.success_rate:.2f}, score {stats.score():.2f}")
+    server.shutdown()
+
+
+# Function to synthesize the results of many reveals: lists of (username, guessed right)
+def record_reveals(games, viewers, seed=7):
+    rng = random.Random(seed)
+    reveals = []
+    for _ in range(games):
+        guessers = rng.sample(range(viewers), rng.randint(20, 300))
+        reveals.append([(f"viewer{viewer}", rng.random() < 0.3) for viewer in guessers])
+    return reveals
+
+
+# Function to measure the cost of recording reveals, the leaderboard queries and reloading 100k viewers
+def benchmark_leaderboard():
+    reveals = record_reveals(BENCH_LEADERBOARD_GAMES, BENCH_LEADERBOARD_VIEWERS)
+    results = sum(len(reveal) for reveal in reveals)
+    with tempfile.TemporaryDirectory() as directory:
+        # Baseline: write each reveal's results in their own transaction, as a reveal without a buffer would
+        db = sqlite3.connect(os.path.join(directory, 'baseline.db'))
+        db.execute("CREATE TABLE viewer_scores (username TEXT PRIMARY KEY, correct INTEGER NOT NULL, "
+                   "incorrect INTEGER NOT NULL, last_played REAL NOT NULL)")
+        baseline = []
+        for reveal in reveals[:BENCH_LEADERBOARD_BASELINE_GAMES]:
+            start = time.perf_counter()
+            with db:
+                db.executemany("INSERT INTO viewer_scores VALUES (?, ?, ?, ?) ON CONFLICT(username) DO UPDATE SET "
+                               "correct = correct + excluded.correct, incorrect = incorrect + excluded.incorrect, "
+                               "last_played = excluded.last_played",
+                               [(username, int(correct), int(not correct), time.time()) for username, correct in reveal])
+            baseline.append(time.perf_counter() - start)
+        db.close()
+
+        db_file = os.path.join(directory, 'leaderboard.db')
+        leaderboard = bot.Leaderboard(db_file, bot.LEADERBOARD_FLUSH_INTERVAL, bot.LEADERBOARD_TOP_K)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            leaderboard.start()
+        buffered = []
+        start = time.monotonic()
+        for reveal in reveals:
+            reveal_start = time.perf_counter()
+            leaderboard.record(reveal)
+            buffered.append(time.perf_counter() - reveal_start)
+        leaderboard.wait_written()
+        drained = time.monotonic() - start
+        flushes = bot.LEADERBOARD_FLUSH_SECONDS.values[()]
+
+        usernames = [f"viewer{index}" for index in range(0, BENCH_LEADERBOARD_VIEWERS, 10)]
+        start = time.perf_counter()
+        ranks = [leaderboard.rank(username) for username in usernames]
+        rank_us = (time.perf_counter() - start) / len(usernames) * 1e6
+        start = time.perf_counter()
+        for _ in range(10000):
+            leaders = leaderboard.leaders()
+        top_us = (time.perf_counter() - start) / 10000 * 1e6
+
+        reloaded = bot.Leaderboard(db_file, bot.LEADERBOARD_FLUSH_INTERVAL, bot.LEADERBOARD_TOP_K)
+        start = time.monotonic()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            reloaded.load()
+        load_seconds = time.monotonic() - start
+        matching = sum(1 for username, rank in zip(usernames, ranks) if reloaded.rank(username) == rank)
+        assert matching == len(usernames), f"only {matching}/{len(usernames)} sampled ranks survived the reload"
+        db_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.startswith('leaderboard'))
+
+    baseline.sort()
+    buffered.sort()
+    print(f"{BENCH_LEADERBOARD_GAMES} reveals, {results} results from {len(leaderboard.scores)} viewers")
+    print(f"{'reveal write':<22}{'p50 ms':>8}{'p99 ms':>8}")
+    print(f"{'transaction each':<22}{1000 * baseline[len(baseline) // 2]:>8.2f}{1000 * baseline[int(len(baseline) * 0.99)]:>8.2f}")
+    print(f"{'write-behind buffer':<22}{1000 * buffered[len(buffered) // 2]:>8.2f}{1000 * buffered[int(len(buffered) * 0.99)]:>8.2f}")
+    print(f"flushed in {flushes[2]} transactions ({flushes[1]:.2f}s writing), drained {drained:.1f}s after the first reveal; {db_bytes} bytes on disk")
+    print(f"!rank {rank_us:.1f} us, !top {top_us:.1f} us; leader {leaders[0][0]} with {leaders[0][1]} correct")
+    print(f"reload: {load_seconds * 1000:.0f} ms, {matching}/{len(usernames)} sampled ranks unchanged")
+
+
+# Function to split a message the way the bot did before packing: a message per line, split at 490 characters
+def legacy_split(message):
+    for line in message.split('\n'):
+        line = line.strip()
+        while line:
+            if len(line) <= 490:
+                yield line
+                break
+            split_index = line.rfind(' ', 0, 490)
+            if split_index == -1:
+                split_index = 490
+            yield line[:split_index]
+            line = line[split_index:].lstrip()
+
+
+# Function to compare the chat messages a mystery takes with and without sentence packing
+def benchmark_packing():
+    backstory, murder, suspects, clues, murderer, reveal = bot.parse_mystery_response(SAMPLE_MYSTERY)
+    texts = {
+        'sample mystery': [f"{label}: {text}" for label, text in zip(bot.MYSTERY_SECTIONS[:4], (backstory, murder, suspects, clues))]
+                          + [f"The Reveal: {reveal}"],
+        'ten-paragraph reveal': ["The Reveal: " + "\n\n".join([sentence.strip() + '.' for sentence in reveal.split('.') if sentence.strip()] * 5)],
+        'accented text': ["Backstory: " + "\n".join(["Le comte Édouard de Sévigné reçoit à déjeuner ses héritiers à Château-Thierry. "
+                                                   "Ça tourne mal: on le retrouve empoisonné, déjà froid. 🕵️"] * 8),
+                          "Clue Phase: " + " ".join(["Déjà-vu à l'hôtel: la clé était sous le paillasson."] * 10)],
+    }
+    # After the burst allowance, the normal rate tier sends one message per 30 / limit seconds
+    seconds_per_message = 30 / bot.TWITCH_CHAT_RATE_LIMITS['normal']
+    print(f"{'text':<22}{'per line':>10}{'packed':>8}{'saved':>7}{'over 490 bytes':>16}{'time saved s':>14}")
+    for name, messages in texts.items():
+        legacy = [line for message in messages for line in legacy_split(message)]
+        packed = [bot.pack_message(message) for message in messages]
+        lines = sum(len(message.lines) for message in packed)
+        oversized = sum(1 for line in legacy if len(line.encode('utf-8')) > 490)
+        print(f"{name:<22}{len(legacy):>10}{lines:>8}{sum(message.unpacked for message in packed) - lines:>7}"
+              f"{oversized:>16}{(len(legacy) - lines) * seconds_per_message:>14.1f}")
+        assert all(len(line) <= bot.MESSAGE_MAX_BYTES for message in packed for line in message.encoded)
+
+
+# Function to run a call on many threads at once; returns how long each took and what it returned
+def run_callers(call, callers):
+    barrier = threading.Barrier(callers)
+
+    def timed(_):
+        barrier.wait()
+        start = time.perf_counter()
+        result = call()
+        return time.perf_counter() - start, result
+
+    with concurrent.futures.ThreadPoolExecutor(callers) as executor:
+        return list(executor.map(timed, range(callers)))
+
+
+# Function to compare token refreshes done inline by every caller with the single-flight token manager
+def benchmark_tokens():
+    server = start_http_server(TokenAuthHandler)
+    bot.TWITCH_AUTH_URL = f"http://127.0.0.1:{server.server_address[1]}/oauth2/token"
+    bot.TWITCH_API_BASE = f"http://127.0.0.1:{server.server_address[1]}/helix"
+    print(f"{BENCH_TOKEN_CALLERS} callers, auth takes {BENCH_TOKEN_LATENCY}s, tokens last {BENCH_TOKEN_LIFETIME}s")
+    print(f"{'scenario':<24}{'auth calls':>11}{'failed':>8}{'p50 ms':>8}{'max ms':>8}")
+
+    def report(name, issued, results, failed=0):
+        waits = sorted(elapsed * 1000 for elapsed, _ in results)
+        print(f"{name:<24}{TokenAuthHandler.issued - issued:>11}{failed:>8}{waits[len(waits) // 2]:>8.1f}{waits[-1]:>8.1f}")
+
+    # Baseline: each caller checks the expiry and fetches a token itself, as the bot did before the manager
+    legacy = {'token': 'stale', 'expiry': time.time() - 1}
+
+    def legacy_get():
+        if legacy['expiry'] is None or time.time() >= legacy['expiry']:
+            data = bot.HTTP.post(bot.TWITCH_AUTH_URL, params={'grant_type': 'client_credentials'}).json()
+            legacy['token'], legacy['expiry'] = data['access_token'], time.time() + data['expires_in']
+        return legacy['token']
+
+    issued = TokenAuthHandler.issued
+    report('inline at expiry', issued, run_callers(legacy_get, BENCH_TOKEN_CALLERS))
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        bot.APP_TOKEN = bot.AppTokenManager(bot.TOKEN_REFRESH_MARGIN, bot.TOKEN_RETRY_DELAY)
+        bot.APP_TOKEN.token, bot.APP_TOKEN.expiry = 'stale', time.time() - 1
+        issued = TokenAuthHandler.issued
+        results = run_callers(bot.APP_TOKEN.get, BENCH_TOKEN_CALLERS)
+    report('manager at expiry', issued, results)
+    assert len({token for _, token in results}) == 1
+
+    # Callers keep asking over several lifetimes; the refresh ahead of expiry means none of them waits
+    issued = TokenAuthHandler.issued
+    results = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        deadline = time.monotonic() + BENCH_TOKEN_LIFETIME * 3
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            token = bot.APP_TOKEN.get()
+            results.append((time.perf_counter() - start, token))
+            time.sleep(0.01)
+    report('manager, steady use', issued, results)
+
+    # Twitch revokes the token: every request gets a 401 at once and should be replayed after one refresh
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        TokenAuthHandler.lifetime = 3600  # Keep the background refresh out of the way
+        bot.APP_TOKEN.get()
+        bot.APP_TOKEN.refresh('scheduled').result()
+        TokenAuthHandler.revoked = f"token{TokenAuthHandler.issued}"
+        issued = TokenAuthHandler.issued
+        results = run_callers(lambda: bot.helix_request('GET', f"{bot.TWITCH_API_BASE}/users").status_code, BENCH_TOKEN_CALLERS)
+    report('manager, 401 storm', issued, results, sum(1 for _, status in results if status != 200))
+    print(f"refreshes by reason: {dict((reason, count) for (reason,), count in sorted(bot.TOKEN_REFRESHES.values.items()))}")
+    server.shutdown()
+
+
+# Program run in a fresh interpreter by the startup benchmark: starts the bot the way main() does ('parallel'),
+# or the way it did before the phases ran concurrently ('serial'), and prints when each phase finished
+STARTUP_CHILD = """
+import json, os, sys, tempfile, threading, time
+start = time.perf_counter()
+mode, irc_port, api_url, channels = sys.argv[1], int(sys.argv[2]), sys.argv[3], sys.argv[4].split(',')
+if mode == 'serial':
+    import flask, requests  # Imported with the module before
+import enhancedMysteryVersionWithEventsub as bot
+imported = time.perf_counter() - start
+directory = tempfile.mkdtemp()
+bot.TWITCH_BOT_USERNAME = 'benchbot'
+bot.TWITCH_CHANNELS = channels
+bot.TWITCH_IRC_SERVER, bot.TWITCH_IRC_PORT = '127.0.0.1', irc_port
+bot.TWITCH_AUTH_URL, bot.TWITCH_API_BASE = api_url + '/oauth2/token', api_url + '/helix'
+bot.WEBHOOK_PORT = 0
+bot.GAME_JOURNAL_FILE = os.path.join(directory, 'game_journal.jsonl')
+bot.LEADERBOARD_DB_FILE = os.path.join(directory, 'leaderboard.db')
+bot.TRACE_FILE = os.path.join(directory, 'mystery_traces.jsonl')
+bot.MYSTERY_POOL = bot.MysteryPool(os.path.join(directory, 'pool.json'), 0, bot.MYSTERY_POOL_MAX_AGE, bot.MYSTERY_REPEAT_WINDOW)
+bot.GAME_JOURNAL = bot.GameJournal(bot.GAME_JOURNAL_FILE, bot.GAME_JOURNAL_COMMIT_INTERVAL, bot.GAME_JOURNAL_COMPACT_RECORDS)
+bot.LEADERBOARD = bot.Leaderboard(bot.LEADERBOARD_DB_FILE, bot.LEADERBOARD_FLUSH_INTERVAL, bot.LEADERBOARD_TOP_K)
+bot.TRACER = bot.Tracer(bot.TRACE_FILE, bot.TRACE_FLUSH_INTERVAL)
+offset = time.perf_counter() - start
+stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+if mode == 'parallel':
+    bot.main()
+else:
+    for channel in channels:
+        bot.add_game(channel)
+    bot.STARTUP.begin(channels)
+    for phase, function in [('mystery pool', bot.MYSTERY_POOL.start), ('journal', bot.GAME_JOURNAL.start),
+                            ('leaderboard', bot.LEADERBOARD.start), ('chat', lambda: bot.start_chat(daemon=True)),
+                            ('resume', bot.resume_games)]:
+        function()
+        bot.STARTUP.done(phase)
+    threading.Thread(target=bot.serve_webhooks, args=(bot.create_app(), bot.WEBHOOK_PORT), daemon=True).start()
+    bot.STARTUP.done('webhook')
+    bot.start_eventsub()
+    bot.STARTUP.done('eventsub')
+bot.STARTUP.ready.wait(30)
+for ended in list(bot.STARTUP.ended.values()):
+    ended.wait(30)
+phases = {phase: offset + seconds for phase, seconds in bot.STARTUP.finished.items()}
+print(json.dumps({'import': imported, 'phases': phases}), file=stdout, flush=True)
+os._exit(0)
+"""
+
+
+# Function to compare cold starts of the bot with the startup phases run one after another and concurrently
+def benchmark_startup():
+    server = FakeIRCServer()
+    server.join_delay = BENCH_STARTUP_LATENCY
+    api = start_http_server(StartupTwitchHandler)
+    api_url = f"http://127.0.0.1:{api.server_address[1]}"
+    channels = ','.join(f"startup{index}" for index in range(BENCH_STARTUP_CHANNELS))
+    environment = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(bot.__file__)))
+    print(f"{BENCH_STARTUP_CHANNELS} channels, {BENCH_STARTUP_LATENCY}s per Twitch call; seconds from process start, "
+          f"median of {BENCH_STARTUP_RUNS}")
+    phases = ['import', 'mystery pool', 'journal', 'leaderboard', 'token', 'webhook', 'chat', 'resume', 'ready', 'eventsub']
+    print(f"{'mode':<10}" + "".join(f"{phase:>13}" for phase in phases))
+    for mode in ('serial', 'parallel'):
+        runs = []
+        for _ in range(BENCH_STARTUP_RUNS):
+            output = subprocess.run([sys.executable, '-c', STARTUP_CHILD, mode, str(server.port), api_url, channels],
+                                    capture_output=True, text=True, env=environment, timeout=60).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            runs.append(dict(result['phases'], **{'import': result['import']}))
+        medians = {phase: sorted(run[phase] for run in runs)[len(runs) // 2] for phase in phases if all(phase in run for run in runs)}
+        print(f"{mode:<10}" + "".join(f"{medians[phase]:>13.2f}" if phase in medians else f"{'-':>13}" for phase in phases))
+    server.close()
+    api.shutdown()
+
+
+# Function to record a guessing window of chat with no parsed suspects: mostly unique strings, each from a new
+# chatter, and a few suspects with most of the real votes, whose chatters sometimes change their mind
+def record_guess_stream(count, seed=11):
+    rng = random.Random(seed)
+    suspects = ["lady ashford", "colonel reed", "dr voss", "the butler", "miss grey"]
+    weights = [8, 5, 3, 2, 1]
+    guesses = []
+    for index in range(count):
+        if rng.random() < BENCH_GUESS_SPAM:
+            guesses.append((f"spammer{index}", f"{rng.getrandbits(64):016x} was it"))
+        else:
+            guesses.append((f"viewer{rng.randrange(count // 20)}", rng.choices(suspects, weights)[0]))
+    return guesses
+
+
+# Function to tally guesses the way the bot did before GuessTally: a count per distinct guess in a dict,
+# with the leaders found by scanning all of it
+def legacy_tally(guesses, read_every):
+    counts = {}
+    votes = {}
+    read_seconds = 0.0
+    start = time.perf_counter()
+    for index, (username, suspect) in enumerate(guesses, 1):
+        previous = votes.get(username)
+        if previous == suspect:
+            continue
+        if previous is not None:
+            counts[previous] -= 1
+            if not counts[previous]:
+                del counts[previous]
+        votes[username] = suspect
+        counts[suspect] = counts.get(suspect, 0) + 1
+        if not index % read_every:
+            read_start = time.perf_counter()
+            sorted(counts.items(), key=lambda item: item[1], reverse=True)[:3]
+            read_seconds += time.perf_counter() - read_start
+    elapsed = time.perf_counter() - start
+    return counts, elapsed - read_seconds, read_seconds, len(counts)
+
+
+# Function to tally guesses with the bot's Game and GuessTally, reading the leaders as the chat updates would
+def bounded_tally(guesses, read_every):
+    game = bot.Game(BENCH_CHANNEL)
+    read_seconds = 0.0
+    largest = 0
+    start = time.perf_counter()
+    for index, (username, suspect) in enumerate(guesses, 1):
+        if game.guesses.get(username) != suspect:
+            game.count_guess(username, suspect)
+        if not index % read_every:
+            read_start = time.perf_counter()
+            game.tally.leaders(3)
+            read_seconds += time.perf_counter() - read_start
+            largest = max(largest, len(game.tally.bucket_of))
+    elapsed = time.perf_counter() - start
+    return game.tally.counts(), elapsed - read_seconds, read_seconds, largest
+
+
+# Function to compare the bounded Space-Saving guess tally with a dict of every distinct guess under a flood of
+# unique guesses, then check that votes from several threads at once all get counted
+def benchmark_guesses():
+    guesses = record_guess_stream(BENCH_GUESS_RATE * BENCH_GUESS_SECONDS)
+    read_every = BENCH_GUESS_RATE // 10  # Leaders read ten times a second
+    truth = legacy_tally(guesses, len(guesses) + 1)[0]
+    true_top = [guess for guess, _ in sorted(truth.items(), key=lambda item: item[1], reverse=True)[:3]]
+    print(f"{len(guesses)} guesses ({BENCH_GUESS_RATE}/s for {BENCH_GUESS_SECONDS}s), {BENCH_GUESS_SPAM:.0%} unique spam; "
+          f"leaders read every {read_every} guesses; GUESS_TALLY_CAPACITY={bot.GUESS_TALLY_CAPACITY}")
+    print("bounded reads include counting the votes queued since the previous read")
+    print(f"{'tally':<10}{'us/guess':>10}{'max/s':>10}{'us/read':>10}{'entries':>10}{'top 3':>8}{'max error':>11}")
+    for name, tally in (('dict', legacy_tally), ('bounded', bounded_tally)):
+        counts, ingest_seconds, read_seconds, entries = tally(guesses, read_every)
+        top = [guess for guess, _ in sorted(counts.items(), key=lambda item: item[1], reverse=True)[:3]]
+        error = max(counts.get(guess, 0) - truth[guess] for guess in true_top)
+        print(f"{name:<10}{1e6 * ingest_seconds / len(guesses):>10.2f}{len(guesses) / ingest_seconds:>10.0f}"
+              f"{1e6 * read_seconds / (len(guesses) // read_every):>10.1f}{entries:>10}{str(top == true_top):>8}{error:>11}")
+
+    # Every voter votes once from one of several threads, while another thread keeps reading the leaders
+    tally = bot.GuessTally(bot.GUESS_TALLY_CAPACITY)
+    done = threading.Event()
+    reads = [0]
+
+    def read():
+        while not done.is_set():
+            tally.leaders(3)
+            reads[0] += 1
+
+    def vote(part):
+        for _, suspect in part:
+            tally.vote(None, suspect)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=vote, args=(guesses[index::BENCH_GUESS_THREADS],)) for index in range(BENCH_GUESS_THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    reader.join()
+    counted = sum(tally.counts().values())
+    print(f"{BENCH_GUESS_THREADS} voting threads: {len(guesses) / elapsed:.0f} guesses/s, {reads[0]} leader reads, "
+          f"{counted} of {len(guesses)} votes counted")
+
+
+# Function to measure the cost of one span, in nanoseconds, with a tracer
+def time_spans(tracer):
+    start = time.perf_counter()
+    for _ in range(BENCH_TRACE_SPANS):
+        with tracer.span('benchmark', None):
+            pass
+    return 1e9 * (time.perf_counter() - start) / BENCH_TRACE_SPANS
+
+
+# Function to read the spans a tracer wrote, waiting for the writer thread to catch up
+def read_spans(trace_file):
+    time.sleep(2 * bot.TRACE_FLUSH_INTERVAL)
+    with open(trace_file, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+# Function to send a chat line as a viewer
+def chat_as(server, channel, user, text):
+    server.send_chat(channel, f":{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #{channel} :{text}\r\n".encode('utf-8'))
+
+
+# Function to measure what tracing costs, break one whole mystery down by its trace, and profile the receive
+# thread through /debug/profile while it handles a chat flood
+def benchmark_tracing():
+    directory = tempfile.mkdtemp()
+    trace_file = os.path.join(directory, 'mystery_traces.jsonl')
+    disabled = time_spans(bot.Tracer(None, bot.TRACE_FLUSH_INTERVAL))
+    bot.TRACER = bot.Tracer(trace_file, bot.TRACE_FLUSH_INTERVAL)
+    bot.TRACER.start()
+    enabled = time_spans(bot.TRACER)
+    print(f"span cost: {disabled:.0f} ns with tracing off, {enabled:.0f} ns with tracing on")
+
+    FakeOpenAIHandler.tokens_per_sec = BENCH_TRACE_TOKENS_PER_SEC
+    openai = start_http_server(FakeOpenAIHandler)
+    bot.OPENAI_API_URL = f"http://127.0.0.1:{openai.server_address[1]}/v1/chat/completions"
+    bot.TIME_SCALE = BENCH_TRACE_SCALE
+    bot.TWITCH_CHAT_RATE_TIER = 'moderator'  # So the sends don't hide the other phases
+    server = FakeIRCServer()
+    prepare_bot(server)
+    game = bot.add_game(BENCH_TRACE_CHANNEL)
+    lags = []
+    bot.process_chat_message = instrument(ORIGINAL_PROCESS_CHAT_MESSAGE, lags)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        bot.start_chat(daemon=True)
+        server.wait_for_joins([BENCH_CHANNEL, BENCH_TRACE_CHANNEL])
+        chat_as(server, BENCH_TRACE_CHANNEL, "viewer0", "!mystery")
+        server.wait_for_message(BENCH_TRACE_CHANNEL, "Guess who", timeout=60)
+        mystery_id = game.mystery_id
+        for index in range(20):
+            chat_as(server, BENCH_TRACE_CHANNEL, f"viewer{index}", "dr voss" if index % 3 else "the butler")
+        bot.handle_event({'subscription': {'type': 'channel.cheer'},
+                          'event': {'broadcaster_user_login': BENCH_TRACE_CHANNEL, 'user_name': 'viewer1', 'bits': 100}})
+        server.wait_for_message(BENCH_TRACE_CHANNEL, "The Reveal:", timeout=60)
+    spans = [span for span in read_spans(trace_file) if span['mystery'] == mystery_id]
+    print(f"mystery {mystery_id}: {len(spans)} spans, TIME_SCALE {BENCH_TRACE_SCALE}")
+    print(f"{'span':<10}{'detail':<14}{'count':>7}{'total s':>10}{'max s':>9}")
+    rows = {}
+    for span in sorted(spans, key=lambda span: span['start']):
+        detail = span.get('section') or span.get('type') or span.get('backend') or span.get('outcome') or ''
+        rows.setdefault((span['span'], detail), []).append(span['seconds'])
+    for (name, detail), seconds in rows.items():
+        print(f"{name:<10}{detail:<14}{len(seconds):>7}{sum(seconds):>10.3f}{max(seconds):>9.3f}")
+
+    bot.ADMIN_TOKEN = 'benchmark'
+    client = bot.create_app().test_client()
+    denied = client.get('/debug/profile?seconds=1').status_code
+    print(f"/debug/profile without the admin token: {denied}")
+    print(f"{'flood':<14}{'lines':>8}{'p50 ms':>9}{'p99 ms':>9}{'samples':>9}")
+    # The first flood only warms the bot up, later ones are slower whether or not they are profiled
+    for profiling in (None, False, True, False, True):
+        lags.clear()
+        response = None
+        requester = None
+        if profiling:
+            def request_profile():
+                nonlocal response
+                response = client.get(f'/debug/profile?seconds={BENCH_PROFILE_SECONDS}',
+                                      headers={'Authorization': f"Bearer {bot.ADMIN_TOKEN}"})
+            requester = threading.Thread(target=request_profile)
+            requester.start()
+        lines = BENCH_RATE * BENCH_PROFILE_SECONDS
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            server.flood(BENCH_CHANNEL, lines, BENCH_RATE)
+            deadline = time.time() + 30
+            while len(lags) < lines and time.time() < deadline:
+                time.sleep(0.05)
+            if requester is not None:
+                requester.join()
+        if profiling is None:
+            continue
+        lags.sort()
+        samples = response.headers.get('X-Profile-Samples') if profiling else '-'
+        print(f"{'profiled' if profiling else 'unprofiled':<14}{len(lags):>8}{1000 * lags[len(lags) // 2]:>9.1f}"
+              f"{1000 * lags[int(len(lags) * 0.99)]:>9.1f}{samples:>9}")
+    start = time.thread_time()
+    samples, _ = bot.PROFILER.profile(1)
+    print(f"sampling costs {1e6 * (time.thread_time() - start) / samples:.0f} us of CPU per sample, "
+          f"{samples} samples a second")
+    receive_stacks = []
+    for line in response.get_data(as_text=True).splitlines():
+        stack, _, count = line.rpartition(' ')
+        if 'receive_messages' in stack.split(';', 1)[0]:
+            receive_stacks.append((int(count), stack.split(';')[-3:]))
+    print("busiest receive thread stacks (innermost three frames):")
+    for count, frames in receive_stacks[:5]:
+        print(f"{count:>6}  {' <- '.join(reversed(frames))}")
+    server.close()
+    openai.shutdown()
+
+
+ORIGINAL_PROCESS_CHAT_MESSAGE = bot.process_chat_message
+ORIGINAL_ASYNC_PROCESS_CHAT_MESSAGE = bot.async_process_chat_message
+
+BENCHMARKS = {
+    'engines': benchmark_engines,
+    'guesses': benchmark_guesses,
+    'hedging': benchmark_hedging,
+    'journal': benchmark_journal,
+    'leaderboard': benchmark_leaderboard,
+    'matcher': benchmark_matcher,
+    'packing': benchmark_packing,
+    'parser': benchmark_parser,
+    'phases': benchmark_phases,
+    'reconnect': benchmark_reconnect,
+    'sharding': benchmark_sharding,
+    'startup': benchmark_startup,
+    'streaming': benchmark_streaming,
+    'tokens': benchmark_tokens,
+    'tracing': benchmark_tracing,
+    'webhook': benchmark_webhook,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the Twitch mystery bot.")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS), help="Benchmark to run")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark]()
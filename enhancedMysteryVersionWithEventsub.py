@@ -1,102 +1,856 @@
 import socket
 import threading
-import requests
+import asyncio
+import queue
+import itertools
+import concurrent.futures
+import collections
+import random
 import time
+import calendar
 import re
 import os
 import json
+import bisect
+import heapq
+import sqlite3
+import contextlib
+import abc
 from urllib.parse import urlencode, urlparse, parse_qs
-from flask import Flask, request, jsonify
 import hmac
 import hashlib
+import base64
+import ssl
+import sys
 
 # Twitch and OpenAI configuration
 TWITCH_BOT_USERNAME = "YourBotUsername"
 TWITCH_CLIENT_ID = "your_twitch_client_id"  # Replace with your actual Client ID
 TWITCH_CLIENT_SECRET = "your_twitch_client_secret"  # Replace with your actual Client Secret
 TWITCH_CHANNEL = "your_channel_name"  # Replace with your channel name (lowercase)
+TWITCH_CHANNELS = [TWITCH_CHANNEL]  # Every channel to run games in (lowercase); all share one IRC connection
+TWITCH_JOIN_RATE_LIMIT = 20  # Channels Twitch lets the bot join per 10 seconds (2000 for verified bots)
 OPENAI_API_KEY = "your_openai_api_key"  # Replace with your actual OpenAI API key
+OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
+TWITCH_AUTH_URL = "https://id.twitch.tv/oauth2/token"
+TWITCH_API_BASE = "https://api.twitch.tv/helix"
+OPENAI_STREAMING = True  # Stream live generations so the Backstory can be posted before the rest is written
 TWITCH_IRC_SERVER = "irc.chat.twitch.tv"
 TWITCH_IRC_PORT = 6667
+IRC_RECV_SIZE = 65536  # Bytes read from the IRC connection at a time
+IRC_PING_INTERVAL = 60  # Seconds of silence after which the bot pings Twitch to check the connection
+IRC_PONG_TIMEOUT = 10  # Seconds to wait for the PONG before the connection is treated as stalled
+IRC_RECONNECT_BACKOFF = 0.5  # Base of the jittered exponential backoff between reconnect attempts
+IRC_RECONNECT_MAX_WAIT = 30  # Never wait longer than this between reconnect attempts
+IRC_REPLAY_LINES = 20  # Chat lines sent since Twitch last sent anything, resent after the connection is lost
 TWITCH_WEBHOOK_SECRET = "your_webhook_secret"  # Secret for verifying EventSub messages
 WEBHOOK_URL = "https://your_public_domain.com/webhook"  # Replace with your public webhook URL
+WEBHOOK_PORT = 8080  # Local port the webhook and /metrics are served on
+WEBHOOK_THREADS = 8  # Request threads of the webhook server
+WEBHOOK_MAX_AGE = 600  # Seconds after which an EventSub message is rejected as a replay
+WEBHOOK_DEDUP_SIZE = 100000  # EventSub message IDs remembered to drop Twitch's retries
+EVENTSUB_EVENTS = [('channel.subscribe', '1'), ('channel.cheer', '1')]  # (type, version) subscribed in every channel
+EVENTSUB_CONCURRENCY = 8  # Subscription creates and deletes in flight at once
+EVENTSUB_TRANSPORT = 'webhook'  # 'webhook' (needs WEBHOOK_URL to be public) or 'websocket' (needs TWITCH_USER_ACCESS_TOKEN)
+EVENTSUB_WEBSOCKET_URL = "wss://eventsub.wss.twitch.tv/ws"
+TWITCH_USER_ACCESS_TOKEN = "your_user_access_token"  # WebSocket subscriptions need a user token with the events' scopes
+EVENTSUB_WELCOME_TIMEOUT = 10  # Seconds to wait for session_welcome after connecting
+USE_ASYNC_ENGINE = False  # Set to True to run all chat I/O on a single asyncio event loop
+TWITCH_CHAT_RATE_TIER = 'normal'  # 'normal', 'moderator' or 'verified', depending on the bot account
+TWITCH_CHAT_RATE_LIMITS = {  # Chat messages Twitch allows per 30 seconds for each tier
+    'normal': 20,
+    'moderator': 100,
+    'verified': 7500,
+}
+TWITCH_CHAT_BURST_FRACTION = 0.25  # Share of the rate limit that may be sent back to back
+MESSAGE_MAX_BYTES = 490  # Twitch's limit is 500 characters; we use 490 UTF-8 bytes to be safe
+PRIORITY_SYSTEM = 0  # Short replies such as cooldown notices and thanks
+PRIORITY_NARRATIVE = 1  # Mystery text
+MYSTERY_POOL_SIZE = 3  # Mysteries generated ahead of time so !mystery starts instantly
+MYSTERY_POOL_MAX_AGE = 7 * 24 * 3600  # Seconds before a pre-generated mystery is discarded
+MYSTERY_REPEAT_WINDOW = 50  # Number of recently served mysteries that must not be served again
+MYSTERY_CACHE_FILE = "mystery_pool.json"  # Keeps the pool across restarts
+HTTP_TIMEOUT = (3.05, 10)  # Connect and read timeouts in seconds for Twitch API calls
+OPENAI_TIMEOUT = (3.05, 120)  # Read timeout is per chunk when streaming
+HTTP_MAX_RETRIES = 3  # Retries for connection errors, 429 and 5xx responses
+HTTP_RETRY_BACKOFF = 0.5  # Base of the jittered exponential backoff between retries
+HTTP_MAX_RETRY_WAIT = 60  # Never wait longer than this for a rate limit to reset
+HTTP_POOL_SIZE = 10  # Keep-alive connections kept per host
+TOKEN_REFRESH_MARGIN = 0.1  # Share of the app token's lifetime still left when it is replaced in the background
+TOKEN_RETRY_DELAY = 30  # Seconds before retrying a failed background refresh of the app token
+USER_CACHE_SIZE = 10000  # Twitch users whose details are kept in memory
+USER_CACHE_TTL = 3600  # Seconds before cached user details are looked up again
+USER_LOOKUP_BATCH_WINDOW = 0.25  # Seconds to gather logins into one Helix call (at most 100 per call)
+MYSTERY_COOLDOWN = 300  # Cooldown time in seconds between mysteries in a channel
+PHASE_DELAY = 10  # Seconds between the sections of a mystery
+GUESS_WINDOW = 60  # Seconds chat has to guess the murderer
+TIME_SCALE = 1.0  # Multiplies PHASE_DELAY and GUESS_WINDOW; the load tests shrink it so a whole mystery takes seconds
+CHANNEL_TIMINGS = {}  # Channel -> overrides of 'phase_delay', 'guess_window' and 'cooldown' in seconds
+GENERATION_WORKERS = 4  # Mysteries generated at once for channels whose pool ran dry
+MYSTERY_BACKENDS = [  # Models that can write mysteries; 'url' and 'api_key' default to OPENAI_API_URL and OPENAI_API_KEY
+    {'name': 'gpt-4', 'model': 'gpt-4', 'max_tokens': 1500},
+    {'name': 'gpt-3.5-turbo', 'model': 'gpt-3.5-turbo', 'max_tokens': 1500},
+]
+GENERATION_HEDGE_DELAY = 20  # Seconds without a valid mystery (when streaming, its first section) before asking another backend
+GENERATION_MAX_ATTEMPTS = 2  # Requests sent for one mystery, counting hedged requests
+GENERATION_EXPLORE_RATE = 0.05  # Share of mysteries that try the backends in random order, so a slow one gets another chance
+GAME_JOURNAL_FILE = "game_journal.jsonl"  # Game events, so mysteries in progress survive a restart; None disables it
+GAME_JOURNAL_COMMIT_INTERVAL = 0.05  # Seconds of records gathered into one write and fsync
+GAME_JOURNAL_COMPACT_RECORDS = 20000  # Records after which the journal is folded into a snapshot
+LEADERBOARD_DB_FILE = "leaderboard.db"  # SQLite database of every viewer's correct and incorrect guesses; None disables it
+LEADERBOARD_FLUSH_INTERVAL = 1.0  # Seconds of results gathered into one database transaction
+LEADERBOARD_TOP_K = 5  # Viewers listed by !top
+METRIC_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # Seconds
+METRIC_PHASE_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600)  # Seconds
+SUSPECT_MATCH_MAX_EDITS = 1  # Typos tolerated when matching a guess to a suspect; 0 disables fuzzy matching
+GUESS_TALLY_CAPACITY = 256  # Distinct guesses counted per game; more only happen when the suspects could not be parsed
+LEADER_UPDATE_INTERVAL = 20  # Seconds between "current leader" posts while chat is guessing; 0 disables them
+TRACE_FILE = "mystery_traces.jsonl"  # Timed spans of every mystery, one JSON object per line; None disables tracing
+TRACE_FLUSH_INTERVAL = 1.0  # Seconds of spans gathered into one write
+ADMIN_TOKEN = None  # Bearer token for the admin endpoints such as /debug/profile; None disables them
+PROFILE_INTERVAL = 0.01  # Seconds between stack samples while profiling
+PROFILE_MAX_SECONDS = 60  # Longest profile /debug/profile runs
+MYSTERY_SECTIONS = ['Backstory', 'The Murder', 'Suspects', 'Clue Phase', 'Murderer', 'The Reveal']
 
 # Global variables
-ACCESS_TOKEN = None
-TOKEN_EXPIRY = None
-IRC_SOCKET = None
-game_state = None
-suspect_count = {}
-murderer_name = ''  # Store the murderer's name for comparison
-cooldown = 300  # Cooldown time in seconds between mysteries
-last_mystery_time = 0  # Timestamp of the last mystery
-app = Flask(__name__)
-
-# Function to get the app access token using OAuth Client Credentials Flow
-def get_app_access_token():
-    global ACCESS_TOKEN, TOKEN_EXPIRY
-    url = 'https://id.twitch.tv/oauth2/token'
-    params = {
-        'client_id': TWITCH_CLIENT_ID,
-        'client_secret': TWITCH_CLIENT_SECRET,
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post(url, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        ACCESS_TOKEN = data['access_token']
-        expires_in = data['expires_in']
-        TOKEN_EXPIRY = time.time() + expires_in
+GAMES = {}  # Channel name -> Game
+GAMES_BY_BROADCASTER = {}  # Broadcaster user ID -> Game, for routing EventSub notifications
+ASYNC_TASKS = set()  # Strong references to background tasks of the asyncio engine
+METRICS = []  # Every metric, in the order /metrics lists them
+
+# Class implementing a Prometheus counter; each combination of label values is counted separately
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values = {}  # Tuple of label values -> value
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    # Function to list (suffix, labels, value) for the exposition format
+    def samples(self):
+        with self.lock:
+            return [('', labels, value) for labels, value in self.values.items()]
+
+# Class implementing a Prometheus gauge; a function gauge is read when /metrics is scraped
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.function = function
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.function is not None:
+            return [('', (), self.function())]
+        return super().samples()
+
+# Class implementing a Prometheus histogram with fixed buckets
+class Histogram(Counter):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=METRIC_LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # Bucket counts, sum, count
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    # Context manager that observes how long its block took
+    @contextlib.contextmanager
+    def time(self, labels=()):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', labels + (('le', str(bound)),), cumulative))
+                samples.append(('_sum', labels, total))
+                samples.append(('_count', labels, count))
+        return samples
+
+# Function to write every metric in the Prometheus text exposition format
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+        for suffix, labels, value in metric.samples():
+            # Bucket samples carry their "le" label as a (name, value) pair after the metric's own label values
+            pairs = [pair if isinstance(pair, tuple) else (name, pair) for name, pair in zip(metric.labelnames + ('le',), labels)]
+            label_text = ",".join(f'{name}="{escape_label_value(label)}"' for name, label in pairs)
+            lines.append(f"{metric.name}{suffix}{{{label_text}}} {value}" if label_text else f"{metric.name}{suffix} {value}")
+    return "\n".join(lines) + "\n"
+
+# Function to escape a label value for the exposition format
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+HTTP_REQUEST_SECONDS = Histogram('mystery_http_request_seconds', "Time spent on each HTTP request, including failed attempts", ('endpoint',))
+TOKEN_REFRESHES = Counter('mystery_token_refreshes_total', "App access token requests, by why the token was refreshed", ('reason',))
+HTTP_REQUEST_ERRORS = Counter('mystery_http_request_errors_total', "HTTP attempts that failed or returned an error status", ('endpoint',))
+OPENAI_GENERATION_SECONDS = Histogram('mystery_openai_generation_seconds', "Time to generate a whole mystery", ('mode',))
+OPENAI_TOKENS = Counter('mystery_openai_tokens_total', "Tokens used by mystery generations", ('kind',))
+GENERATION_ATTEMPTS = Counter('mystery_generation_attempts_total', "Mystery generation requests by backend and outcome", ('backend', 'outcome'))
+IRC_RECONNECTS = Counter('mystery_irc_reconnects_total', "IRC connections lost, by why", ('reason',))
+IRC_RECONNECT_SECONDS = Histogram('mystery_irc_reconnect_seconds', "Time from losing the IRC connection to being connected again")
+CHAT_LINES = Counter('mystery_chat_lines_total', "Chat lines received from Twitch IRC")
+RECEIVE_LAG_SECONDS = Histogram('mystery_receive_lag_seconds', "Delay between Twitch sending a chat line (tmi-sent-ts) and the bot processing it")
+GUESSES = Counter('mystery_guesses_total', "Guesses tallied for a suspect")
+CHAT_MESSAGES_SAVED = Counter('mystery_chat_messages_saved_total', "Chat messages saved by packing sentences, compared with a message per line")
+OUTBOUND_QUEUE_SECONDS = Histogram('mystery_outbound_queue_seconds', "Time a chat line waited in the outbound queue", ('priority',))
+WEBHOOK_SECONDS = Histogram('mystery_webhook_seconds', "Time spent handling an EventSub webhook request")
+GAME_PHASE_SECONDS = Histogram('mystery_game_phase_seconds', "Time a game spent in each phase", ('phase',), METRIC_PHASE_BUCKETS)
+JOURNAL_RECORDS = Counter('mystery_journal_records_total', "Game events written to the game journal")
+JOURNAL_COMMIT_SECONDS = Histogram('mystery_journal_commit_seconds', "Time to write and fsync one batch of game journal records")
+STARTUP_SECONDS = Gauge('mystery_startup_seconds', "Seconds after startup began that each startup phase finished", ('phase',))
+LEADERBOARD_FLUSH_SECONDS = Histogram('mystery_leaderboard_flush_seconds', "Time to write one batch of viewer results to the leaderboard database")
+
+# Class for the things a writer thread saves in batches: whatever is queued while the thread waits interval seconds
+# after the first record is saved at once. Subclasses add records to pending while holding condition, notify it,
+# and save each batch in write_batch().
+class BatchWriter(abc.ABC):
+    idle_timeout = None  # Seconds the writer thread waits for records before calling between_batches() again
+
+    def __init__(self, interval, pending):
+        self.interval = interval
+        self.pending = pending  # Records waiting for the next batch; an empty list or dict to begin with
+        lock = threading.Lock()
+        self.condition = threading.Condition(lock)  # Notified when records are queued
+        self.written = threading.Condition(lock)  # Notified when a batch has been saved
+        self.writing = False  # Whether a batch was taken from pending and is not saved yet
+        self.thread = None
+
+    # Function to start the writer thread
+    def start_writer(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Function to wait until everything queued so far has been saved; only call it once the writer has started
+    def wait_written(self):
+        with self.condition:
+            while self.pending or self.writing:
+                self.written.wait()
+
+    # Function called by the writer thread before it waits for each batch
+    def between_batches(self):
+        pass
+
+    # Function to save one batch; run by the writer thread
+    @abc.abstractmethod
+    def write_batch(self, batch):
+        pass
+
+    # Function run by the writer thread
+    def run(self):
+        while True:
+            self.between_batches()
+            with self.condition:
+                if not self.pending:
+                    self.condition.wait(self.idle_timeout)
+                if not self.pending:
+                    continue
+                self.writing = True
+            time.sleep(self.interval)  # Let the records that arrive meanwhile share the batch
+            with self.condition:
+                batch, self.pending = self.pending, type(self.pending)()
+            try:
+                self.write_batch(batch)
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.written.notify_all()
+
+# A timed step of a mystery, such as generating it or sending a chat line; end() hands it to the tracer. Used in a
+# with statement, the span times the block and notes the exception that ended it, if any.
+class Span:
+    __slots__ = ('tracer', 'name', 'trace_id', 'attributes', 'start', 'started', 'ended')
+
+    def __init__(self, tracer, name, trace_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.ended = False
+
+    # Function to end the span, adding attributes known only at the end; ending it again does nothing
+    def end(self, **attributes):
+        if self.ended:
+            return
+        self.ended = True
+        self.attributes.update(attributes)
+        self.tracer.record(self.name, self.trace_id, self.start, time.perf_counter() - self.started, **self.attributes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is not None:
+            self.attributes['error'] = error_type.__name__
+        self.end()
+
+# Class that writes the spans of every mystery to a JSONL file, each with its mystery's ID, so one game can be
+# followed from generation to reveal. Spans are written in batches by a writer thread; until start() is called,
+# and when there is no trace file, they are dropped.
+class Tracer(BatchWriter):
+    def __init__(self, trace_file, flush_interval):
+        super().__init__(flush_interval, [])  # Encoded spans
+        self.trace_file = trace_file
+        self.file = None
+
+    # Function to start a span; end it with its end() method, or use it in a with statement
+    def span(self, name, trace_id, **attributes):
+        return Span(self, name, trace_id, attributes)
+
+    # Function to queue a finished span, given its start as a timestamp and its length in seconds
+    def record(self, name, trace_id, start, seconds, **attributes):
+        if self.file is None:
+            return
+        fields = {'mystery': trace_id, 'span': name, 'start': round(start, 6), 'seconds': round(seconds, 6),
+                  'thread': threading.current_thread().name}
+        fields.update(attributes)
+        line = json.dumps(fields) + '\n'
+        with self.condition:
+            self.pending.append(line)
+            if len(self.pending) == 1:
+                self.condition.notify()
+
+    # Function to open the trace file and start the writer thread
+    def start(self):
+        if self.thread is None and self.trace_file:
+            self.file = open(self.trace_file, 'a', encoding='utf-8')
+            self.start_writer()
+
+    # Function to write a batch of spans; run by the writer thread
+    def write_batch(self, batch):
+        try:
+            self.file.write(''.join(batch))
+            self.file.flush()
+        except OSError as e:
+            print(f"Error writing the trace file: {e}")
+
+TRACER = Tracer(TRACE_FILE, TRACE_FLUSH_INTERVAL)
+
+# Class that samples the stack of every thread with sys._current_frames() for /debug/profile. Sampling only runs
+# while a profile is requested, one at a time, so it costs nothing the rest of the time.
+class StackSampler:
+    def __init__(self, interval, max_seconds):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.lock = threading.Lock()
+
+    # Function to sample for the given seconds on the calling thread; returns the number of samples and the
+    # samples per collapsed stack, or None while another profile is running. A sample only walks the frames,
+    # names are looked up once at the end.
+    def profile(self, seconds):
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            stacks = collections.Counter()  # (thread ident, code objects from innermost out) -> samples
+            samples = 0
+            own_thread = threading.get_ident()
+            deadline = time.monotonic() + min(seconds, self.max_seconds)
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_thread:
+                        continue
+                    codes = []
+                    while frame is not None:
+                        codes.append(frame.f_code)
+                        frame = frame.f_back
+                    stacks[ident, tuple(codes)] += 1
+                samples += 1
+                time.sleep(self.interval)
+        finally:
+            self.lock.release()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        collapsed = collections.Counter()
+        for (ident, codes), count in stacks.items():
+            collapsed[self.collapse(names.get(ident, str(ident)), codes)] += count
+        return samples, collapsed
+
+    # Function to write a stack in the collapsed format flame graph tools read: thread;outermost;...;innermost
+    @staticmethod
+    def collapse(thread_name, codes):
+        functions = [f"{code.co_name} ({os.path.basename(code.co_filename)})" for code in reversed(codes)]
+        return ';'.join([thread_name] + functions)
+
+PROFILER = StackSampler(PROFILE_INTERVAL, PROFILE_MAX_SECONDS)
+
+# Class that sends all HTTP requests over pooled keep-alive connections with timeouts and retries. requests is
+# imported on the first request, which at startup is the app token fetch running alongside everything else.
+class HttpClient:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout, max_retries, pool_size):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.sessions = {}  # host -> requests.Session
+        self.lock = threading.Lock()
+
+    # Function to get the session holding the connection pool for a URL's host
+    def session(self, url):
+        import requests.adapters
+        host = urlparse(url).netloc
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[host] = session
+        return session
+
+    # Function to record how long a call to an endpoint took
+    def record(self, endpoint, elapsed, failed):
+        HTTP_REQUEST_SECONDS.observe(elapsed, (endpoint,))
+        if failed:
+            HTTP_REQUEST_ERRORS.inc(labels=(endpoint,))
+
+    # Function to work out how long to wait before retrying
+    def retry_delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            reset = response.headers.get('Ratelimit-Reset')
+            try:
+                if retry_after is not None:
+                    return min(float(retry_after), HTTP_MAX_RETRY_WAIT)
+                if reset is not None:
+                    return min(max(0.0, float(reset) - time.time()), HTTP_MAX_RETRY_WAIT)
+            except ValueError:
+                pass
+        # Full jitter keeps clients that failed together from retrying together
+        return random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** attempt)
+
+    # Function to send a request, retrying connection errors, 429 and 5xx responses
+    def request(self, method, url, endpoint=None, timeout=None, **kwargs):
+        import requests
+        endpoint = endpoint or f"{method} {urlparse(url).netloc}{urlparse(url).path}"
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            try:
+                response = self.session(url).request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.record(endpoint, time.monotonic() - start, True)
+                # A read timeout may mean the server already acted on the request, so don't repeat it
+                if attempt == self.max_retries or isinstance(e, requests.ReadTimeout):
+                    raise
+                delay = self.retry_delay(attempt)
+            else:
+                self.record(endpoint, time.monotonic() - start, response.status_code >= 400)
+                if response.status_code not in self.RETRY_STATUSES or attempt == self.max_retries:
+                    return response
+                delay = self.retry_delay(attempt, response)
+                response.close()
+            print(f"Retrying {endpoint} in {delay:.1f} seconds (attempt {attempt + 1} of {self.max_retries}).")
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+HTTP = HttpClient(HTTP_TIMEOUT, HTTP_MAX_RETRIES, HTTP_POOL_SIZE)
+
+# Class that owns the app access token. It is replaced in the background before it expires, and concurrent
+# refreshes, including those after a 401, are collapsed into one call to Twitch, so callers only wait for a
+# token when there is none yet or it expired.
+class AppTokenManager:
+    def __init__(self, refresh_margin, retry_delay):
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+        self.token = None
+        self.expiry = 0  # Timestamp the token stops working
+        self.refreshing = None  # Future of the refresh in flight
+        self.refresh_event = None  # Scheduled background refresh
+        self.lock = threading.Lock()
+
+    # Function to get a working token
+    def get(self):
+        with self.lock:
+            if self.token is not None and time.time() < self.expiry:
+                return self.token
+        return self.refresh('expired').result()
+
+    # Function to use a token for the given number of seconds and schedule its replacement
+    def set(self, token, expires_in):
+        with self.lock:
+            self.token = token
+            self.expiry = time.time() + expires_in
+        self.schedule_refresh(expires_in * (1 - self.refresh_margin))
+
+    def schedule_refresh(self, delay):
+        with self.lock:
+            if self.refresh_event is not None:
+                self.refresh_event.cancel()
+            self.refresh_event = SCHEDULER.schedule(delay, self.refresh, 'scheduled')
+
+    # Function to start a refresh unless one is in flight; returns a future of the new token. Given the token
+    # Twitch rejected, it returns the current token instead if that one was already replaced.
+    def refresh(self, reason, rejected=None):
+        with self.lock:
+            if rejected is not None and self.token != rejected and time.time() < self.expiry:
+                future = concurrent.futures.Future()
+                future.set_result(self.token)
+                return future
+            if self.refreshing is None:
+                self.refreshing = concurrent.futures.Future()
+                TOKEN_REFRESHES.inc(labels=(reason,))
+                threading.Thread(target=self.fetch, args=(self.refreshing,), daemon=True).start()
+            return self.refreshing
+
+    # Function run on a thread of its own to get a new token using OAuth Client Credentials Flow
+    def fetch(self, future):
+        params = {
+            'client_id': TWITCH_CLIENT_ID,
+            'client_secret': TWITCH_CLIENT_SECRET,
+            'grant_type': 'client_credentials'
+        }
+        try:
+            response = HTTP.post(TWITCH_AUTH_URL, params=params)
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to obtain app access token: {response.text}")
+            data = response.json()
+            token = data['access_token']
+            expires_in = data['expires_in']
+        except Exception as e:
+            print(f"{e}; retrying in {self.retry_delay} seconds.")
+            with self.lock:
+                self.refreshing = None
+            self.schedule_refresh(self.retry_delay)  # Keep using the current token, if any, meanwhile
+            future.set_exception(e)
+            return
+        self.set(token, expires_in)
+        with self.lock:
+            self.refreshing = None
         print("Successfully obtained app access token.")
-    else:
-        print(f"Failed to obtain app access token: {response.text}")
-
-# Function to refresh the access token if expired
-def refresh_access_token_if_needed():
-    if ACCESS_TOKEN is None or time.time() > TOKEN_EXPIRY:
-        get_app_access_token()
-
-# Function to send a message to Twitch chat
-def send_message(sock, message):
-    max_length = 490  # Twitch's limit is 500; we use 490 to be safe.
-    lines = message.split('\n')
-    for line in lines:
-        line = line.strip()
-        if line:
-            while len(line) > 0:
-                if len(line) <= max_length:
-                    send_line = line
-                    line = ''
-                else:
-                    # Find the last space before max_length to avoid splitting words
-                    split_index = line.rfind(' ', 0, max_length)
-                    if split_index == -1:
-                        split_index = max_length
-                    send_line = line[:split_index]
-                    line = line[split_index:].lstrip()
-                print(f"Sending message to chat: {send_line}")
-                sock.send(f"PRIVMSG #{TWITCH_CHANNEL} :{send_line}\r\n".encode('utf-8'))
-                time.sleep(2)  # Delay to avoid rate limits
-
-# Function to connect to Twitch IRC
+        future.set_result(token)
+
+APP_TOKEN = AppTokenManager(TOKEN_REFRESH_MARGIN, TOKEN_RETRY_DELAY)
+
+# Function to call the Twitch API. With the app token, a 401 refreshes the token once and replays the request;
+# a token passed in, such as a user token, is used as it is.
+def helix_request(method, url, access_token=None, **kwargs):
+    headers = dict(kwargs.pop('headers', {}), **{'Client-ID': TWITCH_CLIENT_ID})
+    token = access_token or APP_TOKEN.get()
+    while True:
+        headers['Authorization'] = f'Bearer {token}'
+        response = HTTP.request(method, url, headers=headers, **kwargs)
+        if response.status_code != 401 or access_token is not None:
+            return response
+        print("Twitch rejected the app access token; refreshing it.")
+        replacement = APP_TOKEN.refresh('rejected', token).result()
+        if replacement == token:
+            return response
+        token, access_token = replacement, replacement  # Replay once with the new token
+
+SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+|(?<=[.!?]["\')\u201d\u2019])\s+')
+
+# A message laid out for chat: the text of each chat message, the same encoded as UTF-8, and the number
+# of chat messages the text would have taken with one per line
+PackedMessage = collections.namedtuple('PackedMessage', ['lines', 'encoded', 'unpacked'])
+
+# Function to lay a message out in as few chat messages as possible. Sentences are packed across line breaks
+# into messages of at most MESSAGE_MAX_BYTES, so a message only ends mid-sentence when the sentence is longer
+# than a whole message. Lengths are measured in encoded bytes, and each line is encoded only once.
+def pack_message(message):
+    encoded = []
+    current = []  # Encoded sentences and words of the chat message being filled
+    size = 0
+    unpacked = 0
+
+    def flush():
+        nonlocal current, size
+        if current:
+            encoded.append(b' '.join(current))
+        current, size = [], 0
+
+    def add(piece):
+        nonlocal size
+        if current and size + 1 + len(piece) <= MESSAGE_MAX_BYTES:
+            current.append(piece)
+            size += 1 + len(piece)
+        else:
+            flush()
+            current.append(piece)
+            size = len(piece)
+
+    for paragraph in message.split('\n'):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        paragraph_size = -1
+        for sentence in SENTENCE_BREAK.split(paragraph):
+            piece = sentence.encode('utf-8')
+            paragraph_size += 1 + len(piece)
+            if len(piece) <= MESSAGE_MAX_BYTES:
+                add(piece)
+                continue
+            # Too long for any message: fill messages word by word (a space byte is never inside a UTF-8 character)
+            for word in piece.split(b' '):
+                while len(word) > MESSAGE_MAX_BYTES:
+                    cut = MESSAGE_MAX_BYTES
+                    while word[cut] & 0xC0 == 0x80:  # Don't cut through a multi-byte character
+                        cut -= 1
+                    flush()
+                    encoded.append(word[:cut])
+                    word = word[cut:]
+                if word:
+                    add(word)
+        unpacked += -(-paragraph_size // MESSAGE_MAX_BYTES)
+    flush()
+    return PackedMessage([line.decode('utf-8') for line in encoded], encoded, unpacked)
+
+# Class implementing a token bucket that paces outbound chat messages
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # Function to return how long to wait until a token is available
+    def delay(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    # Function to take a token after delay() returned 0
+    def consume(self):
+        self.tokens -= 1
+
+# Class that sends all outbound chat through one writer thread, highest priority first
+class OutboundScheduler:
+    def __init__(self):
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.bucket = None
+
+    # Function to queue a message, given as text or packed, and return a future that resolves once its last line is sent
+    def submit(self, sock, message, priority=PRIORITY_NARRATIVE, channel=TWITCH_CHANNEL, trace_id=None):
+        future = concurrent.futures.Future()
+        packed = message if isinstance(message, PackedMessage) else pack_message(message)
+        lines = packed.lines
+        if not lines:
+            future.set_result(0)
+            return future
+        CHAT_MESSAGES_SAVED.inc(packed.unpacked - len(lines))
+        prefix = f"PRIVMSG #{channel} :".encode('utf-8')
+        sequence = next(self.sequence)
+        for index, (send_line, encoded) in enumerate(zip(lines, packed.encoded)):
+            payload = prefix + encoded + b"\r\n"
+            done = future if index == len(lines) - 1 else None
+            self.queue.put((priority, sequence, index, sock, send_line, payload, done, time.monotonic(), channel, trace_id))
+        self.start()
+        return future
+
+    # Function to start the writer thread on first use
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                # A bucket of capacity C refilling at r tokens/s can send at most C + 30 * r
+                # messages in any 30 second window, so split the limit between the two.
+                limit = TWITCH_CHAT_RATE_LIMITS[TWITCH_CHAT_RATE_TIER]
+                capacity = max(1, int(limit * TWITCH_CHAT_BURST_FRACTION))
+                self.bucket = TokenBucket((limit - capacity) / 30, capacity)
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    # Function run by the writer thread
+    def run(self):
+        while True:
+            item = self.queue.get()
+            delay = self.bucket.delay()
+            if delay > 0:
+                # Put the line back so anything more urgent that arrives meanwhile goes first
+                self.queue.put(item)
+                time.sleep(delay)
+                continue
+            self.bucket.consume()
+            priority, sequence, index, sock, send_line, payload, done, queued, channel, trace_id = item
+            waited = time.monotonic() - queued
+            OUTBOUND_QUEUE_SECONDS.observe(waited, (priority,))
+            print(f"Sending message to chat: {send_line}")
+            try:
+                sock.send(payload)
+            except OSError as e:
+                print(f"Error sending message: {e}")
+                if done is not None:
+                    done.set_exception(e)
+                continue
+            # The span starts when the line was queued, so it includes the wait for the rate limit
+            seconds = time.monotonic() - queued
+            TRACER.record('send', trace_id, time.time() - seconds, seconds, channel=channel, priority=priority,
+                          line=index, bytes=len(payload), waited=round(waited, 6))
+            if done is not None:
+                done.set_result(index + 1)
+
+OUTBOUND = OutboundScheduler()
+OUTBOUND_QUEUE_DEPTH = Gauge('mystery_outbound_queue_depth', "Chat lines waiting to be sent", function=lambda: OUTBOUND.queue.qsize())
+
+# Function to send a message to Twitch chat; returns a future instead of blocking the caller
+def send_message(sock, message, priority=PRIORITY_NARRATIVE, channel=TWITCH_CHANNEL, trace_id=None):
+    return OUTBOUND.submit(sock, message, priority, channel, trace_id)
+
+# Class standing in for the IRC socket across reconnects. While the bot is disconnected, send() waits for the
+# next connection, so the outbound writer keeps its queued lines and sends them once the bot is back. Chat lines
+# sent into a connection that was then lost may never have arrived, so they are sent again: a line can reach
+# chat twice, but it is not lost.
+class IRCConnection:
+    def __init__(self, replay_lines):
+        self.sock = None
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        self.lost_at = None  # Monotonic time the connection was lost, while reconnecting
+        self.unconfirmed = collections.deque(maxlen=replay_lines)  # Chat lines sent since Twitch last sent anything
+        self.replay = []  # Chat lines to send again on the next connection
+
+    # Function to start using a new connection
+    def attach(self, sock):
+        with self.lock:
+            for payload in self.replay:
+                sock.send(payload)
+            if self.replay:
+                print(f"Resent {len(self.replay)} chat lines that may have been lost.")
+            self.replay = []
+            self.sock = sock
+            if self.lost_at is not None:
+                IRC_RECONNECT_SECONDS.observe(time.monotonic() - self.lost_at)
+                self.lost_at = None
+            self.connected.set()
+
+    # Function called whenever Twitch sends something, which shows the connection is alive
+    def received(self):
+        if self.unconfirmed:
+            self.unconfirmed.clear()
+
+    # Function to stop using a connection that failed; a connection already replaced is left alone
+    def detach(self, sock, reason):
+        with self.lock:
+            if self.sock is not sock or not self.connected.is_set():
+                return False
+            self.connected.clear()
+            self.lost_at = time.monotonic()
+            if reason not in ('reconnect', 'auth'):  # Those come over a working connection, so earlier lines arrived
+                self.replay = list(self.unconfirmed)
+            self.unconfirmed.clear()
+        IRC_RECONNECTS.inc(labels=(reason,))
+        with contextlib.suppress(OSError):
+            sock.shutdown(socket.SHUT_RDWR)  # Wakes the reader if it is still waiting on this connection
+        return True
+
+    def send(self, data):
+        while True:
+            self.connected.wait()
+            sock = self.sock
+            try:
+                sent = sock.send(data)
+            except OSError as e:
+                print(f"Error sending to Twitch IRC: {e}; waiting for the reconnect.")
+                self.detach(sock, 'error')
+                continue
+            if data.startswith(b'PRIVMSG'):
+                with self.lock:
+                    self.unconfirmed.append(data)
+            return sent
+
+IRC_SOCKET = IRCConnection(IRC_REPLAY_LINES)
+
+# Function to connect to Twitch IRC; channels are (re-)joined in the background
 def connect_to_twitch():
-    global IRC_SOCKET
-    refresh_access_token_if_needed()
-    IRC_SOCKET = socket.socket()
-    IRC_SOCKET.connect((TWITCH_IRC_SERVER, TWITCH_IRC_PORT))
-    IRC_SOCKET.send(f"PASS oauth:{ACCESS_TOKEN}\r\n".encode('utf-8'))
-    IRC_SOCKET.send(f"NICK {TWITCH_BOT_USERNAME}\r\n".encode('utf-8'))
-    IRC_SOCKET.send(f"JOIN #{TWITCH_CHANNEL}\r\n".encode('utf-8'))
+    access_token = APP_TOKEN.get()
+    sock = socket.create_connection((TWITCH_IRC_SERVER, TWITCH_IRC_PORT), timeout=HTTP_TIMEOUT[0])
+    sock.settimeout(IRC_PING_INTERVAL)
+    sock.sendall("CAP REQ :twitch.tv/tags\r\n".encode('utf-8'))
+    sock.sendall(f"PASS oauth:{access_token}\r\n".encode('utf-8'))
+    sock.sendall(f"NICK {TWITCH_BOT_USERNAME}\r\n".encode('utf-8'))
+    IRC_SOCKET.attach(sock)
+    threading.Thread(target=join_channels, args=(IRC_SOCKET, list(GAMES)), daemon=True).start()
     print("Connected to Twitch IRC successfully.")
 
-# Function to fetch a mystery from ChatGPT
-def fetch_mystery_from_chatgpt():
+# Function to get how long to wait before reconnect attempt number attempt (from 0), with full jitter
+def reconnect_delay(attempt):
+    return random.uniform(0, min(IRC_RECONNECT_MAX_WAIT, IRC_RECONNECT_BACKOFF * 2 ** attempt))
+
+# Function to decide what a line from the server means for the connection: None to carry on, a reply to
+# send back for PING, or the reason to reconnect
+def check_connection_line(line, access_token):
+    if line.startswith('PING'):
+        return 'PONG' + line[4:]  # Echo the server name, e.g. "PONG :tmi.twitch.tv"
+    if line.startswith(':tmi.twitch.tv RECONNECT'):
+        return 'reconnect'
+    if line.startswith(':tmi.twitch.tv NOTICE * :Login authentication failed'):
+        APP_TOKEN.refresh('rejected', access_token)
+        return 'auth'
+    return None
+
+# Function to join channels in batches, staying under Twitch's join rate limit
+def join_channels(sock, channels):
+    max_line = 500  # IRC lines are limited to 512 bytes including the command
+    batch = []
+    for index, channel in enumerate(channels):
+        batch.append(f"#{channel}")
+        full = len(batch) >= TWITCH_JOIN_RATE_LIMIT or len(','.join(batch)) + len(channel) + 7 > max_line
+        if full or index == len(channels) - 1:
+            sock.send(f"JOIN {','.join(batch)}\r\n".encode('utf-8'))
+            print(f"Joined {len(batch)} channels.")
+            batch = []
+            if index < len(channels) - 1:
+                time.sleep(10)  # Each batch uses the whole 10 second join allowance
+
+# Function to leave channels
+def part_channels(sock, channels):
+    for start in range(0, len(channels), 20):
+        sock.send(f"PART {','.join('#' + channel for channel in channels[start:start + 20])}\r\n".encode('utf-8'))
+
+# Function to build the ChatGPT request for a new mystery
+def build_mystery_request(backend):
     headers = {
         'Content-Type': 'application/json',
-        'Authorization': f'Bearer {OPENAI_API_KEY}'
+        'Authorization': f"Bearer {backend.get('api_key') or OPENAI_API_KEY}"
     }
     data = {
-        "model": "gpt-4",  # Use 'gpt-4' or 'gpt-3.5-turbo' depending on availability
+        "model": backend['model'],
+        "max_tokens": backend['max_tokens'],
         "messages": [
             {
                 "role": "system",
@@ -117,29 +871,142 @@ def fetch_mystery_from_chatgpt():
             }
         ]
     }
+    return headers, data
 
+# Function to fetch a mystery from ChatGPT; attempt, when given, can cancel the request
+def fetch_mystery_from_chatgpt(backend=None, attempt=None):
+    backend = backend or MYSTERY_BACKENDS[0]
+    headers, data = build_mystery_request(backend)
     try:
-        print("Sending request to ChatGPT API...")
-        response = requests.post(
-            'https://api.openai.com/v1/chat/completions',
+        print(f"Sending request to ChatGPT API ({backend['name']})...")
+        start = time.monotonic()
+        response = HTTP.post(
+            backend.get('url') or OPENAI_API_URL,
             headers=headers,
-            json=data
+            json=data,
+            stream=True,  # Return once the headers arrive so the request can be cancelled while the body is read
+            timeout=OPENAI_TIMEOUT
         )
+        if attempt is not None and not attempt.track(response):
+            return None
         if response.status_code == 200:
             mystery_response = response.json()
             print("Received response from ChatGPT.")
+            OPENAI_GENERATION_SECONDS.observe(time.monotonic() - start, ('blocking',))
+            usage = mystery_response.get('usage', {})
+            OPENAI_TOKENS.inc(usage.get('prompt_tokens', 0), ('prompt',))
+            OPENAI_TOKENS.inc(usage.get('completion_tokens', 0), ('completion',))
             mystery_text = mystery_response['choices'][0]['message']['content']
-            return parse_mystery_response(mystery_text)
+            return parse_mystery_response(mystery_text, attempt.trace_id if attempt is not None else None)
         else:
             print(f"Error fetching mystery: {response.status_code}")
             print(f"Response text: {response.text}")
             return None
     except Exception as e:
-        print(f"Exception during API call to ChatGPT: {e}")
+        if attempt is None or not attempt.cancelled:
+            print(f"Exception during API call to ChatGPT: {e}")
+        return None
+
+# Function to fetch a mystery from ChatGPT as a stream, calling on_section(label, text) as each section completes
+def stream_mystery_from_chatgpt(on_section, backend=None, attempt=None):
+    backend = backend or MYSTERY_BACKENDS[0]
+    headers, data = build_mystery_request(backend)
+    data['stream'] = True
+    sections = {}
+
+    def collect(label, text):
+        sections[label] = text
+        on_section(label, text)
+
+    parser = MysterySectionParser(collect)
+    try:
+        print(f"Sending streaming request to ChatGPT API ({backend['name']})...")
+        start = time.monotonic()
+        response = HTTP.post(backend.get('url') or OPENAI_API_URL, headers=headers, json=data, stream=True, timeout=OPENAI_TIMEOUT)
+        if attempt is not None and not attempt.track(response):
+            return None
+        if response.status_code != 200:
+            print(f"Error fetching mystery: {response.status_code}")
+            print(f"Response text: {response.text}")
+            return None
+        response.encoding = 'utf-8'  # Server-sent events are always UTF-8
+        tokens = 0
+        for event_line in response.iter_lines(decode_unicode=True):
+            if attempt is not None and attempt.cancelled:
+                return None
+            if not event_line or not event_line.startswith('data:'):
+                continue
+            payload = event_line[5:].strip()
+            if payload == '[DONE]':
+                break
+            choices = json.loads(payload).get('choices') or [{}]
+            content = choices[0].get('delta', {}).get('content')
+            if content:
+                tokens += 1  # Each streamed delta carries one token
+                parser.feed(content)
+        parser.close()
+        print("Received streamed response from ChatGPT.")
+        OPENAI_GENERATION_SECONDS.observe(time.monotonic() - start, ('stream',))
+        OPENAI_TOKENS.inc(tokens, ('completion',))
+    except Exception as e:
+        if attempt is None or not attempt.cancelled:
+            print(f"Exception during streaming API call to ChatGPT: {e}")
         return None
+    if len(sections) < len(MYSTERY_SECTIONS):
+        print("Error: Mystery response does not match the expected format.")
+    return tuple(sections.get(label, '') for label in MYSTERY_SECTIONS)
+
+# Class that splits streamed mystery text into labelled sections as soon as each one is complete
+class MysterySectionParser:
+    LABEL_PATTERNS = [re.compile(re.escape(label) + r':\s*', re.IGNORECASE) for label in MYSTERY_SECTIONS]
+    LONGEST_LABEL = max(len(label) for label in MYSTERY_SECTIONS) + 1
 
-# Function to parse the mystery response
-def parse_mystery_response(mystery_text):
+    def __init__(self, on_section):
+        self.on_section = on_section
+        self.buffer = ''
+        self.index = -1  # Section being read; -1 until the first label arrives
+        self.start = 0  # Where the current section's text starts in the buffer
+        self.scanned = 0  # Everything before this offset is known not to hold the next label
+
+    # Function to add streamed text; a section is emitted once the label after it has arrived
+    def feed(self, text):
+        self.buffer += text
+        while self.index + 1 < len(MYSTERY_SECTIONS):
+            search_from = max(self.start, self.scanned - self.LONGEST_LABEL)
+            match = self.LABEL_PATTERNS[self.index + 1].search(self.buffer, search_from)
+            if not match:
+                self.scanned = len(self.buffer)
+                break
+            if match.end() == len(self.buffer):
+                # Wait for text after the label so the whitespace after the colon is complete
+                self.scanned = match.start() + self.LONGEST_LABEL
+                break
+            if self.index >= 0:
+                self.on_section(MYSTERY_SECTIONS[self.index], self.buffer[self.start:match.start()].strip())
+            self.index += 1
+            self.start = match.end()
+            self.scanned = self.start
+
+    # Function to emit the last section once the stream has ended
+    def close(self):
+        self.feed('')
+        match = self.LABEL_PATTERNS[self.index + 1].search(self.buffer, self.start) if self.index + 1 < len(MYSTERY_SECTIONS) else None
+        if match:
+            # The stream ended right after a label
+            if self.index >= 0:
+                self.on_section(MYSTERY_SECTIONS[self.index], self.buffer[self.start:match.start()].strip())
+            self.index += 1
+            self.start = match.end()
+        if self.index >= 0:
+            self.on_section(MYSTERY_SECTIONS[self.index], self.buffer[self.start:].strip())
+
+# Function to parse the mystery response; trace_id, when given, is the mystery whose trace times the parse
+def parse_mystery_response(mystery_text, trace_id=None):
+    with TRACER.span('parse', trace_id, characters=len(mystery_text)):
+        return parse_mystery_sections(mystery_text)
+
+# Function to split the mystery text into its sections
+def parse_mystery_sections(mystery_text):
     try:
         print("Parsing mystery response.")
         pattern = r"Backstory:\s*(.*?)\s*The Murder:\s*(.*?)\s*Suspects:\s*(.*?)\s*Clue Phase:\s*(.*?)\s*Murderer:\s*(.*?)\s*The Reveal:\s*(.*)"
@@ -159,199 +1026,1854 @@ def parse_mystery_response(mystery_text):
         print(f"Error parsing the mystery response: {e}")
         return "", "", "", "", "", ""
 
-# Function to receive messages from Twitch chat
+# Class keeping moving averages of how fast and how reliably a generation backend answers
+class BackendStats:
+    SMOOTHING = 0.2  # Weight of the newest observation
+
+    def __init__(self, latency):
+        self.latency = latency  # Seconds to a valid mystery, or to its first section when streaming
+        self.success_rate = 1.0  # Share of finished requests that gave a valid mystery
+        self.lock = threading.Lock()
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self.latency += self.SMOOTHING * (seconds - self.latency)
+
+    # Function to count a request cancelled after the given time, which would have taken at least that long
+    def record_slower(self, seconds):
+        with self.lock:
+            if seconds > self.latency:
+                self.latency += self.SMOOTHING * (seconds - self.latency)
+
+    def record_result(self, success):
+        with self.lock:
+            self.success_rate += self.SMOOTHING * ((1.0 if success else 0.0) - self.success_rate)
+
+    # Function to estimate the seconds to a valid mystery, counting the retries failures cost; lower is better
+    def score(self):
+        with self.lock:
+            return self.latency / max(self.success_rate, 0.05)
+
+BACKEND_STATS = {}  # Backend name -> BackendStats
+
+# Function to get the statistics of a backend
+def backend_stats(backend):
+    stats = BACKEND_STATS.get(backend['name'])
+    if stats is None:
+        stats = BACKEND_STATS.setdefault(backend['name'], BackendStats(GENERATION_HEDGE_DELAY))
+    return stats
+
+# Class for one generation request, which may race a hedged request and be cancelled
+class GenerationAttempt:
+    def __init__(self, backend, results, trace_id=None):
+        self.backend = backend
+        self.trace_id = trace_id  # Mystery this request generates, for its trace
+        self.results = results  # Queue told (attempt, 'section') on the first streamed section and (attempt, 'done') at the end
+        self.started = time.monotonic()
+        self.first_section = None  # Seconds to the first streamed section
+        self.finished = None  # Seconds to the end of the response
+        self.mystery = None
+        self.sections = {}
+        self.on_section = None  # Set once this request's streamed sections are the ones shown in chat
+        self.response = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    # Function run on a generation thread
+    def run(self, streaming):
+        with TRACER.span('generate', self.trace_id, backend=self.backend['name'], streaming=streaming) as span:
+            if streaming:
+                self.mystery = stream_mystery_from_chatgpt(self.add_section, self.backend, self)
+            else:
+                self.mystery = fetch_mystery_from_chatgpt(self.backend, self)
+            span.attributes.update(valid=self.valid(), cancelled=self.cancelled, first_section=self.first_section)
+        self.finished = time.monotonic() - self.started
+        self.results.put((self, 'done'))
+
+    # Function to check the response has every section of a mystery
+    def valid(self):
+        return bool(self.mystery) and all(self.mystery)
+
+    def add_section(self, label, text):
+        with self.lock:
+            self.sections[label] = text
+            first = self.first_section is None
+            if first:
+                self.first_section = time.monotonic() - self.started
+            on_section = self.on_section
+        if on_section is not None:
+            on_section(label, text)
+        if first:
+            self.results.put((self, 'section'))
+
+    # Function to pass this request's sections on, starting with those already streamed
+    def forward(self, on_section):
+        with self.lock:
+            self.on_section = on_section
+            sections = list(self.sections.items())
+        for label, text in sections:
+            on_section(label, text)
+
+    # Function to keep the response so cancel() can close it; returns False if already cancelled
+    def track(self, response):
+        with self.lock:
+            self.response = response
+            cancelled = self.cancelled
+        if cancelled:
+            response.close()
+        return not cancelled
+
+    # Function to stop the request; the thread running it returns None soon after
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            response = self.response
+        if response is not None:
+            response.close()
+
+GENERATION_ATTEMPT_EXECUTOR = concurrent.futures.ThreadPoolExecutor((GENERATION_WORKERS + 1) * GENERATION_MAX_ATTEMPTS)
+
+# Function to generate a mystery from the backend expected to be fastest, sending a hedged request to the next one
+# when no valid mystery (when streaming, no first section) arrived within GENERATION_HEDGE_DELAY or the request failed.
+# The first valid response wins and the others are cancelled. Streamed sections only go to on_section from the
+# request committed to: the one that validates, or the last one left once no other could replace it, so chat never
+# gets the start of a mystery that is then abandoned. With hedge=False, for callers nobody is waiting on, it only
+# fails over. trace_id is the mystery whose trace the requests are timed in.
+def generate_mystery(on_section=None, hedge=True, trace_id=None):
+    streaming = on_section is not None
+    hedge_delay = GENERATION_HEDGE_DELAY if hedge else None
+    backends = sorted(MYSTERY_BACKENDS, key=lambda backend: backend_stats(backend).score())
+    if random.random() < GENERATION_EXPLORE_RATE:
+        random.shuffle(backends)
+    results = queue.Queue()
+    attempts = []
+    streamed = False  # Whether any request has streamed a section, which stops the hedging
+    committed = None  # The request whose sections go to on_section
+    winner = None
+
+    running = set()  # Requests whose result hasn't been taken yet
+
+    def launch():
+        attempt = GenerationAttempt(backends[len(attempts) % len(backends)], results, trace_id)
+        attempts.append(attempt)
+        running.add(attempt)
+        GENERATION_ATTEMPT_EXECUTOR.submit(attempt.run, streaming)
+
+    launch()
+    hedge_at = time.monotonic() + hedge_delay if hedge_delay is not None else None
+    while running:
+        can_launch = len(attempts) < GENERATION_MAX_ATTEMPTS
+        if streaming and committed is None and len(running) == 1 and not can_launch:
+            # Nothing is left to fall back to, so the sections of the last request can go to chat as they stream
+            committed = next(iter(running))
+            committed.forward(on_section)
+        try:
+            can_hedge = can_launch and not streamed and hedge_at is not None
+            timeout = max(0, hedge_at - time.monotonic()) if can_hedge else None
+            attempt, kind = results.get(timeout=timeout)
+        except queue.Empty:
+            print(f"No mystery from {attempts[-1].backend['name']} yet, also asking {backends[len(attempts) % len(backends)]['name']}.")
+            launch()
+            hedge_at = time.monotonic() + hedge_delay
+            continue
+        if kind == 'section':
+            streamed = True  # The others keep going until a request validates, in case this one fails
+            continue
+        running.discard(attempt)
+        if attempt.valid():
+            winner = attempt
+            if streaming and committed is None:
+                attempt.forward(on_section)
+            break
+        if can_launch and not running:
+            # The only request failed, so ask the next backend now rather than at the deadline
+            launch()
+            hedge_at = time.monotonic() + hedge_delay if hedge_delay is not None else None
+
+    for attempt in attempts:
+        stats = backend_stats(attempt.backend)
+        if attempt is not winner and attempt.finished is None:
+            attempt.cancel()
+        if attempt.cancelled:
+            stats.record_slower(time.monotonic() - attempt.started)
+            outcome = 'cancelled'
+        elif attempt.valid():
+            stats.record_result(True)
+            stats.record_latency(attempt.first_section if streaming else attempt.finished)
+            outcome = 'valid'
+        else:
+            stats.record_result(False)
+            outcome = 'failed'
+        GENERATION_ATTEMPTS.inc(labels=(attempt.backend['name'], outcome))
+    return winner.mystery if winner is not None else None
+
+# Class that keeps parsed mysteries generated ahead of time and refills them in the background
+class MysteryPool:
+    def __init__(self, cache_file, size, max_age, repeat_window):
+        self.cache_file = cache_file
+        self.size = size
+        self.max_age = max_age
+        self.mysteries = collections.deque()  # (created, fingerprint, mystery) oldest first
+        self.recent = collections.deque(maxlen=repeat_window)  # Fingerprints of served mysteries
+        self.condition = threading.Condition()
+        self.dirty = False
+        self.thread = None
+
+    # Function to identify a mystery so repeats can be detected
+    @staticmethod
+    def fingerprint(mystery):
+        backstory, murder, suspects, clues, murderer, reveal = mystery
+        return hashlib.sha1(f"{murderer}|{backstory}".lower().encode('utf-8')).hexdigest()
+
+    # Function to load the pool saved by a previous run
+    def load(self):
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable mystery cache: {e}")
+            return
+        with self.condition:
+            self.recent.extend(data.get('recent', []))
+            for entry in data.get('mysteries', []):
+                mystery = tuple(entry['mystery'])
+                self.mysteries.append((entry['created'], self.fingerprint(mystery), mystery))
+            self.evict()
+        print(f"Loaded {len(self.mysteries)} cached mysteries.")
+
+    # Function to write the pool to disk atomically
+    def save(self):
+        with self.condition:
+            data = {
+                'mysteries': [{'created': created, 'mystery': list(mystery)} for created, _, mystery in self.mysteries],
+                'recent': list(self.recent),
+            }
+            self.dirty = False
+        temporary_file = f"{self.cache_file}.tmp"
+        try:
+            with open(temporary_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(temporary_file, self.cache_file)
+        except OSError as e:
+            print(f"Error saving mystery cache: {e}")
+
+    # Function to drop mysteries that are too old or over the size limit; call with the lock held
+    def evict(self):
+        cutoff = time.time() - self.max_age
+        while self.mysteries and (self.mysteries[0][0] < cutoff or len(self.mysteries) > self.size):
+            self.mysteries.popleft()
+            self.dirty = True
+
+    # Function to take a ready mystery, or None if the pool is empty
+    def take(self):
+        with self.condition:
+            self.evict()
+            if not self.mysteries:
+                return None
+            _, fingerprint, mystery = self.mysteries.popleft()
+            self.recent.append(fingerprint)
+            self.dirty = True
+            self.condition.notify()
+        return mystery
+
+    # Function to add a freshly generated mystery unless it repeats a recent one
+    def add(self, mystery):
+        fingerprint = self.fingerprint(mystery)
+        with self.condition:
+            if fingerprint in self.recent or any(fingerprint == entry[1] for entry in self.mysteries):
+                print("Discarding a repeated mystery.")
+                return False
+            self.mysteries.append((time.time(), fingerprint, mystery))
+            self.evict()
+            self.dirty = True
+        return True
+
+    # Function to start the background refill worker
+    def start(self):
+        if self.thread is None:
+            self.load()
+            self.thread = threading.Thread(target=self.refill, daemon=True)
+            self.thread.start()
+
+    # Function run by the worker to keep the pool full
+    def refill(self):
+        backoff = 30
+        while True:
+            with self.condition:
+                self.evict()
+                while len(self.mysteries) >= self.size and not self.dirty:
+                    self.condition.wait(timeout=3600)
+                    self.evict()
+                full = len(self.mysteries) >= self.size
+            if self.dirty:
+                self.save()
+            if full:
+                continue
+            # Nobody is waiting for the pool, so fail over to another backend but don't hedge on time
+            mystery = generate_mystery(hedge=False)
+            if mystery and all(mystery):
+                self.add(mystery)
+                self.save()
+                backoff = 30
+            else:
+                print(f"Mystery pool refill failed, retrying in {backoff} seconds.")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 600)
+
+MYSTERY_POOL = MysteryPool(MYSTERY_CACHE_FILE, MYSTERY_POOL_SIZE, MYSTERY_POOL_MAX_AGE, MYSTERY_REPEAT_WINDOW)
+
+# Class that lets a game read the sections of a mystery while it is still being generated
+class PendingMystery:
+    def __init__(self, mystery=None, trace_id=None):
+        self.trace_id = trace_id  # Mystery whose trace times the generation
+        self.sections = {}
+        self.finished = False
+        self.waiters = []  # (label, callback) waiting for a section
+        self.condition = threading.Condition()
+        if mystery is not None:
+            self.sections = dict(zip(MYSTERY_SECTIONS, mystery))
+            self.finished = True
+
+    # Function to record a section as soon as it has been generated
+    def add_section(self, label, text):
+        with self.condition:
+            self.sections[label] = text
+            self.condition.notify_all()
+        self.wake_waiters()
+
+    # Function run on a background thread to generate the mystery
+    def generate(self):
+        mystery = generate_mystery(self.add_section if OPENAI_STREAMING else None, trace_id=self.trace_id)
+        with self.condition:
+            if mystery:
+                self.sections.update(zip(MYSTERY_SECTIONS, mystery))
+            self.finished = True
+            self.condition.notify_all()
+        self.wake_waiters()
+
+    # Function to wait for a section; returns '' if generation ended without it
+    def section(self, label):
+        with self.condition:
+            self.condition.wait_for(lambda: self.ready(label))
+            return self.sections.get(label, '')
+
+    # Function to check whether section() would return without waiting
+    def ready(self, label):
+        return label in self.sections or self.finished
+
+    # Function to call back once a section is ready, right away if it already is
+    def when_ready(self, label, callback):
+        with self.condition:
+            if not self.ready(label):
+                self.waiters.append((label, callback))
+                return
+        callback()
+
+    # Function to run the callbacks whose sections are now ready
+    def wake_waiters(self):
+        with self.condition:
+            ready = [callback for label, callback in self.waiters if self.ready(label)]
+            self.waiters = [(label, callback) for label, callback in self.waiters if not self.ready(label)]
+        for callback in ready:
+            callback()
+
+# Function to get the next mystery, generating it on the spot when the pool is empty
+def open_mystery(game):
+    mystery = MYSTERY_POOL.take()
+    game.mystery_span.attributes['pooled'] = mystery is not None
+    if mystery is not None:
+        return PendingMystery(mystery)
+    game.say("Fetching a new mystery...", PRIORITY_SYSTEM)
+    pending = PendingMystery(trace_id=game.mystery_id)
+    GENERATION_EXECUTOR.submit(pending.generate)
+    return pending
+
+GENERATION_EXECUTOR = concurrent.futures.ThreadPoolExecutor(GENERATION_WORKERS)
+
+# Class that maps chat guesses to the suspects of a mystery with precomputed lookups
+class SuspectIndex:
+    TITLES = {
+        'lady', 'lord', 'sir', 'dame', 'dr', 'doctor', 'mr', 'mrs', 'ms', 'miss', 'mister', 'madam', 'madame',
+        'colonel', 'col', 'captain', 'capt', 'major', 'general', 'professor', 'prof', 'inspector', 'detective',
+        'father', 'reverend', 'rev', 'count', 'countess', 'baron', 'baroness', 'duke', 'duchess', 'the',
+    }
+    MIN_PREFIX = 3  # Shortest prefix of a name accepted as a guess
+    MAX_MEMO = 10000  # Distinct chat lines whose match result is remembered
+    LIST_MARKER = re.compile(r'^\s*(?:\d+[.)]|[-*\u2022])\s*')
+    NAME_END = re.compile(r'\s+[-\u2013\u2014]\s+|[:(,]')
+    NOT_NAME = re.compile(r'[^\w\s]|_')
+
+    def __init__(self, suspects_text='', max_edits=SUSPECT_MATCH_MAX_EDITS):
+        self.max_edits = max_edits
+        self.suspects = []
+        for entry in self.split_entries(suspects_text):
+            name = self.NAME_END.split(self.LIST_MARKER.sub('', entry), 1)[0].strip(' .')
+            words = name.split()
+            if 0 < len(words) <= 5 and name[0].isupper() and self.name_tokens(name) and name not in self.suspects:
+                self.suspects.append(name)
+        self.build()
+
+    # Function to normalize text for lookups: lowercase words without punctuation
+    @classmethod
+    def normalize(cls, text):
+        return ' '.join(cls.NOT_NAME.sub(' ', text.lower()).split())
+
+    # Function to get the words of a name without titles
+    @classmethod
+    def name_tokens(cls, name):
+        return [token for token in cls.normalize(name).split() if token not in cls.TITLES]
+
+    # Function to split the Suspects section into one entry per suspect
+    @staticmethod
+    def split_entries(suspects_text):
+        entries = [entry for entry in re.split(r'[\n;]+', suspects_text) if entry.strip()]
+        if len(entries) <= 1:
+            # A single line lists suspects separated by commas and "and"
+            entries = [entry for entry in re.split(r',|\band\b', suspects_text) if entry.strip()]
+        return entries
+
+    # Function to add a suspect that the Suspects section didn't list in a recognizable way
+    def add_suspect(self, name):
+        if self.name_tokens(name) and name not in self.suspects:
+            self.suspects.append(name)
+            self.build()
+        return name
+
+    # Function to precompute every accepted way of naming each suspect
+    def build(self):
+        exact = {}
+        prefixes = {}
+        for name in self.suspects:
+            normalized = self.normalize(name)
+            tokens = self.name_tokens(name)
+            titles = [token for token in normalized.split() if token in self.TITLES and token != 'the']
+            keys = {normalized, ' '.join(tokens), tokens[0], tokens[-1]}
+            keys.update(f"{title} {tokens[-1]}" for title in titles)
+            for key in keys:
+                exact.setdefault(key, set()).add(name)
+            for word in set(tokens) | {' '.join(tokens)}:
+                for end in range(self.MIN_PREFIX, len(word)):
+                    prefixes.setdefault(word[:end], set()).add(name)
+        # Keys shared by several suspects are ambiguous and match nobody; exact names beat prefixes
+        self.exact = {key: names.pop() for key, names in exact.items() if len(names) == 1}
+        self.keys = {key: names.pop() for key, names in prefixes.items() if len(names) == 1 and key not in exact}
+        self.keys.update(self.exact)
+        self.memo = {}
+
+    # Function to find the suspect a chat message names, or None
+    def match(self, message):
+        result = self.memo.get(message, False)
+        if result is not False:
+            return result
+        result = self.lookup(self.normalize(message))
+        if len(self.memo) >= self.MAX_MEMO:
+            self.memo.clear()
+        self.memo[message] = result
+        return result
+
+    def lookup(self, normalized):
+        if not normalized:
+            return None
+        suspect = self.keys.get(normalized)
+        if suspect is not None:
+            return suspect
+        # Look for exactly one suspect named inside a longer message such as "it was ashford!"
+        tokens = normalized.split()[:12]
+        found = set()
+        for index in range(len(tokens)):
+            for key in (tokens[index], ' '.join(tokens[index:index + 2]), ' '.join(tokens[index:index + 3])):
+                if key in self.exact:
+                    found.add(self.exact[key])
+            # Inside a sentence only longer prefixes count, so words like "was" don't match a name
+            if len(tokens[index]) > self.MIN_PREFIX and tokens[index] in self.keys:
+                found.add(self.keys[tokens[index]])
+        if len(found) == 1:
+            return found.pop()
+        if found or not self.max_edits or len(normalized) < 4:
+            return None
+        # Bounded edit distance against the exact names catches small typos
+        for key, name in self.exact.items():
+            if abs(len(key) - len(normalized)) <= self.max_edits and edit_distance_within(key, normalized, self.max_edits):
+                found.add(name)
+        return found.pop() if len(found) == 1 else None
+
+# Function to check whether two strings are within max_edits insertions, deletions, substitutions or swaps
+def edit_distance_within(a, b, max_edits):
+    before_previous = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if before_previous is not None and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                cost = min(cost, before_previous[j - 2] + 1)
+            current.append(cost)
+        if min(current) > max_edits:
+            return False
+        before_previous, previous = previous, current
+    return previous[-1] <= max_edits
+
+# One bucket of a GuessTally: the guesses that have exactly count votes, linked to the buckets with the next
+# lower and higher counts
+class TallyBucket:
+    __slots__ = ('count', 'guesses', 'lower', 'higher')
+
+    def __init__(self, count):
+        self.count = count
+        self.guesses = {}  # Guess -> None; a dict keeps the guesses in the order they reached this count
+        self.lower = self.higher = None
+
+# Class that counts votes for at most capacity distinct guesses with the Space-Saving algorithm. Guesses are kept
+# in buckets of equal votes ordered by count (a Stream-Summary), so a vote moves a guess to the neighbouring
+# bucket in O(1), and the leaders are read from the top bucket down. Once full, a new guess takes over the slot
+# of a guess with the fewest votes, and its count; any guess with more than 1/capacity of the votes is kept.
+# Votes are queued without a lock and counted in batches, under a lock only the thread counting them takes.
+class GuessTally:
+    BATCH = 1024  # Queued votes that make the voting thread count them, if no other thread is
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.bucket_of = {}  # Guess -> its TallyBucket
+        self.lowest = self.highest = None  # Buckets with the fewest and the most votes
+        self.pending = collections.deque()  # (previous guess or None, guess) votes not counted yet
+        self.lock = threading.Lock()
+
+    # Function to move a chatter's vote from their previous guess, if any, to a new one
+    def vote(self, previous, guess):
+        self.pending.append((previous, guess))
+        if len(self.pending) >= self.BATCH and self.lock.acquire(blocking=False):
+            try:
+                self.count_pending()
+            finally:
+                self.lock.release()
+
+    # Function to get the k guesses with the most votes as (guess, votes), most first
+    def leaders(self, k):
+        with self.lock:
+            self.count_pending()
+            leaders = []
+            bucket = self.highest
+            while bucket is not None and len(leaders) < k:
+                leaders.extend((guess, bucket.count) for guess in itertools.islice(bucket.guesses, k - len(leaders)))
+                bucket = bucket.lower
+            return leaders
+
+    # Function to get the votes of every counted guess
+    def counts(self):
+        with self.lock:
+            self.count_pending()
+            return {guess: bucket.count for guess, bucket in self.bucket_of.items()}
+
+    # Function to count the queued votes; call with the lock held
+    def count_pending(self):
+        pending = self.pending
+        while pending:
+            previous, guess = pending.popleft()
+            if previous is not None and previous in self.bucket_of:
+                self.shift(previous, self.bucket_of[previous], -1)  # A guess pushed out already lost its votes
+            bucket = self.bucket_of.get(guess)
+            if bucket is None:
+                if len(self.bucket_of) < self.capacity:
+                    self.add(guess)
+                    continue
+                bucket = self.lowest
+                evicted = next(iter(bucket.guesses))
+                del bucket.guesses[evicted], self.bucket_of[evicted]
+                bucket.guesses[guess] = None
+                self.bucket_of[guess] = bucket
+            self.shift(guess, bucket, 1)
+
+    # Function to count the first vote for a guess
+    def add(self, guess):
+        bucket = self.lowest
+        if bucket is None or bucket.count != 1:
+            bucket = self.link(TallyBucket(1), None, self.lowest)
+        bucket.guesses[guess] = None
+        self.bucket_of[guess] = bucket
+
+    # Function to move a guess to the bucket one vote higher (step 1) or lower (step -1)
+    def shift(self, guess, bucket, step):
+        count = bucket.count + step
+        del bucket.guesses[guess]
+        if count:
+            target = bucket.higher if step > 0 else bucket.lower
+            if target is None or target.count != count:
+                target = self.link(TallyBucket(count), *((bucket, bucket.higher) if step > 0 else (bucket.lower, bucket)))
+            target.guesses[guess] = None
+            self.bucket_of[guess] = target
+        else:
+            del self.bucket_of[guess]
+        if not bucket.guesses:
+            self.unlink(bucket)
+
+    # Function to insert a bucket between two neighbours, either of which may be None at the ends
+    def link(self, bucket, lower, higher):
+        bucket.lower, bucket.higher = lower, higher
+        if lower is None:
+            self.lowest = bucket
+        else:
+            lower.higher = bucket
+        if higher is None:
+            self.highest = bucket
+        else:
+            higher.lower = bucket
+        return bucket
+
+    # Function to take an empty bucket out of the list
+    def unlink(self, bucket):
+        if bucket.lower is None:
+            self.lowest = bucket.higher
+        else:
+            bucket.lower.higher = bucket.higher
+        if bucket.higher is None:
+            self.highest = bucket.lower
+        else:
+            bucket.higher.lower = bucket.lower
+
+# A callback due at a given time; cancelling it keeps it from running
+class ScheduledEvent:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+# Class that runs every game phase and cooldown expiry from one thread, whatever the number of games;
+# callbacks run on that thread, so they must hand anything slow to another thread
+class PhaseScheduler:
+    def __init__(self):
+        self.heap = []  # (when, sequence, event), earliest first
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    # Function to run callback(*args) after delay seconds; returns the event so it can be cancelled
+    def schedule(self, delay, callback, *args):
+        event = ScheduledEvent(time.monotonic() + delay, callback, args)
+        with self.condition:
+            heapq.heappush(self.heap, (event.when, next(self.sequence), event))
+            if self.heap[0][2] is event:
+                self.condition.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return event
+
+    # Function to move an event to a new delay from now; returns the replacement event
+    def reschedule(self, event, delay):
+        event.cancel()
+        return self.schedule(delay, event.callback, *event.args)
+
+    # Function run by the scheduler thread
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, event = heapq.heappop(self.heap)
+            if event.cancelled:
+                continue
+            try:
+                event.callback(*event.args)
+            except Exception as e:
+                print(f"Error in scheduled {getattr(event.callback, '__name__', 'callback')}: {e}")
+
+SCHEDULER = PhaseScheduler()
+
+# Class that appends game events to a file so the games in progress can be picked up again after a restart.
+# Records are written in batches with one fsync each, and periodically folded into a snapshot of every game.
+# Every record sets state rather than changing it, so replaying one twice is harmless.
+class GameJournal(BatchWriter):
+    def __init__(self, journal_file, commit_interval, compact_records):
+        super().__init__(commit_interval, [])  # Encoded records
+        self.journal_file = journal_file
+        self.snapshot_file = f"{journal_file}.snapshot"
+        self.compact_records = compact_records
+        self.records = 0  # Records written since the last snapshot
+        self.restorable = {}  # Channel -> saved game not yet resumed
+        self.file = None
+
+    # Function to queue a game event; does nothing until the journal is started
+    def record(self, channel, kind, **fields):
+        if self.file is None:
+            return
+        fields.update(channel=channel, kind=kind, time=time.time())
+        line = json.dumps(fields) + '\n'
+        with self.condition:
+            self.pending.append(line)
+            self.condition.notify()
+
+    # Function to apply one record to the saved games it was replayed into
+    @staticmethod
+    def apply(saved_games, record):
+        channel, kind = record['channel'], record['kind']
+        if kind == 'part':
+            saved_games.pop(channel, None)
+            return
+        if kind == 'restore':  # A game handed over from another journal
+            saved_games[channel] = record['game']
+            return
+        saved = saved_games.get(channel)
+        if saved is None:
+            saved = saved_games[channel] = Game.default_snapshot(channel)
+        if kind == 'start':
+            saved.update(state='starting', index=0, due=record['time'], sections=None, mystery=record.get('mystery'), guesses={})
+        elif kind == 'mystery':
+            saved['sections'] = record['sections']
+        elif kind == 'phase':
+            saved.update(state=record['state'], index=record['index'], due=record['due'])
+        elif kind == 'guess':
+            saved['guesses'][record['user']] = record['suspect']
+        elif kind in ('finish', 'abort'):
+            saved.update(state=None, sections=None, guesses={})
+            if kind == 'finish':
+                saved.update(cooldown=record['cooldown'], last_mystery_time=record['last_mystery_time'])
+        elif kind == 'cooldown':
+            saved['cooldown'] = record['cooldown']
+
+    # Function to rebuild the saved games from the snapshot and the records written after it
+    def load(self):
+        saved_games = {}
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                saved_games = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable game snapshot: {e}")
+        replayed = 0
+        try:
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        print("Ignoring a partly written record at the end of the game journal.")
+                        break
+                    self.apply(saved_games, record)
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error reading the game journal: {e}")
+        self.restorable = saved_games
+        in_progress = sum(1 for saved in saved_games.values() if saved['state'] is not None)
+        print(f"Loaded {len(saved_games)} games from the journal ({replayed} records replayed, {in_progress} mysteries in progress).")
+
+    # Function to write a snapshot of every game and empty the journal; run by the writer thread
+    def compact(self):
+        saved_games = {channel: game.snapshot() for channel, game in list(GAMES.items())}
+        saved_games.update(self.restorable)  # Games not resumed yet keep their saved state
+        temporary_file = f"{self.snapshot_file}.tmp"
+        try:
+            with open(temporary_file, 'w', encoding='utf-8') as f:
+                json.dump(saved_games, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_file, self.snapshot_file)
+            # A crash before the journal is emptied only replays records the snapshot already contains
+            self.file.close()
+            self.file = open(self.journal_file, 'w', encoding='utf-8')
+            self.records = 0
+        except OSError as e:
+            print(f"Error compacting the game journal: {e}")
+
+    # Function to load the journal and start the writer thread
+    def start(self):
+        if self.thread is None:
+            self.load()
+            self.file = open(self.journal_file, 'a', encoding='utf-8')
+            self.compact()  # Also drops a partly written last record, which new records would be appended to
+            self.start_writer()
+
+    # Function to write and fsync a batch of records; run by the writer thread
+    def write_batch(self, batch):
+        try:
+            with JOURNAL_COMMIT_SECONDS.time():
+                self.file.write(''.join(batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        except OSError as e:
+            print(f"Error writing the game journal: {e}")
+            return
+        JOURNAL_RECORDS.inc(len(batch))
+        self.records += len(batch)
+        if self.records >= self.compact_records:
+            self.compact()
+
+GAME_JOURNAL = GameJournal(GAME_JOURNAL_FILE, GAME_JOURNAL_COMMIT_INTERVAL, GAME_JOURNAL_COMPACT_RECORDS)
+
+# Class keeping every viewer's score across games and channels. Scores are kept in memory, along with the top viewers
+# and how many viewers have each score, so !rank and !top never touch the disk; results reach SQLite in batches.
+# When other processes write to the same database, the writer thread re-reads it every refresh_interval seconds.
+class Leaderboard(BatchWriter):
+    def __init__(self, db_file, flush_interval, top_k, refresh_interval=None):
+        super().__init__(flush_interval, {})  # Username -> [correct, incorrect, last played] not yet written
+        self.db_file = db_file
+        self.top_k = top_k
+        self.idle_timeout = self.refresh_interval = refresh_interval
+        self.refreshed = 0  # Monotonic time the scores were last read from the database
+        self.scores = {}  # Username -> [correct, incorrect]
+        self.score_counts = collections.Counter()  # Correct guesses -> viewers with that many
+        self.top = []  # (-correct, username) of the best viewers, best first
+        self.db = None  # The writer thread's connection
+
+    # Function to open the database, creating the table the first time
+    def connect(self):
+        db = sqlite3.connect(self.db_file, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")  # Readers and other workers' writers don't block each other
+        db.execute("PRAGMA synchronous=NORMAL")  # With WAL, a power cut can lose the last batch but never corrupt
+        db.execute("CREATE TABLE IF NOT EXISTS viewer_scores (username TEXT PRIMARY KEY, correct INTEGER NOT NULL, "
+                   "incorrect INTEGER NOT NULL, last_played REAL NOT NULL)")
+        return db
+
+    # Function to load every viewer's score into memory, adding the results not written yet; returns the viewers read
+    def load(self):
+        db = self.connect()
+        try:
+            rows = db.execute("SELECT username, correct, incorrect FROM viewer_scores").fetchall()
+        finally:
+            db.close()
+        with self.condition:
+            self.scores = {username: [correct, incorrect] for username, correct, incorrect in rows}
+            for username, (correct, incorrect, _) in self.pending.items():
+                score = self.scores.setdefault(username, [0, 0])
+                score[0] += correct
+                score[1] += incorrect
+            self.score_counts = collections.Counter(correct for correct, _ in self.scores.values())
+            self.top = heapq.nsmallest(self.top_k, ((-correct, username) for username, (correct, _) in self.scores.items() if correct))
+        return len(rows)
+
+    # Function to count the results of a reveal: (username, guessed right) pairs
+    def record(self, results):
+        now = time.time()
+        with self.condition:
+            for username, correct in results:
+                score = self.scores.get(username)
+                if score is None:
+                    score = self.scores[username] = [0, 0]
+                else:
+                    self.score_counts[score[0]] -= 1
+                    if not self.score_counts[score[0]]:
+                        del self.score_counts[score[0]]
+                score[0 if correct else 1] += 1
+                self.score_counts[score[0]] += 1
+                if correct:
+                    self.update_top(username, score[0])
+                if self.thread is not None:
+                    pending = self.pending.get(username)
+                    if pending is None:
+                        pending = self.pending[username] = [0, 0, now]
+                    pending[0 if correct else 1] += 1
+                    pending[2] = now
+            self.condition.notify()
+
+    # Function to move a viewer whose score went up into the top list; call with the lock held.
+    # Scores only grow, so a viewer outside the list can only get in by passing its last entry.
+    def update_top(self, username, correct):
+        for index, (_, name) in enumerate(self.top):
+            if name == username:
+                del self.top[index]
+                break
+        entry = (-correct, username)
+        if len(self.top) < self.top_k or entry < self.top[-1]:
+            bisect.insort(self.top, entry)
+            del self.top[self.top_k:]
+
+    # Function to get a viewer's rank, correct and incorrect guesses, or None if they never guessed
+    def rank(self, username):
+        with self.condition:
+            score = self.scores.get(username)
+            if score is None:
+                return None
+            ahead = sum(count for correct, count in self.score_counts.items() if correct > score[0])
+            return ahead + 1, score[0], score[1]
+
+    # Function to list (username, correct guesses) of the best viewers
+    def leaders(self):
+        with self.condition:
+            return [(username, -negative_correct) for negative_correct, username in self.top]
+
+    # Function to load the scores and start the writer thread
+    def start(self):
+        if self.thread is None:
+            print(f"Loaded the scores of {self.load()} viewers.")
+            self.refreshed = time.monotonic()
+            self.start_writer()
+
+    # Function to re-read the scores when other processes save to the same database; run by the writer thread
+    def between_batches(self):
+        if self.refresh_interval and time.monotonic() - self.refreshed >= self.refresh_interval:
+            self.load()  # Brings in the results other processes saved since the last time
+            self.refreshed = time.monotonic()
+
+    # Function to add a batch of results to the database in one transaction; run by the writer thread
+    def write_batch(self, batch):
+        try:
+            if self.db is None:
+                self.db = self.connect()
+            with LEADERBOARD_FLUSH_SECONDS.time(), self.db:
+                self.db.executemany(
+                    "INSERT INTO viewer_scores VALUES (?, ?, ?, ?) ON CONFLICT(username) DO UPDATE SET "
+                    "correct = correct + excluded.correct, incorrect = incorrect + excluded.incorrect, "
+                    "last_played = excluded.last_played",
+                    [(username, correct, incorrect, last_played) for username, (correct, incorrect, last_played) in batch.items()])
+        except sqlite3.Error as e:
+            print(f"Error saving viewer scores, retrying with the next batch: {e}")
+            with self.condition:
+                for username, (correct, incorrect, last_played) in batch.items():
+                    pending = self.pending.setdefault(username, [0, 0, last_played])
+                    pending[0] += correct
+                    pending[1] += incorrect
+            time.sleep(self.interval)
+
+LEADERBOARD = Leaderboard(LEADERBOARD_DB_FILE, LEADERBOARD_FLUSH_INTERVAL, LEADERBOARD_TOP_K)
+
+# Class holding the state, cooldown and tallies of the game in one channel
+class Game:
+    def __init__(self, channel):
+        self.channel = channel
+        self.broadcaster_id = None
+        self._state = None
+        self.state_since = time.monotonic()
+        self.tally = GuessTally(GUESS_TALLY_CAPACITY)  # Votes per guessed suspect
+        self.guesses = {}  # Each chatter's current guess; a new guess replaces the old one
+        self.lock = threading.Lock()  # Held to count queued guesses, to change what the journal saves, and to snapshot it
+        self.queued_guesses = collections.deque()  # (username, suspect) guesses from chat not counted yet
+        self.count_scheduled = False  # Whether the scheduler thread will count the queued guesses
+        self.suspect_index = SuspectIndex()
+        self.murderer_name = ''  # Store the murderer's name for comparison
+        self.mystery_sections = None  # Sections of the running mystery once generated, kept for the journal
+        self.phase_index = 0  # Next section to post; 4 once the guessing is opened
+        self.phase_due = 0  # Timestamp the next phase is due
+        timings = CHANNEL_TIMINGS.get(channel, {})
+        self.phase_delay = timings.get('phase_delay', PHASE_DELAY)
+        self.guess_window = timings.get('guess_window', GUESS_WINDOW)
+        self.cooldown = timings.get('cooldown', MYSTERY_COOLDOWN)
+        self.last_mystery_time = 0  # Timestamp of the last mystery
+        self.mystery_id = None  # ID of the running mystery, shared by the spans of its trace
+        self.mystery_span = self.phase_span = None  # Spans timing the running mystery and its current phase
+        self.phase_event = None  # Next scheduled step of the running mystery
+        self.leader_event = None  # Next "current leader" post while chat is guessing
+        self.cooldown_event = None  # Scheduled end of the cooldown, None when a mystery may start
+        self.chat_lines = 0  # Chat lines received, used to measure how busy the channel is
+        self.messages_sent = 0  # Chat messages sent for the current mystery
+        self.messages_saved = 0  # Chat messages packing saved for the current mystery
+
+    # The game's phase: None, 'starting', 'guessing' or 'revealing'; the time spent in each is recorded
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        if state == self._state:
+            return
+        now = time.monotonic()
+        if self._state is not None:
+            GAME_PHASE_SECONDS.observe(now - self.state_since, (self._state,))
+        self._state = state
+        self.state_since = now
+
+    # Function to send a message to this game's channel
+    def say(self, message, priority=PRIORITY_NARRATIVE):
+        packed = pack_message(message)
+        self.messages_sent += len(packed.lines)
+        self.messages_saved += packed.unpacked - len(packed.lines)
+        return send_message(IRC_SOCKET, packed, priority, self.channel, self.mystery_id)
+
+    # Function to clear the tallies for a new mystery
+    def reset(self):
+        self.tally = GuessTally(GUESS_TALLY_CAPACITY)
+        self.guesses = {}
+        self.queued_guesses.clear()
+        self.suspect_index = SuspectIndex()
+        self.messages_sent = 0
+        self.messages_saved = 0
+
+    # Function to give a new mystery its ID and start timing it, along with its first phase
+    def begin_trace(self, mystery_id=None, index=0, **attributes):
+        self.mystery_id = mystery_id or os.urandom(8).hex()
+        self.mystery_span = TRACER.span('mystery', self.mystery_id, channel=self.channel, **attributes)
+        self.phase_span = self.begin_phase(index)
+
+    # Function to start timing a phase, which ends when the next one is recorded
+    def begin_phase(self, index, **attributes):
+        # Phases 1 to 4 are the delays before the sections and the guessing prompt; index 4 is recorded again for the guessing
+        section = 'guessing' if self.state == 'guessing' else MYSTERY_SECTIONS[index] if index < 4 else 'Guess prompt'
+        return TRACER.span('phase', self.mystery_id, index=index, section=section, **attributes)
+
+    # Function to stop timing the mystery, which ended the way outcome says
+    def end_trace(self, outcome):
+        if self.mystery_span is None:
+            return
+        self.phase_span.end()
+        self.mystery_span.end(outcome=outcome, messages=self.messages_sent)
+        self.mystery_span = self.phase_span = None
+        self.mystery_id = None
+
+    # Function to append an event of this game to the journal
+    def journal(self, kind, **fields):
+        GAME_JOURNAL.record(self.channel, kind, **fields)
+
+    # Function to keep the generated mystery so it can be resumed after a restart
+    def remember_mystery(self, mystery):
+        with self.lock:
+            self.mystery_sections = dict(mystery.sections)
+            self.journal('mystery', sections=self.mystery_sections)
+
+    # Function to set up the suspects chat can guess from
+    def set_suspects(self, suspects, murderer):
+        self.suspect_index = SuspectIndex(suspects)
+        self.murderer_name = self.suspect_index.match(murderer) or self.suspect_index.add_suspect(murderer)
+
+    # Function to queue a chatter's guess to be counted; each chatter has one vote and their latest guess replaces
+    # it. The receive thread takes no lock: the scheduler thread counts and journals the queued guesses in batches.
+    def tally_guess(self, username, message):
+        if self.suspect_index.suspects:
+            suspect = self.suspect_index.match(message)
+        else:
+            suspect = message.strip().lower() or None
+        if suspect is None or self.state != 'guessing':
+            return None
+        self.queued_guesses.append((username, suspect))
+        if not self.count_scheduled:
+            self.count_scheduled = True
+            SCHEDULER.schedule(GAME_JOURNAL_COMMIT_INTERVAL, self.count_guesses)
+        return suspect
+
+    # Function to count the queued guesses, run by the scheduler thread
+    def count_guesses(self):
+        with self.lock:
+            self.count_queued_guesses()
+
+    # Function to count and journal the queued guesses; call with the lock held. Guesses queued after the
+    # guessing closed are dropped.
+    def count_queued_guesses(self):
+        self.count_scheduled = False  # Cleared first, so a guess queued from now on schedules another count
+        queued = self.queued_guesses
+        counted = 0
+        while queued:
+            username, suspect = queued.popleft()
+            if self.state != 'guessing':
+                continue
+            counted += 1
+            if self.guesses.get(username) != suspect:
+                self.count_guess(username, suspect)
+                self.journal('guess', user=username, suspect=suspect)
+        if counted:
+            GUESSES.inc(counted)
+
+    # Function to move a chatter's vote to a suspect
+    def count_guess(self, username, suspect):
+        previous = self.guesses.get(username)
+        self.guesses[username] = suspect
+        self.tally.vote(previous, suspect)
+
+    # Function to get the most guessed suspect, or None before anyone guessed
+    def leader(self):
+        with self.lock:
+            self.count_queued_guesses()
+        leaders = self.tally.leaders(1)
+        return leaders[0] if leaders else (None, 0)
+
+    # Function to get the "current leader" post for chat, or None before anyone guessed
+    def leader_message(self):
+        suspect, votes = self.leader()
+        if suspect is None:
+            return None
+        remaining = max(0, round((self.phase_due - time.time()) / TIME_SCALE))
+        return (f"Current leader: {self.format_suspect(suspect)} with {votes} {'vote' if votes == 1 else 'votes'}. "
+                f"{remaining} seconds left to guess!")
+
+    # Function to stop taking guesses, counting the ones queued so far; a guess queued later is dropped
+    def close_guessing(self):
+        with self.lock:
+            self.count_queued_guesses()
+            self.state = 'revealing'
+
+    # Function to list (username, guessed right) for every chatter who guessed
+    def guess_results(self):
+        murderer = self.murderer_name.lower()
+        with self.lock:
+            guesses = list(self.guesses.items())
+        return [(username, suspect.lower() == murderer) for username, suspect in guesses]
+
+    # Function to get the name to show in chat for a tallied suspect
+    def format_suspect(self, suspect):
+        return suspect if self.suspect_index.suspects else suspect.title()
+
+    # Function to check whether a new mystery may start; replies in chat when it can't
+    def try_start(self):
+        if self.state is not None:
+            self.say("A mystery is already in progress.", PRIORITY_SYSTEM)
+            return False
+        cooldown_event = self.cooldown_event
+        if cooldown_event is not None and not cooldown_event.cancelled:
+            self.say(f"Please wait {int(cooldown_event.when - time.monotonic())} seconds before starting a new mystery.", PRIORITY_SYSTEM)
+            return False
+        self.state = 'starting'
+        return True
+
+    # Function to schedule the next step of the running mystery
+    def schedule(self, delay, callback, *args):
+        self.phase_event = SCHEDULER.schedule(delay, callback, *args)
+        return self.phase_event
+
+    # Function to journal and schedule the next phase of the mystery
+    def schedule_phase(self, index, delay, callback, *args):
+        if self.phase_span is not None:
+            self.phase_span.end()
+        self.phase_span = self.begin_phase(index, delay=delay)
+        with self.lock:
+            self.phase_index = index
+            self.phase_due = time.time() + delay
+            self.journal('phase', state=self.state, index=index, due=self.phase_due)
+        return self.schedule(delay, callback, *args)
+
+    # Function to schedule the next "current leader" post, unless the reveal comes first
+    def schedule_leader_update(self):
+        delay = LEADER_UPDATE_INTERVAL * TIME_SCALE
+        if LEADER_UPDATE_INTERVAL and self.phase_due - time.time() > delay:
+            self.leader_event = SCHEDULER.schedule(delay, announce_leader, self)
+
+    # Function to end a mystery and start the cooldown before the next one
+    def finish(self):
+        self.end_trace('finished')
+        with self.lock:
+            self.state = None
+            self.phase_event = None
+            self.mystery_sections = None
+            self.last_mystery_time = time.time()
+            self.journal('finish', cooldown=self.cooldown, last_mystery_time=self.last_mystery_time)
+        self.cooldown_event = SCHEDULER.schedule(self.cooldown, self.end_cooldown)
+        print(f"Mystery in #{self.channel} took {self.messages_sent} chat messages; packing saved {self.messages_saved}.")
+
+    # Function to give up on a mystery that could not be generated; no cooldown applies
+    def abort(self):
+        self.end_trace('aborted')
+        with self.lock:
+            self.state = None
+            self.phase_event = None
+            self.mystery_sections = None
+            self.journal('abort')
+
+    def end_cooldown(self):
+        self.cooldown_event = None
+
+    # Function to shorten the cooldown, including one that is already running
+    def reduce_cooldown(self, seconds):
+        with self.lock:
+            self.cooldown = max(60, self.cooldown - seconds)
+            self.journal('cooldown', cooldown=self.cooldown)
+        cooldown_event = self.cooldown_event
+        if cooldown_event is not None and not cooldown_event.cancelled:
+            remaining = self.last_mystery_time + self.cooldown - time.time()
+            self.cooldown_event = SCHEDULER.reschedule(cooldown_event, max(0, remaining))
+
+    # Function to stop the running mystery and cooldown, e.g. when leaving the channel
+    def cancel(self):
+        for event in (self.phase_event, self.cooldown_event, self.leader_event):
+            if event is not None:
+                event.cancel()
+        self.phase_event = self.cooldown_event = self.leader_event = None
+        if self.state is not None:
+            self.end_trace('cancelled')
+        self.state = None
+
+    # Function to copy every chatter's guess, counting the queued ones first
+    def saved_guesses(self):
+        with self.lock:
+            self.count_queued_guesses()
+            return dict(self.guesses)
+
+    # Function to get what the journal saves of a game in a channel that has not played yet
+    @staticmethod
+    def default_snapshot(channel):
+        return {
+            'state': None,
+            'index': 0,
+            'due': 0,
+            'sections': None,
+            'mystery': None,
+            'guesses': {},
+            'cooldown': CHANNEL_TIMINGS.get(channel, {}).get('cooldown', MYSTERY_COOLDOWN),
+            'last_mystery_time': 0,
+        }
+
+    # Function to save the game for the journal's snapshot; the lock keeps the fields from changing meanwhile
+    def snapshot(self):
+        with self.lock:
+            self.count_queued_guesses()
+            return {
+                'state': self.state,
+                'index': self.phase_index,
+                'due': self.phase_due,
+                'sections': self.mystery_sections,
+                'mystery': self.mystery_id,
+                'guesses': dict(self.guesses),
+                'cooldown': self.cooldown,
+                'last_mystery_time': self.last_mystery_time,
+            }
+
+    # Function to pick a game up from the journal after a restart, rescheduling what was left of it
+    def resume(self, saved):
+        self.cooldown = saved['cooldown']
+        self.last_mystery_time = saved['last_mystery_time']
+        if saved['state'] is None:
+            remaining = self.last_mystery_time + self.cooldown - time.time()
+            if remaining > 0:
+                self.cooldown_event = SCHEDULER.schedule(remaining, self.end_cooldown)
+            return
+        self.state = 'starting'
+        sections = saved['sections']
+        if sections is None:
+            # The restart interrupted the generation, so there is nothing to resume from
+            SCHEDULER.schedule(0, start_mystery, self)
+            return
+        self.mystery_sections = sections
+        self.phase_index = saved['index']
+        self.phase_due = saved['due']
+        delay = max(0, self.phase_due - time.time())
+        if saved['state'] == 'starting':
+            self.begin_trace(saved.get('mystery'), self.phase_index, resumed=True)
+            mystery = PendingMystery(tuple(sections.get(label, '') for label in MYSTERY_SECTIONS))
+            self.schedule(delay, advance_mystery, self, mystery, self.phase_index)
+            return
+        self.set_suspects(sections.get('Suspects', ''), sections.get('Murderer', ''))
+        for username, suspect in saved['guesses'].items():
+            self.count_guess(username, suspect)
+        self.state = 'guessing'
+        self.begin_trace(saved.get('mystery'), self.phase_index, resumed=True)
+        self.schedule(delay, poll_chat_for_reveal, self, sections.get('The Reveal', ''))
+        self.schedule_leader_update()
+
+# Function to add a channel to play in
+def add_game(channel):
+    game = GAMES.get(channel)
+    if game is None:
+        game = GAMES[channel] = Game(channel)
+    return game
+
+# Function to stop playing in a channel
+def remove_game(channel):
+    game = GAMES.pop(channel, None)
+    if game is not None:
+        game.cancel()
+        game.journal('part')
+        if GAMES_BY_BROADCASTER.get(game.broadcaster_id) is game:
+            del GAMES_BY_BROADCASTER[game.broadcaster_id]
+    return game
+
+# Function to resume the games the journal saved for the channels now being played; what they say waits for chat
+def resume_games():
+    for channel, game in list(GAMES.items()):
+        saved = GAME_JOURNAL.restorable.pop(channel, None)
+        if saved is not None:
+            game.resume(saved)
+
+# Function to connect to Twitch chat and receive messages, reconnecting whenever the connection can't be made,
+# closes, fails or stalls. The games carry on meanwhile; only chat sent during the gap is missed.
 def receive_messages():
-    global game_state, suspect_count
-    buffer = ""
+    attempt = 0
     while True:
         try:
-            response = IRC_SOCKET.recv(2048).decode('utf-8')
-            buffer += response
-            while '\r\n' in buffer:
-                line, buffer = buffer.split('\r\n', 1)
-                if line.startswith('PING'):
-                    IRC_SOCKET.send('PONG\n'.encode('utf-8'))
-                else:
+            connect_to_twitch()
+        except Exception as e:
+            print(f"Error connecting to Twitch IRC: {e}")
+            time.sleep(reconnect_delay(attempt))
+            attempt += 1
+            continue
+        sock = IRC_SOCKET.sock
+        reason, healthy = read_until_disconnected(sock)
+        if IRC_SOCKET.detach(sock, reason):
+            print(f"Lost the Twitch IRC connection ({reason}); reconnecting.")
+        sock.close()
+        attempt = 0 if healthy else attempt + 1
+        time.sleep(reconnect_delay(attempt))
+
+# Function to read chat from one connection until it is lost; returns why, and whether any line arrived
+def read_until_disconnected(sock):
+    framer = IRCLineFramer()
+    access_token = APP_TOKEN.token
+    healthy = False
+    pinged = False
+    while True:
+        try:
+            try:
+                lines = framer.read(sock)
+            except socket.timeout:
+                if pinged:
+                    print("Twitch IRC did not answer our PING.")
+                    return 'stalled', healthy
+                pinged = True
+                sock.settimeout(IRC_PONG_TIMEOUT)
+                sock.send("PING :tmi.twitch.tv\r\n".encode('utf-8'))
+                continue
+            if lines is None:
+                print("Connection closed by Twitch IRC.")
+                return 'closed', healthy
+            healthy = True
+            IRC_SOCKET.received()
+            if pinged:
+                pinged = False
+                sock.settimeout(IRC_PING_INTERVAL)
+            for line in lines:
+                check = check_connection_line(line, access_token)
+                if check is None:
                     process_chat_message(line)
+                elif check.startswith('PONG'):
+                    sock.send(f"{check}\r\n".encode('utf-8'))
+                else:
+                    return check, healthy and check != 'auth'  # Back off if Twitch keeps refusing the token
         except Exception as e:
             print(f"Error receiving messages: {e}")
-            break
+            return 'error', healthy
+
+# Splits the raw IRC byte stream into lines; each complete line is decoded on its own, so a multibyte
+# character split across two reads is never decoded in halves
+class IRCLineFramer:
+    def __init__(self, recv_size=IRC_RECV_SIZE):
+        self.buffer = bytearray()
+        self.chunk = bytearray(recv_size)
+        self.view = memoryview(self.chunk)
+
+    # Function to read once from a socket; returns the complete lines, or None when the connection closed
+    def read(self, sock):
+        count = sock.recv_into(self.chunk)
+        if not count:
+            return None
+        return self.feed(self.view[:count])
+
+    # Function to add received bytes and return every line they complete
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        lines = []
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start)
+            if end < 0:
+                break
+            stop = end - 1 if end > start and buffer[end - 1] == 13 else end  # Drop the \r of \r\n
+            lines.append(buffer[start:stop].decode('utf-8', errors='replace'))
+            start = end + 1
+        if start:
+            del buffer[:start]
+        return lines
+
+# One parsed IRC line; tags are kept raw and only unescaped by parse_irc_tags when needed
+IRCMessage = collections.namedtuple('IRCMessage', ['tags', 'prefix', 'nick', 'command', 'channel', 'text'])
+
+# Function to parse an IRC line with optional IRCv3 tags, e.g. "@tags :nick!user@host PRIVMSG #channel :text"
+def parse_irc_line(line):
+    tags = prefix = nick = channel = ''
+    if line.startswith('@'):
+        tags, _, line = line[1:].partition(' ')
+    if line.startswith(':'):
+        prefix, _, line = line[1:].partition(' ')
+        nick = prefix.partition('!')[0]
+    command, _, params = line.partition(' ')
+    if params.startswith('#'):
+        channel, _, params = params[1:].partition(' ')
+    text = params[1:] if params.startswith(':') else params
+    return IRCMessage(tags, prefix, nick, command, channel, text)
+
+# Escape sequences used in IRCv3 tag values
+IRC_TAG_ESCAPES = re.compile(r'\\(.?)')
+IRC_TAG_UNESCAPED = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+# Function to turn the raw IRCv3 tags of a line into a dict
+def parse_irc_tags(raw_tags):
+    tags = {}
+    if not raw_tags:
+        return tags
+    for tag in raw_tags.split(';'):
+        key, _, value = tag.partition('=')
+        if '\\' in value:
+            value = IRC_TAG_ESCAPES.sub(lambda match: IRC_TAG_UNESCAPED.get(match.group(1), match.group(1)), value)
+        tags[key] = value
+    return tags
+
+# Function to record how long ago Twitch sent a line, from its tmi-sent-ts tag in milliseconds
+def observe_receive_lag(raw_tags):
+    start = raw_tags.find('tmi-sent-ts=')
+    if start < 0 or (start and raw_tags[start - 1] != ';'):
+        return
+    end = raw_tags.find(';', start)
+    sent = raw_tags[start + 12:end if end >= 0 else len(raw_tags)]
+    if sent.isdigit():
+        RECEIVE_LAG_SECONDS.observe(max(0.0, time.time() - int(sent) / 1000))
+
+# Function to find a chatter's display name without waiting on the Helix API
+def resolve_display_name(username, tags):
+    display_name = tags.get('display-name')
+    if display_name:
+        if 'user-id' in tags:
+            USER_CACHE.put(username, {'id': tags['user-id'], 'login': username, 'display_name': display_name})
+        return display_name
+    user_info = USER_CACHE.get(username)
+    if user_info:
+        return user_info.get('display_name', username)
+    # Look the user up in the background so later messages from them have a display name
+    USER_LOOKUPS.request(username)
+    return username
+
+# Function to handle a chat line for either engine; begin(game) starts a mystery the way the engine runs them
+def handle_chat_line(line, begin):
+    irc_message = parse_irc_line(line)
+    CHAT_LINES.inc()
+    observe_receive_lag(irc_message.tags)
+    if irc_message.command != 'PRIVMSG':
+        if irc_message.command == 'JOIN':
+            STARTUP.joined(irc_message.nick, irc_message.channel)
+        return
+    game = GAMES.get(irc_message.channel)
+    if game is None:
+        return
+    username = irc_message.nick
+    message = irc_message.text
+    game.chat_lines += 1
+    print(f"Message received from {username} in #{game.channel}: {message}")
+
+    if message.lower() == "!mystery":
+        if game.try_start():
+            begin(game)
+    elif message.lower() in ("!rank", "!top"):
+        answer_leaderboard_command(game, username, message.lower(), irc_message.tags)
+    elif game.state == 'guessing':
+        suspect = game.tally_guess(username, message)
+        if suspect:
+            display_name = resolve_display_name(username, parse_irc_tags(irc_message.tags))
+            print(f"User {display_name} guessed: {suspect}")
 
 # Function to process chat messages
 def process_chat_message(line):
-    global game_state, suspect_count, last_mystery_time, cooldown
-    if "PRIVMSG" in line:
-        match = re.search(r":(\w+)!.*PRIVMSG #\w+ :(.*)", line)
-        if match:
-            username = match.group(1)
-            message = match.group(2)
-            print(f"Message received from {username}: {message}")
-
-            if message.lower() == "!mystery":
-                current_time = time.time()
-                if game_state is None:
-                    if current_time - last_mystery_time >= cooldown:
-                        threading.Thread(target=start_mystery).start()
-                    else:
-                        remaining_time = int(cooldown - (current_time - last_mystery_time))
-                        send_message(IRC_SOCKET, f"Please wait {remaining_time} seconds before starting a new mystery.")
-                else:
-                    send_message(IRC_SOCKET, "A mystery is already in progress.")
-            elif game_state == 'guessing':
-                suspect = message.strip().lower()
-                if suspect:
-                    suspect_count[suspect] = suspect_count.get(suspect, 0) + 1
-                    # Fetch user info using Twitch API
-                    user_info = get_user_info(username)
-                    if user_info:
-                        display_name = user_info.get('display_name', username)
-                    else:
-                        display_name = username
-                    print(f"User {display_name} guessed: {suspect}")
-
-# Function to start the mystery
-def start_mystery():
-    global game_state, suspect_count, murderer_name, last_mystery_time
-    game_state = 'starting'
-    suspect_count = {}
-    send_message(IRC_SOCKET, "Fetching a new mystery...")
-    backstory, murder, suspects, clues, murderer, reveal = fetch_mystery_from_chatgpt()
-
-    if backstory and murder and clues and reveal and suspects and murderer:
-        murderer_name = murderer.lower()
-        send_message(IRC_SOCKET, f"Backstory: {backstory}")
-        time.sleep(10)
-
-        send_message(IRC_SOCKET, f"The Murder: {murder}")
-        time.sleep(10)
-
-        send_message(IRC_SOCKET, f"Suspects: {suspects}")
-        time.sleep(10)
-
-        send_message(IRC_SOCKET, f"Clue Phase: {clues}")
-        time.sleep(10)
-
-        # Include the list of suspects when asking for guesses
-        send_message(IRC_SOCKET, f"Guess who the murderer is from the suspects listed! You have 60 seconds to submit your guesses.")
-        game_state = 'guessing'
-        # Schedule the reveal in 60 seconds
-        threading.Timer(60, poll_chat_for_reveal, args=(reveal,)).start()
+    handle_chat_line(line, schedule_mystery)
+
+# Function to start a mystery on the scheduler thread
+def schedule_mystery(game):
+    SCHEDULER.schedule(0, start_mystery, game)
+
+# Function to answer !rank and !top from the in-memory leaderboard
+def answer_leaderboard_command(game, username, command, raw_tags):
+    if command == "!rank":
+        display_name = resolve_display_name(username, parse_irc_tags(raw_tags))
+        rank = LEADERBOARD.rank(username)
+        if rank is None:
+            game.say(f"@{display_name} hasn't guessed in a mystery yet.", PRIORITY_SYSTEM)
+        else:
+            position, correct, incorrect = rank
+            game.say(f"@{display_name} is ranked #{position} with {correct} correct guesses out of {correct + incorrect}.", PRIORITY_SYSTEM)
+        return
+    leaders = LEADERBOARD.leaders()
+    if not leaders:
+        game.say("No one has solved a mystery yet.", PRIORITY_SYSTEM)
+        return
+    names = []
+    for position, (login, correct) in enumerate(leaders, 1):
+        user_info = USER_CACHE.get(login)
+        names.append(f"{position}. {user_info.get('display_name', login) if user_info else login} ({correct})")
+    game.say(f"Top detectives: {', '.join(names)}", PRIORITY_SYSTEM)
+
+# Function to start the mystery; the phases that follow are driven by the scheduler
+def start_mystery(game):
+    with game.lock:
+        game.state = 'starting'
+        game.reset()
+        game.begin_trace()
+        game.journal('start', mystery=game.mystery_id)
+    mystery = open_mystery(game)
+    mystery.when_ready('The Reveal', lambda: game.remember_mystery(mystery))
+    advance_mystery(game, mystery, 0)
+
+# Function to post the next section of a mystery, or open the guessing once all are posted; runs on the
+# scheduler thread and never waits: a section that is still being generated calls back when it is ready
+def advance_mystery(game, mystery, index):
+    if game.state != 'starting':
+        return
+    label = MYSTERY_SECTIONS[index] if index < 4 else 'The Reveal'
+    if not mystery.ready(label):
+        mystery.when_ready(label, lambda: game.schedule(0, advance_mystery, game, mystery, index))
+        return
+    if index < 4:
+        text = mystery.section(label)
+        if text:
+            # Wait for the section to be sent before the delay to the next one starts
+            sent = game.say(f"{label}: {text}")
+            sent.add_done_callback(lambda _: game.schedule_phase(index + 1, game.phase_delay * TIME_SCALE, advance_mystery, game, mystery, index + 1))
+            return
     else:
-        send_message(IRC_SOCKET, "An error occurred fetching the mystery. Try again later.")
-        game_state = None
+        murderer = mystery.section('Murderer')
+        reveal = mystery.section('The Reveal')
+        if murderer and reveal:
+            game.set_suspects(mystery.section('Suspects'), murderer)
+            # Include the list of suspects when asking for guesses
+            game.say(f"Guess who the murderer is from the suspects listed! You have {game.guess_window} seconds to submit your guesses.")
+            game.state = 'guessing'
+            # Schedule the reveal once the guessing window closes
+            game.schedule_phase(4, game.guess_window * TIME_SCALE, poll_chat_for_reveal, game, reveal)
+            game.schedule_leader_update()
+            return
+    game.say("An error occurred fetching the mystery. Try again later.", PRIORITY_SYSTEM)
+    game.abort()
+
+# Function to post which suspect chat is leaning towards, and schedule the next post; runs on the scheduler thread
+def announce_leader(game):
+    if game.state != 'guessing':
+        return
+    message = game.leader_message()
+    if message:
+        game.say(message)
+    game.schedule_leader_update()
 
 # Function to poll the chat for guesses and reveal the murderer
-def poll_chat_for_reveal(reveal):
-    global suspect_count, game_state, murderer_name, last_mystery_time
-    game_state = 'revealing'
-    most_likely_suspect = max(suspect_count, key=suspect_count.get, default=None) if suspect_count else None
+def poll_chat_for_reveal(game, reveal):
+    messages = reveal_messages(game, reveal)
+    span = TRACER.span('reveal', game.mystery_id, guesses=len(game.guesses))
+    sent = None
+    for message in messages:
+        sent = game.say(message)
+    # The messages go out in order, so the reveal has reached chat once the last one is sent
+    if sent is None:
+        span.end()
+    else:
+        sent.add_done_callback(lambda future: span.end(**end_reveal_attributes(future)))
+    LEADERBOARD.record(game.guess_results())
+    game.finish()
+
+# Function to return the attributes to end the reveal span with, given the future of its last message
+def end_reveal_attributes(future):
+    error = future.exception()
+    return {} if error is None else {'error': type(error).__name__}
+
+# Function to close the guessing and list the messages that reveal the murderer
+def reveal_messages(game, reveal):
+    game.close_guessing()
+    most_likely_suspect, _ = game.leader()
+    messages = []
 
     # Before revealing, show the most guessed suspect
     if most_likely_suspect:
-        send_message(IRC_SOCKET, f"Most guessed suspect: {most_likely_suspect.title()}")
+        messages.append(f"Most guessed suspect: {game.format_suspect(most_likely_suspect)}")
         # Compare the most guessed suspect with the murderer's name
-        if most_likely_suspect.lower() == murderer_name.lower():
-            send_message(IRC_SOCKET, "That is correct! Let's see how it all went down...")
+        if most_likely_suspect.lower() == game.murderer_name.lower():
+            messages.append("That is correct! Let's see how it all went down...")
         else:
-            send_message(IRC_SOCKET, "That is incorrect. Let's see who really did it...")
+            messages.append("That is incorrect. Let's see who really did it...")
     else:
-        send_message(IRC_SOCKET, "No guesses were made.")
+        messages.append("No guesses were made.")
 
     # Now reveal the murderer
-    send_message(IRC_SOCKET, f"The Reveal: {reveal}")
+    messages.append(f"The Reveal: {reveal}")
+    return messages
 
-    game_state = None
-    last_mystery_time = time.time()
+# Class implementing a least-recently-used cache of Twitch users whose entries expire
+class UserCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # login -> (expires, user_info)
+        self.lock = threading.Lock()
 
-# Function to get user information using Twitch API
-def get_user_info(username):
-    refresh_access_token_if_needed()
-    url = 'https://api.twitch.tv/helix/users'
-    headers = {
-        'Authorization': f'Bearer {ACCESS_TOKEN}',
-        'Client-ID': TWITCH_CLIENT_ID
-    }
-    params = {
-        'login': username
-    }
-    response = requests.get(url, headers=headers, params=params)
-    data = response.json()
-    if 'data' in data and len(data['data']) > 0:
-        return data['data'][0]
-    else:
-        return None
+    def get(self, login):
+        with self.lock:
+            entry = self.entries.get(login)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[login]
+                return None
+            self.entries.move_to_end(login)
+            return entry[1]
 
-# Function to handle EventSub subscriptions
-def subscribe_to_eventsub():
-    refresh_access_token_if_needed()
-    url = 'https://api.twitch.tv/helix/eventsub/subscriptions'
-    headers = {
-        'Authorization': f'Bearer {ACCESS_TOKEN}',
-        'Client-ID': TWITCH_CLIENT_ID,
-        'Content-Type': 'application/json'
-    }
+    def put(self, login, user_info):
+        with self.lock:
+            self.entries[login] = (time.monotonic() + self.ttl, user_info)
+            self.entries.move_to_end(login)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+USER_CACHE = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# Class that gathers pending user lookups and resolves them with as few Helix calls as possible
+class UserLookupBatcher:
+    MAX_LOGINS_PER_CALL = 100  # Helix limit for /users
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = set()
+        self.condition = threading.Condition()
+        self.thread = None
 
-    # Unsubscribe from existing subscriptions
-    response = requests.get(url, headers=headers)
+    # Function to queue a login for lookup; never blocks on the API
+    def request(self, login):
+        with self.condition:
+            self.pending.add(login)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    # Function run by the lookup thread
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+            time.sleep(self.window)  # Let more logins arrive so they share the call
+            with self.condition:
+                logins = [login for login in self.pending if USER_CACHE.get(login) is None]
+                self.pending.clear()
+            for start in range(0, len(logins), self.MAX_LOGINS_PER_CALL):
+                try:
+                    get_users_info(logins[start:start + self.MAX_LOGINS_PER_CALL])
+                except Exception as e:
+                    print(f"Error looking up Twitch users: {e}")
+
+USER_LOOKUPS = UserLookupBatcher(USER_LOOKUP_BATCH_WINDOW)
+
+# Function to get information for up to 100 users with one Twitch API call; results are cached
+def get_users_info(usernames):
+    url = f'{TWITCH_API_BASE}/users'
+    params = [('login', username) for username in usernames]
+    response = helix_request('GET', url, params=params)
     data = response.json()
-    if 'data' in data:
-        for sub in data['data']:
-            sub_id = sub['id']
-            delete_url = f"{url}?id={sub_id}"
-            requests.delete(delete_url, headers=headers)
-
-    # Subscribe to channel.subscribe and channel.cheer events
-    event_types = ['channel.subscribe', 'channel.cheer']
-    for event_type in event_types:
+    users = {}
+    for user_info in data.get('data', []):
+        users[user_info['login']] = user_info
+        USER_CACHE.put(user_info['login'], user_info)
+    return users
+
+# Function to make EventSub subscriptions match the channels being played in, changing only what differs;
+# subscribes with the webhook transport unless given another transport and the token it needs. webhook_ready is an
+# event the caller sets once its webhook server is bound; without one the webhook is taken to be up already.
+def subscribe_to_eventsub(transport=None, access_token=None, webhook_ready=None):
+    if transport is None:
+        transport = {'method': 'webhook', 'callback': WEBHOOK_URL, 'secret': TWITCH_WEBHOOK_SECRET}
+    url = f'{TWITCH_API_BASE}/eventsub/subscriptions'
+    resolve_broadcaster_ids()
+    desired = {}
+    for game, (event_type, version) in itertools.product(list(GAMES.values()), EVENTSUB_EVENTS):
+        if game.broadcaster_id is None:
+            continue
         body = {
             'type': event_type,
-            'version': '1',
+            'version': version,
             'condition': {
-                'broadcaster_user_id': get_user_id(TWITCH_CHANNEL)
+                'broadcaster_user_id': game.broadcaster_id
             },
-            'transport': {
-                'method': 'webhook',
-                'callback': WEBHOOK_URL,
-                'secret': TWITCH_WEBHOOK_SECRET
-            }
+            'transport': transport
         }
-        response = requests.post(url, headers=headers, json=body)
-        print(f"Subscribed to {event_type}: {response.status_code}")
+        desired[subscription_key(body)] = body
 
-# Function to get user ID from username
-def get_user_id(username):
-    user_info = get_user_info(username)
-    if user_info:
-        return user_info['id']
-    else:
+    # Keep one working copy of each wanted subscription; delete the rest
+    existing = set()
+    stale = []
+    for sub in list_eventsub_subscriptions(url, access_token):
+        key = subscription_key(sub)
+        if key in desired and key not in existing and sub.get('status') in ('enabled', 'webhook_callback_verification_pending'):
+            existing.add(key)
+        else:
+            stale.append(sub['id'])
+    missing = [body for key, body in desired.items() if key not in existing]
+
+    # Create before deleting so no wanted event goes unsubscribed in between. Twitch checks a webhook callback
+    # as soon as the subscription is created, so the webhook has to be up by then.
+    if transport['method'] == 'webhook' and webhook_ready is not None:
+        webhook_ready.wait()
+    with concurrent.futures.ThreadPoolExecutor(EVENTSUB_CONCURRENCY) as pool:
+        created = sum(pool.map(lambda body: helix_request('POST', url, access_token, json=body).status_code == 202, missing))
+        deleted = sum(pool.map(lambda sub_id: helix_request('DELETE', url, access_token, params={'id': sub_id}).status_code == 204, stale))
+    print(f"EventSub subscriptions: {len(existing)} kept, {created} of {len(missing)} created, {deleted} of {len(stale)} deleted.")
+
+# Function to page through every EventSub subscription of the app
+def list_eventsub_subscriptions(url, access_token=None):
+    subscriptions = []
+    params = {}
+    while True:
+        response = helix_request('GET', url, access_token, params=params)
+        if response.status_code != 200:
+            raise RuntimeError(f"Could not list EventSub subscriptions: {response.status_code} {response.text}")
+        data = response.json()
+        subscriptions.extend(data.get('data', []))
+        cursor = data.get('pagination', {}).get('cursor')
+        if not cursor:
+            return subscriptions
+        params = {'after': cursor}
+
+# Function to get what identifies a subscription: its type, version, condition and callback or WebSocket session
+def subscription_key(subscription):
+    transport = subscription.get('transport', {})
+    condition = tuple(sorted((name, value) for name, value in subscription.get('condition', {}).items() if value))
+    destination = transport.get('callback') or transport.get('session_id')
+    return subscription['type'], subscription['version'], condition, transport.get('method'), destination
+
+# Function to look up the broadcaster IDs of all channels, 100 per Helix call
+def resolve_broadcaster_ids():
+    games = []
+    for game in list(GAMES.values()):
+        if game.broadcaster_id is not None:
+            continue
+        user_info = USER_CACHE.get(game.channel)
+        if user_info is not None and 'id' in user_info:
+            game.broadcaster_id = user_info['id']
+            GAMES_BY_BROADCASTER[game.broadcaster_id] = game
+        else:
+            games.append(game)
+    for start in range(0, len(games), UserLookupBatcher.MAX_LOGINS_PER_CALL):
+        batch = games[start:start + UserLookupBatcher.MAX_LOGINS_PER_CALL]
+        users = get_users_info([game.channel for game in batch])
+        for game in batch:
+            user_info = users.get(game.channel)
+            if user_info is None:
+                print(f"Could not find the Twitch user for #{game.channel}.")
+                continue
+            game.broadcaster_id = user_info['id']
+            GAMES_BY_BROADCASTER[game.broadcaster_id] = game
+
+# Class that remembers recently seen message IDs for a limited time
+class MessageDeduplicator:
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.seen_at = collections.OrderedDict()  # Message ID -> time first seen, oldest first
+        self.lock = threading.Lock()
+
+    # Function to record a message ID; returns True if it was already seen
+    def seen(self, message_id):
+        now = time.monotonic()
+        with self.lock:
+            while self.seen_at and next(iter(self.seen_at.values())) < now - self.ttl:
+                self.seen_at.popitem(last=False)
+            if message_id in self.seen_at:
+                return True
+            if len(self.seen_at) >= self.size:
+                self.seen_at.popitem(last=False)  # Make room only for a new ID, so a full set still catches the oldest
+            self.seen_at[message_id] = now
+            return False
+
+WEBHOOK_MESSAGE_IDS = MessageDeduplicator(WEBHOOK_MAX_AGE, WEBHOOK_DEDUP_SIZE)
+
+# Class that handles queued events on a worker thread, so the webhook can answer Twitch right away
+class EventWorker:
+    def __init__(self, handler):
+        self.handler = handler
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # Function to queue an event for the worker
+    def submit(self, event):
+        self.queue.put(event)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    # Function run by the worker thread
+    def run(self):
+        while True:
+            event = self.queue.get()
+            try:
+                self.handler(event)
+            except Exception as e:
+                print(f"Error handling event: {e}")
+
+# Function to turn an EventSub timestamp such as 2024-05-01T12:00:00.123456789Z into epoch seconds
+def parse_eventsub_timestamp(timestamp):
+    try:
+        whole, _, fraction = timestamp.rstrip('Z').partition('.')
+        return calendar.timegm(time.strptime(whole, '%Y-%m-%dT%H:%M:%S')) + float(f"0.{fraction or 0}")
+    except ValueError:
         return None
 
+# Function to check that an EventSub message is signed by Twitch and recent; returns an error status, or None if it is valid
+def check_webhook_message(message_id, timestamp, body, message_signature):
+    if not (message_id and timestamp and message_signature) or not verify_signature(TWITCH_WEBHOOK_SECRET, message_id, timestamp, body, message_signature):
+        print("Invalid signature.")
+        return 403
+    sent = parse_eventsub_timestamp(timestamp)
+    if sent is None or time.time() - sent > WEBHOOK_MAX_AGE:
+        print(f"Rejecting an EventSub message sent at {timestamp}.")
+        return 403
+    return None
+
+# Function to create the Flask app serving the webhook and /metrics; Flask is only imported here. Notifications go
+# to dispatch, EVENTS.submit unless another process routes them, such as the sharded coordinator.
+def create_app(dispatch=None):
+    from flask import Flask
+    flask_app = Flask(__name__)
+    flask_app.add_url_rule('/webhook', 'webhook', lambda: webhook(dispatch), methods=['POST'])
+    flask_app.add_url_rule('/metrics', view_func=metrics, methods=['GET'])
+    flask_app.add_url_rule('/debug/profile', view_func=profile, methods=['GET'])
+    return flask_app
+
 # Flask route to handle EventSub notifications
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    # Verify the message
+def webhook(dispatch=None):
+    with WEBHOOK_SECONDS.time():
+        return handle_webhook_request(dispatch or EVENTS.submit)
+
+# Function to verify an EventSub request and hand its event to dispatch; never waits on chat or the Twitch API
+def handle_webhook_request(dispatch):
+    from flask import request
     message_id = request.headers.get('Twitch-Eventsub-Message-Id')
     timestamp = request.headers.get('Twitch-Eventsub-Message-Timestamp')
     message_signature = request.headers.get('Twitch-Eventsub-Message-Signature')
     body = request.get_data().decode('utf-8')
 
-    if not verify_signature(TWITCH_WEBHOOK_SECRET, message_id, timestamp, body, message_signature):
-        print("Invalid signature.")
-        return '', 403
+    status = check_webhook_message(message_id, timestamp, body, message_signature)
+    if status is not None:
+        return '', status
 
     # Handle the message type
     message_type = request.headers.get('Twitch-Eventsub-Message-Type')
 
     if message_type == 'webhook_callback_verification':
-        challenge = request.json['challenge']
+        challenge = json.loads(body)['challenge']
         return challenge, 200
     elif message_type == 'notification':
-        event = request.json['event']
-        handle_event(event)
-        return '', 200
+        # Twitch retries with the same message ID when it doesn't hear back in time; handle each message once
+        if not WEBHOOK_MESSAGE_IDS.seen(message_id):
+            # The notification holds both the 'subscription' and the 'event' objects
+            dispatch(json.loads(body))
+        return '', 204
+    elif message_type == 'revocation':
+        print(f"Twitch revoked a subscription: {json.loads(body)['subscription']['type']}")
+        return '', 204
     else:
         return '', 400
 
+# Flask route to expose metrics for Prometheus to scrape
+def metrics():
+    from flask import Response
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Flask route for admins to sample every thread's stack for ?seconds=N (5 by default), answered with the samples
+# per stack in the collapsed format flame graph tools read; needs "Authorization: Bearer <ADMIN_TOKEN>"
+def profile():
+    from flask import request, Response
+    if ADMIN_TOKEN is None:
+        return '', 404
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'), f"Bearer {ADMIN_TOKEN}".encode('utf-8')):
+        return '', 401
+    try:
+        seconds = float(request.args.get('seconds', 5))
+    except ValueError:
+        return 'seconds must be a number\n', 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return f'seconds must be more than 0 and at most {PROFILE_MAX_SECONDS}\n', 400
+    result = PROFILER.profile(seconds)
+    if result is None:
+        return 'A profile is already running\n', 409
+    samples, stacks = result
+    body = ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    return Response(body, mimetype='text/plain', headers={'X-Profile-Samples': str(samples)})
+
 # Function to verify the signature of the EventSub message
 def verify_signature(secret, message_id, timestamp, body, expected_signature):
     hmac_message = message_id + timestamp + body
@@ -365,36 +2887,443 @@ def verify_signature(secret, message_id, timestamp, body, expected_signature):
 
 # Function to handle EventSub events
 def handle_event(event):
-    global cooldown
+    game = GAMES_BY_BROADCASTER.get(event['event'].get('broadcaster_user_id'))
+    if game is None:
+        game = GAMES.get(event['event'].get('broadcaster_user_login'))
+    if game is None:
+        print(f"Ignoring an event for an unknown channel: {event['event'].get('broadcaster_user_login')}")
+        return
     event_type = event['subscription']['type']
+    with TRACER.span('event', game.mystery_id, type=event_type, channel=game.channel):
+        apply_event(game, event_type, event)
+
+# Function to thank the viewer behind an EventSub event and shorten the cooldown
+def apply_event(game, event_type, event):
     if event_type == 'channel.subscribe':
         user_name = event['event']['user_name']
-        send_message(IRC_SOCKET, f"Thank you @{user_name} for subscribing!")
+        game.say(f"Thank you @{user_name} for subscribing!", PRIORITY_SYSTEM)
         # Reduce the cooldown by 60 seconds per subscription
         cooldown_reduction = 60
-        cooldown = max(60, cooldown - cooldown_reduction)
-        send_message(IRC_SOCKET, f"The cooldown for the next mystery has been reduced by {cooldown_reduction} seconds!")
+        game.reduce_cooldown(cooldown_reduction)
+        game.say(f"The cooldown for the next mystery has been reduced by {cooldown_reduction} seconds!", PRIORITY_SYSTEM)
     elif event_type == 'channel.cheer':
         user_name = event['event']['user_name']
         bits = event['event']['bits']
-        send_message(IRC_SOCKET, f"Thank you @{user_name} for cheering {bits} bits!")
+        game.say(f"Thank you @{user_name} for cheering {bits} bits!", PRIORITY_SYSTEM)
         # Reduce the cooldown by 10 seconds per 100 bits
         cooldown_reduction = int(bits / 100) * 10
         if cooldown_reduction > 0:
-            cooldown = max(60, cooldown - cooldown_reduction)
-            send_message(IRC_SOCKET, f"The cooldown for the next mystery has been reduced by {cooldown_reduction} seconds!")
+            game.reduce_cooldown(cooldown_reduction)
+            game.say(f"The cooldown for the next mystery has been reduced by {cooldown_reduction} seconds!", PRIORITY_SYSTEM)
+
+EVENTS = EventWorker(handle_event)
+
+# Class implementing the client side of a WebSocket connection (RFC 6455), enough for EventSub
+class WebSocketConnection:
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    def __init__(self, url, timeout=EVENTSUB_WELCOME_TIMEOUT):
+        parts = urlparse(url)
+        secure = parts.scheme == 'wss'
+        self.sock = socket.create_connection((parts.hostname, parts.port or (443 if secure else 80)), timeout=timeout)
+        if secure:
+            self.sock = ssl.create_default_context().wrap_socket(self.sock, server_hostname=parts.hostname)
+        self.buffer = bytearray()
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        self.sock.sendall((f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                           f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode('ascii'))
+        while b'\r\n\r\n' not in self.buffer:
+            self.fill()
+        head, _, rest = bytes(self.buffer).partition(b'\r\n\r\n')
+        self.buffer = bytearray(rest)
+        status, *header_lines = head.decode('latin-1').split('\r\n')
+        headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(':') for line in header_lines)}
+        accept = base64.b64encode(hashlib.sha1((key + self.GUID).encode('ascii')).digest()).decode('ascii')
+        if status.split(' ')[1:2] != ['101'] or headers.get('sec-websocket-accept') != accept:
+            self.sock.close()
+            raise ConnectionError(f"WebSocket handshake with {parts.netloc} failed: {status}")
+
+    # Function to read more bytes from the socket into the buffer
+    def fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("WebSocket connection closed")
+        self.buffer += data
 
-# Function to run the Flask app
-def run_flask_app():
-    app.run(host='0.0.0.0', port=8080)
+    # Function to take exactly count bytes from the connection
+    def read_exact(self, count):
+        while len(self.buffer) < count:
+            self.fill()
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return data
+
+    # Function to read one frame; returns (final, opcode, payload)
+    def read_frame(self):
+        first, second = self.read_exact(2)
+        length = second & 0x7f
+        if length == 126:
+            length = int.from_bytes(self.read_exact(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(self.read_exact(8), 'big')
+        mask = self.read_exact(4) if second & 0x80 else None
+        payload = self.read_exact(length)
+        if mask:
+            payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        return first & 0x80, first & 0x0f, payload
+
+    # Function to send one frame; clients must mask everything they send
+    def send_frame(self, opcode, payload=b''):
+        header = bytearray([0x80 | opcode])
+        if len(payload) < 126:
+            header.append(0x80 | len(payload))
+        elif len(payload) < 65536:
+            header.append(0x80 | 126)
+            header += len(payload).to_bytes(2, 'big')
+        else:
+            header.append(0x80 | 127)
+            header += len(payload).to_bytes(8, 'big')
+        mask = os.urandom(4)
+        self.sock.sendall(bytes(header) + mask + bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload)))
+
+    # Function to receive the next text message, answering pings on the way; returns None once the server closes
+    def recv(self):
+        message = bytearray()
+        while True:
+            final, opcode, payload = self.read_frame()
+            if opcode == 0x9:
+                self.send_frame(0xA, payload)
+            elif opcode == 0x8:
+                with contextlib.suppress(OSError):
+                    self.send_frame(0x8, payload[:2])
+                return None
+            elif opcode != 0xA:
+                message += payload
+                if final:
+                    return message.decode('utf-8')
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        with contextlib.suppress(OSError):
+            self.send_frame(0x8, (1000).to_bytes(2, 'big'))
+        self.sock.close()
+
+# Class that receives EventSub notifications over a WebSocket session instead of the webhook
+class EventSubWebSocket:
+    def __init__(self, url=EVENTSUB_WEBSOCKET_URL):
+        self.url = url
+        self.connection = None
+        self.session_id = None
+
+    # Function to connect and wait for session_welcome; returns the connection
+    def connect(self, url):
+        connection = WebSocketConnection(url)
+        try:
+            message = json.loads(connection.recv() or '{}')
+            if message.get('metadata', {}).get('message_type') != 'session_welcome':
+                raise ConnectionError(f"Expected session_welcome from {url}")
+        except Exception:
+            connection.close()
+            raise
+        session = message['payload']['session']
+        self.session_id = session['id']
+        # Twitch sends something at least every keepalive period; silence past that means the session is dead
+        connection.settimeout(session['keepalive_timeout_seconds'] + 5)
+        return connection
+
+    # Function run by the WebSocket thread; a new session needs new subscriptions, so they are made after each welcome
+    def run(self):
+        backoff = 1
+        while True:
+            try:
+                self.connection = self.connect(self.url)
+                print(f"EventSub WebSocket session {self.session_id} started.")
+                transport = {'method': 'websocket', 'session_id': self.session_id}
+                threading.Thread(target=subscribe_to_eventsub, args=(transport, TWITCH_USER_ACCESS_TOKEN), daemon=True).start()
+                backoff = 1
+                self.receive()
+            except (OSError, ValueError, KeyError) as e:
+                print(f"EventSub WebSocket error: {e}")
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            delay = random.uniform(0, backoff)
+            print(f"Reconnecting to EventSub in {delay:.1f} seconds.")
+            time.sleep(delay)
+            backoff = min(backoff * 2, 60)
+
+    # Function to handle messages until the session ends
+    def receive(self):
+        while True:
+            text = self.connection.recv()
+            if text is None:
+                print("EventSub WebSocket closed by Twitch.")
+                return
+            self.handle(json.loads(text))
+
+    # Function to act on one EventSub message
+    def handle(self, message):
+        metadata = message['metadata']
+        message_type = metadata['message_type']
+        if message_type == 'notification':
+            # Reconnects can deliver a message on both connections; handle each message once
+            if not WEBHOOK_MESSAGE_IDS.seen(metadata['message_id']):
+                EVENTS.submit(message['payload'])
+        elif message_type == 'session_reconnect':
+            self.reconnect(message['payload']['session']['reconnect_url'])
+        elif message_type == 'revocation':
+            print(f"Twitch revoked a subscription: {message['payload']['subscription']['type']}")
+
+    # Function to move to the URL given by session_reconnect; the subscriptions carry over to it
+    def reconnect(self, url):
+        old = self.connection
+        self.connection = self.connect(url)
+        # Twitch keeps using the old connection until the new one is welcomed, then closes it; handle what is left
+        old.settimeout(EVENTSUB_WELCOME_TIMEOUT)
+        try:
+            while True:
+                text = old.recv()
+                if text is None:
+                    break
+                self.handle(json.loads(text))
+        except OSError:
+            pass
+        old.close()
+        print(f"EventSub WebSocket reconnected to {url}.")
+
+# Function to start receiving EventSub notifications with the configured transport
+def start_eventsub(webhook_ready=None):
+    if EVENTSUB_TRANSPORT == 'websocket':
+        threading.Thread(target=EventSubWebSocket().run, daemon=True).start()
+    else:
+        subscribe_to_eventsub(webhook_ready=webhook_ready)
+
+# Function to start a coroutine in the background of the asyncio engine
+def spawn(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    ASYNC_TASKS.add(task)
+    task.add_done_callback(ASYNC_TASKS.discard)
+    return task
+
+# Class that lets the outbound scheduler write to the asyncio engine's connection
+class AsyncIRCSocket:
+    def __init__(self, writer):
+        self.loop = asyncio.get_running_loop()
+        self.writer = writer
+
+    def send(self, data):
+        if self.writer.is_closing():
+            raise ConnectionResetError("The IRC connection is closed")
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+        return len(data)
+
+    def shutdown(self, how):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+# Function to connect to Twitch IRC with asyncio streams
+async def async_start_chat():
+    access_token = await asyncio.to_thread(APP_TOKEN.get)
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(TWITCH_IRC_SERVER, TWITCH_IRC_PORT), HTTP_TIMEOUT[0])
+    writer.write("CAP REQ :twitch.tv/tags\r\n".encode('utf-8'))
+    writer.write(f"PASS oauth:{access_token}\r\n".encode('utf-8'))
+    writer.write(f"NICK {TWITCH_BOT_USERNAME}\r\n".encode('utf-8'))
+    await writer.drain()
+    IRC_SOCKET.attach(AsyncIRCSocket(writer))
+    spawn(asyncio.to_thread(join_channels, IRC_SOCKET, list(GAMES)))
+    print("Connected to Twitch IRC successfully.")
+    return reader, writer
+
+# Coroutine to connect to Twitch chat and receive messages, reconnecting whenever the connection can't be made,
+# closes, fails or stalls
+async def async_receive_messages():
+    attempt = 0
+    while True:
+        try:
+            reader, writer = await async_start_chat()
+        except Exception as e:
+            print(f"Error connecting to Twitch IRC: {e}")
+            await asyncio.sleep(reconnect_delay(attempt))
+            attempt += 1
+            continue
+        sock = IRC_SOCKET.sock
+        reason, healthy = await async_read_until_disconnected(reader, writer)
+        writer.close()
+        if IRC_SOCKET.detach(sock, reason):
+            print(f"Lost the Twitch IRC connection ({reason}); reconnecting.")
+        attempt = 0 if healthy else attempt + 1
+        await asyncio.sleep(reconnect_delay(attempt))
+
+# Coroutine to read chat from one connection until it is lost; returns why, and whether any line arrived
+async def async_read_until_disconnected(reader, writer):
+    framer = IRCLineFramer()
+    access_token = APP_TOKEN.token
+    healthy = False
+    pinged = False
+    while True:
+        try:
+            data = await asyncio.wait_for(reader.read(IRC_RECV_SIZE), IRC_PONG_TIMEOUT if pinged else IRC_PING_INTERVAL)
+        except asyncio.TimeoutError:
+            if pinged:
+                print("Twitch IRC did not answer our PING.")
+                return 'stalled', healthy
+            pinged = True
+            writer.write("PING :tmi.twitch.tv\r\n".encode('utf-8'))
+            continue
+        except Exception as e:
+            print(f"Error receiving messages: {e}")
+            return 'error', healthy
+        if not data:
+            print("Connection closed by Twitch IRC.")
+            return 'closed', healthy
+        healthy = True
+        pinged = False
+        IRC_SOCKET.received()
+        for line in framer.feed(data):
+            check = check_connection_line(line, access_token)
+            if check is None:
+                async_process_chat_message(line)
+            elif check.startswith('PONG'):
+                writer.write(f"{check}\r\n".encode('utf-8'))
+            else:
+                return check, healthy and check != 'auth'
+
+# Function to process chat messages without blocking the event loop; the games' phases run on the scheduler thread
+# with either engine, so Game.cancel() stops them and per-channel timings apply
+def async_process_chat_message(line):
+    handle_chat_line(line, schedule_mystery)
+
+# Main coroutine of the asyncio engine; main() starts everything else
+async def async_main():
+    receiving = spawn(async_receive_messages())
+    await asyncio.to_thread(IRC_SOCKET.connected.wait)  # A failed connect is retried until it works
+    STARTUP.done('chat')
+    await receiving
+
+# Function to bind a server for a Flask app, with waitress or, when it isn't installed, Flask's threaded server;
+# returns the function that serves requests. The webhook needs waitress in production: Flask's server is not
+# built for Twitch's notification rate, so falling back to it is reported on stderr.
+def bind_webhook_server(flask_app, port):
+    try:
+        from waitress import create_server
+    except ImportError:
+        print("WARNING: waitress is not installed, so the webhook is served by Flask's development server, which is "
+              "not meant for production and may fall behind Twitch's notifications. Install it with "
+              "'pip install waitress'.", file=sys.stderr)
+        from werkzeug.serving import make_server
+        return make_server('0.0.0.0', port, flask_app, threaded=True).serve_forever
+    return create_server(flask_app, host='0.0.0.0', port=port, threads=WEBHOOK_THREADS).run
+
+# Function to serve a Flask app until the process exits
+def serve_webhooks(flask_app, port):
+    bind_webhook_server(flask_app, port)()
+
+# Function to start serving the webhook and /metrics; returns once the port is bound, then sets ready if given
+def start_webhook_server(ready=None):
+    threading.Thread(target=bind_webhook_server(create_app(), WEBHOOK_PORT)).start()
+    if ready is not None:
+        ready.set()
+
+# Function to read chat on a thread of its own; returns once the first connection is up, however many tries it takes
+def start_chat(daemon=False):
+    threading.Thread(target=receive_messages, daemon=daemon).start()
+    IRC_SOCKET.connected.wait()
+
+# Class that runs the startup phases on threads of their own, each as soon as the phases it needs are done, and
+# records when each finished. The bot is ready for chat once Twitch has confirmed joining every channel.
+class Startup:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = {}  # Phase -> seconds after the start it finished
+        self.ended = {}  # Phase -> event set once it ended, whether or not it succeeded
+        self.pending_joins = set()
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+
+    # Function to start the clock and say which channels have to be joined before the bot is ready
+    def begin(self, channels):
+        self.started = time.monotonic()
+        with self.lock:
+            self.pending_joins = set(channels)
+
+    # Function to declare a phase run elsewhere, which calls done() when it finishes, so others can run after it
+    def expect(self, phase):
+        with self.lock:
+            return self.ended.setdefault(phase, threading.Event())
+
+    # Function to run a phase on a thread once the phases named in after have ended
+    def run(self, phase, function, after=()):
+        ended = self.expect(phase)
+        waits = [self.ended[name] for name in after if name in self.ended]
+
+        def target():
+            for event in waits:
+                event.wait()
+            try:
+                function()
+                self.done(phase)
+            except Exception as e:
+                print(f"Startup phase '{phase}' failed: {e}")
+            finally:
+                ended.set()
+
+        threading.Thread(target=target, name=f"startup-{phase}").start()
+
+    # Function to record that a phase finished
+    def done(self, phase):
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            self.finished[phase] = elapsed
+            ended = self.ended.get(phase)
+        STARTUP_SECONDS.set(elapsed, (phase,))
+        if ended is not None:
+            ended.set()
+        print(f"Startup: {phase} done after {elapsed:.2f} seconds.")
+
+    # Function called for the JOIN Twitch sends back for each channel the bot joined
+    def joined(self, nick, channel):
+        if nick != TWITCH_BOT_USERNAME.lower():
+            return
+        with self.lock:
+            if not self.pending_joins or self.ready.is_set():
+                return
+            self.pending_joins.discard(channel)
+            if self.pending_joins:
+                return
+            self.ready.set()
+        self.done('ready')
+        print("Ready for chat.")
+
+STARTUP = Startup()
 
 # Main function
 def main():
     try:
-        connect_to_twitch()
-        threading.Thread(target=receive_messages).start()
-        threading.Thread(target=run_flask_app).start()
-        subscribe_to_eventsub()
+        for channel in TWITCH_CHANNELS:
+            add_game(channel)
+        STARTUP.begin(list(GAMES))
+        TRACER.start()
+        # The phases only wait for what they need: chat and EventSub both wait for the token on their own, what
+        # resumed games say is queued until chat is connected, and EventSub only waits for the webhook to create
+        # subscriptions. Importing Flask for the webhook takes a while, so it waits until chat is connected.
+        STARTUP.run('token', lambda: APP_TOKEN.refresh('startup').result())
+        STARTUP.run('mystery pool', MYSTERY_POOL.start)
+        if LEADERBOARD_DB_FILE:
+            STARTUP.run('leaderboard', LEADERBOARD.start)
+        if GAME_JOURNAL_FILE:
+            STARTUP.run('journal', GAME_JOURNAL.start)
+        STARTUP.run('resume', resume_games, after=('journal',))
+        webhook_ready = threading.Event()
+        STARTUP.run('eventsub', lambda: start_eventsub(webhook_ready))
+        if USE_ASYNC_ENGINE:
+            STARTUP.expect('chat')  # Connected by async_main() on the event loop
+        else:
+            STARTUP.run('chat', start_chat)
+        STARTUP.run('webhook', lambda: start_webhook_server(webhook_ready), after=('chat',))
+        if USE_ASYNC_ENGINE:
+            asyncio.run(async_main())
     except Exception as e:
         print(f"An error occurred: {e}")
 
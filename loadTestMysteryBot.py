@@ -0,0 +1,558 @@
+import argparse
+import base64
+import builtins
+import collections
+import contextlib
+import hashlib
+import http.client
+import io
+import json
+import random
+import socket
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+
+import basicMysteryVersionForDevpost as basic
+import benchmarkMysteryBot as bench
+import enhancedMysteryVersionWithEventsub as enhanced
+
+# Load test configuration
+LOAD_CHANNEL = "loadtestchannel"
+LOAD_RATE = 1000  # Chat lines per second sent while the mystery runs
+LOAD_TIME_SCALE = 0.05  # Shrinks every game timing, so a mystery takes about 5 seconds instead of 100
+LOAD_API_LATENCY = 0.05  # Seconds added to every fake Helix, OAuth and OpenAI response
+LOAD_API_ERROR_RATE = 0.0  # Share of fake API calls answered with a 503
+LOAD_TOKENS_PER_SEC = 2000  # Generation speed of the fake OpenAI endpoint
+LOAD_TIMEOUT = 120  # Give up on a mystery that has not been revealed after this many seconds
+LOAD_DRAIN = 2  # Seconds to wait for the bot to catch up after the flood stops
+RECEIVED_PREFIX = "Message received from "
+
+
+# Fake Twitch Helix, Twitch OAuth and OpenAI endpoints on one local server, with injectable latency and errors
+class FakeServicesHandler(bench.FakeOpenAIHandler):
+    latency = LOAD_API_LATENCY
+    error_rate = LOAD_API_ERROR_RATE
+    tokens_per_sec = LOAD_TOKENS_PER_SEC
+    subscriptions = {}  # Subscription ID -> subscription, shared by every request
+    calls = collections.Counter()  # "METHOD /path" -> number of calls
+    errors = collections.Counter()  # "METHOD /path" -> number of injected errors
+    lock = threading.Lock()
+
+    # Function to count a call, add the configured latency and decide whether it fails; returns the parsed URL
+    def begin(self):
+        url = urllib.parse.urlparse(self.path)
+        endpoint = f"{self.command} {url.path}"
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls[endpoint] += 1
+            failed = random.random() < self.error_rate
+            if failed:
+                self.errors[endpoint] += 1
+        if failed:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_json(503, {'error': 'Service Unavailable', 'status': 503, 'message': 'injected error'})
+            return None
+        return url
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = self.begin()
+        if url is None:
+            return
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == '/helix/users':
+            users = [{'id': str(zlib.crc32(login.lower().encode('utf-8'))), 'login': login.lower(), 'display_name': login.title()}
+                     for login in query.get('login', [])]
+            self.send_json(200, {'data': users})
+        elif url.path == '/helix/eventsub/subscriptions':
+            # Pages of 100, with the offset of the next page as the cursor
+            offset = int(query.get('after', ['0'])[0])
+            with self.lock:
+                subscriptions = list(self.subscriptions.values())
+            page = subscriptions[offset:offset + 100]
+            pagination = {'cursor': str(offset + 100)} if offset + 100 < len(subscriptions) else {}
+            self.send_json(200, {'data': page, 'total': len(subscriptions), 'pagination': pagination})
+        else:
+            self.send_json(404, {'error': 'Not Found', 'status': 404})
+
+    def do_POST(self):
+        url = self.begin()
+        if url is None:
+            return
+        if url.path == '/oauth2/token':
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_json(200, {'access_token': 'loadtest', 'expires_in': 3600, 'token_type': 'bearer'})
+        elif url.path == '/helix/eventsub/subscriptions':
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            subscription = dict(body, id=str(uuid.uuid4()), status='webhook_callback_verification_pending')
+            subscription['transport'] = {key: value for key, value in body.get('transport', {}).items() if key != 'secret'}
+            key = enhanced.subscription_key(subscription)
+            with self.lock:
+                duplicate = any(enhanced.subscription_key(existing) == key for existing in self.subscriptions.values())
+                if not duplicate:
+                    self.subscriptions[subscription['id']] = subscription
+            if duplicate:
+                self.send_json(409, {'error': 'Conflict', 'status': 409, 'message': 'subscription already exists'})
+            else:
+                self.send_json(202, {'data': [subscription], 'total': len(self.subscriptions)})
+        elif url.path == '/v1/chat/completions':
+            super().do_POST()
+        else:
+            self.send_json(404, {'error': 'Not Found', 'status': 404})
+
+    def do_DELETE(self):
+        url = self.begin()
+        if url is None:
+            return
+        with self.lock:
+            removed = self.subscriptions.pop(urllib.parse.parse_qs(url.query).get('id', [''])[0], None)
+        self.send_response(204 if removed else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+# Function to read chat messages to replay from a file; accepts plain text or raw IRC PRIVMSG lines
+def load_replay(path):
+    texts = []
+    with open(path, encoding='utf-8') as replay:
+        for line in replay:
+            line = line.rstrip('\r\n')
+            if line.startswith(('@', ':')):
+                message = enhanced.parse_irc_line(line)
+                if message.command != 'PRIVMSG':
+                    continue
+                line = message.text
+            if line and line.lower() != '!mystery':
+                texts.append(line)
+    return texts
+
+
+# Chat traffic for one channel; each line comes from its own chatter, u<sequence>, so the bot's log shows
+# exactly which line it processed and when
+class ChatLoad:
+    def __init__(self, server, channel, texts, rate):
+        self.server = server
+        self.channel = channel
+        self.texts = texts
+        self.rate = rate
+        self.sent = []  # Send time of each line, indexed by its sequence number
+        self.received = {}  # Sequence number -> (processed time, whether the bot was taking guesses)
+        self.stopped = threading.Event()
+
+    # Function to send chat at the configured rate until stopped
+    def run(self):
+        batch = max(1, self.rate // 100)
+        start = time.time()
+        while not self.stopped.is_set():
+            payload = []
+            now = time.time()
+            for _ in range(batch):
+                sequence = len(self.sent)
+                text = self.texts[sequence % len(self.texts)]
+                payload.append(f":u{sequence}!u{sequence}@u{sequence}.tmi.twitch.tv PRIVMSG #{self.channel} :{text}\r\n")
+                self.sent.append(now)
+            self.server.send_chat(self.channel, "".join(payload).encode('utf-8'))
+            delay = start + len(self.sent) / self.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    # Function to replace a bot module's print, so every processed chat line is timed without changing the bot
+    def hook(self, module, is_guessing, verbose=False):
+        def hooked_print(*args, **kwargs):
+            text = args[0] if args and isinstance(args[0], str) else ''
+            if text.startswith(RECEIVED_PREFIX + 'u'):
+                sequence = text[len(RECEIVED_PREFIX) + 1:].split(' ', 1)[0].rstrip(':')
+                if sequence.isdigit():
+                    self.received[int(sequence)] = (time.time(), is_guessing())
+                    return
+            if verbose:
+                builtins.print(*args, **kwargs)
+        module.print = hooked_print
+
+
+# Function to start the basic bot against the fake services
+def start_basic(server, api_url, time_scale):
+    basic.TWITCH_IRC_SERVER = '127.0.0.1'
+    basic.TWITCH_IRC_PORT = server.port
+    basic.TWITCH_CHANNEL = LOAD_CHANNEL
+    basic.OPENAI_API_URL = f"{api_url}/v1/chat/completions"
+    basic.TIME_SCALE = time_scale
+    sock = basic.connect_to_twitch()
+    threading.Thread(target=basic.receive_messages, args=(sock,), daemon=True).start()
+    return lambda: basic.game_state == 'guessing'
+
+
+# Function to start the enhanced bot against the fake services, following the start-up of its main()
+def start_enhanced(server, api_url, time_scale):
+    enhanced.TWITCH_IRC_SERVER = '127.0.0.1'
+    enhanced.TWITCH_IRC_PORT = server.port
+    enhanced.TWITCH_AUTH_URL = f"{api_url}/oauth2/token"
+    enhanced.TWITCH_API_BASE = f"{api_url}/helix"
+    enhanced.OPENAI_API_URL = f"{api_url}/v1/chat/completions"
+    enhanced.TIME_SCALE = time_scale
+    # The chat rate limit isn't scaled, so leader posts would hold back the reveal; the basic bot has none either
+    enhanced.LEADER_UPDATE_INTERVAL = 0
+    enhanced.TWITCH_CHANNELS = [LOAD_CHANNEL]
+    game = enhanced.add_game(LOAD_CHANNEL)
+    enhanced.APP_TOKEN.get()
+    enhanced.subscribe_to_eventsub()
+    enhanced.start_chat(daemon=True)
+    return lambda: game.state == 'guessing'
+
+
+# Function to find when the bot first sent a chat message starting with some text
+def first_message_time(server, prefix, after=0.0):
+    with server.condition:
+        return next((sent for sent, _, text in server.bot_messages if sent >= after and text.startswith(prefix)), None)
+
+
+# Function to percentile a sorted list
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+# Function to run one mystery under chat load and return its measurements
+# The servers are left running for the caller to close: the basic bot spins on a closed connection, which
+# would skew whatever runs after it
+def run_load_test(name, start_bot, texts, rate, time_scale, servers, verbose=False):
+    server = bench.FakeIRCServer()
+    api = bench.start_http_server(FakeServicesHandler)
+    api_url = f"http://127.0.0.1:{api.server_address[1]}"
+    servers.append((server, api))
+    FakeServicesHandler.calls.clear()
+    FakeServicesHandler.errors.clear()
+    load = ChatLoad(server, LOAD_CHANNEL, texts, rate)
+    module = basic if start_bot is start_basic else enhanced
+    is_guessing = None
+
+    # The hook has to be in place before the bot starts printing
+    load.hook(module, lambda: is_guessing(), verbose)
+    is_guessing = start_bot(server, api_url, time_scale)
+    if not server.wait_for_joins([LOAD_CHANNEL], timeout=10):
+        raise RuntimeError(f"The {name} bot did not join #{LOAD_CHANNEL}")
+
+    flood = threading.Thread(target=load.run, daemon=True)
+    flood.start()
+    started = time.time()
+    server.send_chat(LOAD_CHANNEL, f":starter!starter@starter.tmi.twitch.tv PRIVMSG #{LOAD_CHANNEL} :!mystery\r\n".encode('utf-8'))
+    revealed = server.wait_for_message(LOAD_CHANNEL, "The Reveal:", timeout=LOAD_TIMEOUT)
+    load.stopped.set()
+    flood.join()
+    time.sleep(LOAD_DRAIN)
+    finished = time.time()
+    module.print = builtins.print
+
+    # Guesses are lines sent while the bot was taking them; a late guess was processed after the window closed
+    window_open = first_message_time(server, "Guess who", started)
+    window_close = window_open and next((sent for sent, _, text in server.bot_messages if sent > window_open), None)
+    guesses = [sequence for sequence, sent in enumerate(load.sent)
+               if window_open and window_close and window_open <= sent < window_close]
+    lags = sorted(received - load.sent[sequence] for sequence, (received, _) in load.received.items())
+    bot_messages = [(sent, text) for sent, _, text in server.bot_messages if sent >= started]
+    send_span = bot_messages[-1][0] - bot_messages[0][0] if len(bot_messages) > 1 else 0.0
+    first_section = first_message_time(server, "Backstory:", started)
+    reveal = first_message_time(server, "The Reveal:", started)
+    return {
+        'bot': name,
+        'lines_sent': len(load.sent),
+        'lines_processed': len(load.received),
+        'dropped_lines': len(load.sent) - len(load.received),
+        'lag_p50_ms': 1000 * percentile(lags, 0.5),
+        'lag_p99_ms': 1000 * percentile(lags, 0.99),
+        'lag_max_ms': 1000 * (lags[-1] if lags else 0.0),
+        'guesses_sent': len(guesses),
+        'guesses_dropped': sum(sequence not in load.received for sequence in guesses),
+        'guesses_late': sum(sequence in load.received and not load.received[sequence][1] for sequence in guesses),
+        'bot_messages': len(bot_messages),
+        'bot_messages_per_sec': (len(bot_messages) - 1) / send_span if send_span else 0.0,
+        'bot_bytes': sum(len(text.encode('utf-8')) for _, text in bot_messages),
+        'first_section_s': first_section - started if first_section else None,
+        'mystery_s': reveal - started if revealed and reveal else None,
+        'elapsed_s': finished - started,
+        'api_calls': dict(FakeServicesHandler.calls),
+        'api_errors': dict(FakeServicesHandler.errors),
+    }
+
+
+# Function to print the measurements of each bot side by side
+def print_report(results, rate, time_scale):
+    expected = (4 * enhanced.PHASE_DELAY + enhanced.GUESS_WINDOW) * time_scale
+    print(f"{rate} chat lines/s, TIME_SCALE {time_scale} (section delays and guess window add up to {expected:.1f}s), "
+          f"API latency {FakeServicesHandler.latency * 1000:.0f}ms, API error rate {FakeServicesHandler.error_rate:.0%}")
+    rows = [
+        ('chat lines sent', 'lines_sent', '{:d}'),
+        ('chat lines processed', 'lines_processed', '{:d}'),
+        ('chat lines dropped', 'dropped_lines', '{:d}'),
+        ('receive lag p50 ms', 'lag_p50_ms', '{:.1f}'),
+        ('receive lag p99 ms', 'lag_p99_ms', '{:.1f}'),
+        ('receive lag max ms', 'lag_max_ms', '{:.1f}'),
+        ('guesses sent', 'guesses_sent', '{:d}'),
+        ('guesses dropped', 'guesses_dropped', '{:d}'),
+        ('guesses late', 'guesses_late', '{:d}'),
+        ('bot messages', 'bot_messages', '{:d}'),
+        ('bot messages/s', 'bot_messages_per_sec', '{:.2f}'),
+        ('bot bytes', 'bot_bytes', '{:d}'),
+        ('first section s', 'first_section_s', '{:.2f}'),
+        ('whole mystery s', 'mystery_s', '{:.2f}'),
+    ]
+    print(f"{'':<22}" + "".join(f"{result['bot']:>12}" for result in results))
+    for label, key, form in rows:
+        cells = [form.format(result[key]) if result[key] is not None else 'n/a' for result in results]
+        print(f"{label:<22}" + "".join(f"{cell:>12}" for cell in cells))
+    for result in results:
+        calls = ", ".join(f"{endpoint} x{count}" + (f" ({result['api_errors'][endpoint]} failed)" if endpoint in result['api_errors'] else "")
+                          for endpoint, count in sorted(result['api_calls'].items()))
+        print(f"{result['bot']} API calls: {calls or 'none'}")
+
+
+# Function to time EventSub reconciliation for many channels: a cold start, a restart with nothing to change,
+# and a restart after channels were swapped
+def run_reconcile_test(channel_count):
+    api = bench.start_http_server(FakeServicesHandler)
+    api_url = f"http://127.0.0.1:{api.server_address[1]}"
+    enhanced.TWITCH_AUTH_URL = f"{api_url}/oauth2/token"
+    enhanced.TWITCH_API_BASE = f"{api_url}/helix"
+    FakeServicesHandler.subscriptions.clear()
+    channels = [f"channel{index}" for index in range(channel_count)]
+    swapped = max(1, channel_count // 10)
+    steps = [
+        ('cold start', channels),
+        ('restart, no changes', channels),
+        (f'restart, {swapped} channels swapped', channels[swapped:] + [f"newchannel{index}" for index in range(swapped)]),
+    ]
+    print(f"EventSub reconciliation for {channel_count} channels, {len(enhanced.EVENTSUB_EVENTS)} subscriptions each, "
+          f"API latency {FakeServicesHandler.latency * 1000:.0f}ms")
+    for name, step_channels in steps:
+        for channel in list(enhanced.GAMES):
+            enhanced.remove_game(channel)
+        for channel in step_channels:
+            enhanced.add_game(channel)
+        FakeServicesHandler.calls.clear()
+        start = time.time()
+        enhanced.subscribe_to_eventsub()
+        elapsed = time.time() - start
+        calls = ", ".join(f"{endpoint} x{count}" for endpoint, count in sorted(FakeServicesHandler.calls.items()))
+        print(f"  {name}: {elapsed:.2f}s; {calls}")
+    api.shutdown()
+
+
+# Fake EventSub WebSocket server: welcomes each session, sends keepalives and notifications, and can move a
+# session to a new connection with session_reconnect the way Twitch does
+class FakeEventSubServer:
+    def __init__(self, keepalive=10):
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        self.url = f"ws://127.0.0.1:{self.port}/ws"
+        self.keepalive = keepalive
+        self.session_id = str(uuid.uuid4())
+        self.active = None  # Connection that notifications are sent on
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.welcomed = threading.Condition(self.lock)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    # Function to accept clients and complete the WebSocket handshake
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            request = b""
+            while b"\r\n\r\n" not in request:
+                request += client.recv(4096)
+            key = next(line.split(b":", 1)[1].strip() for line in request.split(b"\r\n") if line.lower().startswith(b"sec-websocket-key:"))
+            accept = base64.b64encode(hashlib.sha1(key + enhanced.WebSocketConnection.GUID.encode('ascii')).digest())
+            client.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                           b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+            threading.Thread(target=self.discard, args=(client,), daemon=True).start()
+            with self.lock:
+                old = self.active
+                self.send(client, 'session_welcome', {'session': {'id': self.session_id, 'status': 'connected',
+                                                                  'keepalive_timeout_seconds': self.keepalive}})
+                self.active = client
+                self.connections += 1
+                self.welcomed.notify_all()
+            if old is not None:
+                # Twitch closes the old connection once the new one is welcomed
+                with contextlib.suppress(OSError):
+                    old.sendall(b"\x88\x02\x0f\xa0")  # Close frame, status 4000
+                    old.close()
+
+    # Function to read and ignore client frames (pongs, closes) so the client never blocks on a full socket
+    def discard(self, client):
+        with contextlib.suppress(OSError):
+            while client.recv(4096):
+                pass
+
+    # Function to send one EventSub message as an unmasked text frame
+    def send(self, client, message_type, payload):
+        message = json.dumps({'metadata': {'message_id': str(uuid.uuid4()), 'message_type': message_type,
+                                           'message_timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+                              'payload': payload}).encode('utf-8')
+        return self.send_raw(client, message)
+
+    def send_raw(self, client, message):
+        if len(message) < 126:
+            header = bytes([0x81, len(message)])
+        elif len(message) < 65536:
+            header = bytes([0x81, 126]) + len(message).to_bytes(2, 'big')
+        else:
+            header = bytes([0x81, 127]) + len(message).to_bytes(8, 'big')
+        client.sendall(header + message)
+
+    # Function to send a notification on the active connection
+    def notify(self, message_id, subscription_type, event):
+        message = json.dumps({'metadata': {'message_id': message_id, 'message_type': 'notification',
+                                           'message_timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+                              'payload': {'subscription': {'type': subscription_type, 'version': '1'}, 'event': event}})
+        with self.lock:
+            self.send_raw(self.active, message.encode('utf-8'))
+
+    # Function to ask the client to move to a new connection; returns once it has been welcomed there
+    def reconnect(self, timeout=10):
+        with self.lock:
+            connections = self.connections
+            self.send(self.active, 'session_reconnect', {'session': {'id': self.session_id, 'status': 'reconnecting',
+                                                                     'reconnect_url': f"{self.url}?reconnect=1"}})
+            return self.welcomed.wait_for(lambda: self.connections > connections, timeout)
+
+    def close(self):
+        self.listener.close()
+
+
+# Function to compare EventSub delivery over the WebSocket transport with signed webhook POSTs, including a
+# session_reconnect in the middle of the WebSocket run
+def run_websocket_test(count, rate):
+    api = bench.start_http_server(FakeServicesHandler)
+    api_url = f"http://127.0.0.1:{api.server_address[1]}"
+    enhanced.TWITCH_AUTH_URL = f"{api_url}/oauth2/token"
+    enhanced.TWITCH_API_BASE = f"{api_url}/helix"
+    FakeServicesHandler.subscriptions.clear()
+    enhanced.IRC_SOCKET, _ = socket.socketpair()
+    game = enhanced.add_game(LOAD_CHANNEL)
+    handled = {}  # Subscriber name -> time the event first reached handle_event
+    repeats = collections.Counter()  # Transport -> events handled more than once
+    handle_event = enhanced.EVENTS.handler
+
+    def record(event):
+        name = event['event']['user_name']
+        if name in handled:
+            repeats[name.rstrip('0123456789')] += 1
+        handled.setdefault(name, time.time())
+        handle_event(event)
+
+    enhanced.EVENTS.handler = record
+    event = lambda index, transport: {'user_name': f"{transport}{index}", 'broadcaster_user_id': game.broadcaster_id,
+                                      'broadcaster_user_login': LOAD_CHANNEL}
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        # WebSocket: subscribe over the session, then deliver with a reconnect halfway and some repeats
+        server = FakeEventSubServer()
+        threading.Thread(target=enhanced.EventSubWebSocket(server.url).run, daemon=True).start()
+        deadline = time.time() + 10
+        while len(FakeServicesHandler.subscriptions) < len(enhanced.EVENTSUB_EVENTS) and time.time() < deadline:
+            time.sleep(0.05)
+        sent = {}
+        start = time.time()
+        for index in range(count):
+            if index == count // 2:
+                server.reconnect()
+            message_id = str(uuid.uuid4())
+            sent[f"websocket{index}"] = time.time()
+            server.notify(message_id, 'channel.subscribe', event(index, 'websocket'))
+            if index % 20 == 0:
+                server.notify(message_id, 'channel.subscribe', event(index, 'websocket'))
+            delay = start + (index + 1) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        results['websocket'] = sent
+
+        # Webhook: the same events as signed POSTs to the webhook server
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        threading.Thread(target=enhanced.serve_webhooks, args=(enhanced.create_app(), port), daemon=True).start()
+        time.sleep(0.5)
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        sent = {}
+        start = time.time()
+        for index in range(count):
+            body = json.dumps({'subscription': {'type': 'channel.subscribe', 'version': '1'}, 'event': event(index, 'webhook')})
+            sent[f"webhook{index}"] = time.time()
+            connection.request('POST', '/webhook', body=body, headers=bench.eventsub_headers(str(uuid.uuid4()), body))
+            connection.getresponse().read()
+            delay = start + (index + 1) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        results['webhook'] = sent
+        time.sleep(LOAD_DRAIN)
+    server.close()
+    api.shutdown()
+
+    print(f"{count} EventSub notifications per transport at {rate}/s; the WebSocket session reconnects halfway "
+          f"and every 20th notification is sent twice")
+    print(f"{'transport':<12}{'handled':>9}{'missing':>9}{'repeated':>10}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for transport, sent in results.items():
+        latencies = sorted(handled[name] - sent_at for name, sent_at in sent.items() if name in handled)
+        print(f"{transport:<12}{len(latencies):>9}{count - len(latencies):>9}{repeats[transport]:>10}{1000 * percentile(latencies, 0.5):>9.2f}"
+              f"{1000 * percentile(latencies, 0.99):>9.2f}{1000 * (latencies[-1] if latencies else 0):>9.2f}")
+    subscriptions = list(FakeServicesHandler.subscriptions.values())
+    print(f"subscriptions: {', '.join(sorted(sub['type'] + ' via ' + sub['transport']['method'] for sub in subscriptions))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a whole mystery against local stand-ins for Twitch and OpenAI under chat load.")
+    parser.add_argument('--bot', choices=['basic', 'enhanced', 'both'], default='both', help="Bot script to test")
+    parser.add_argument('--rate', type=int, default=LOAD_RATE, help="Chat lines per second (1000 to 50000)")
+    parser.add_argument('--time-scale', type=float, default=LOAD_TIME_SCALE, help="Multiplier for the bots' game timings")
+    parser.add_argument('--api-latency', type=float, default=LOAD_API_LATENCY, help="Seconds added to each fake API response")
+    parser.add_argument('--api-error-rate', type=float, default=LOAD_API_ERROR_RATE, help="Share of fake API calls that fail with 503")
+    parser.add_argument('--tokens-per-sec', type=int, default=LOAD_TOKENS_PER_SEC, help="Generation speed of the fake OpenAI endpoint")
+    parser.add_argument('--replay', help="File of chat messages (plain text or raw IRC lines) to replay instead of synthetic guesses")
+    parser.add_argument('--verbose', action='store_true', help="Show the bots' own log output")
+    parser.add_argument('--eventsub-channels', type=int, help="Time EventSub reconciliation for this many channels instead")
+    parser.add_argument('--eventsub-websocket', type=int, metavar='COUNT',
+                        help="Compare delivery of COUNT notifications over the WebSocket transport and the webhook instead")
+    args = parser.parse_args()
+
+    FakeServicesHandler.latency = args.api_latency
+    FakeServicesHandler.error_rate = args.api_error_rate
+    FakeServicesHandler.tokens_per_sec = args.tokens_per_sec
+    if args.eventsub_websocket:
+        run_websocket_test(args.eventsub_websocket, min(args.rate, 1000))
+        return
+    if args.eventsub_channels:
+        run_reconcile_test(args.eventsub_channels)
+        return
+    if args.replay:
+        texts = load_replay(args.replay)
+    else:
+        # "!mystery" is left out so the bot's replies to it don't crowd out the mystery itself
+        with contextlib.redirect_stdout(io.StringIO()):
+            texts = [message for message, _ in bench.record_guess_chat(5000) if message != '!mystery']
+    bots = {'basic': start_basic, 'enhanced': start_enhanced}
+    names = list(bots) if args.bot == 'both' else [args.bot]
+    servers = []
+    results = [run_load_test(name, bots[name], texts, args.rate, args.time_scale, servers, args.verbose) for name in names]
+    print_report(results, args.rate, args.time_scale)
+    for server, api in servers:
+        api.shutdown()
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+import argparse
+import bisect
+import contextlib
+import hashlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+
+import enhancedMysteryVersionWithEventsub as bot
+
+# Sharding configuration
+SHARD_WORKERS = 4  # Worker processes, each with its own IRC connection
+SHARD_VIRTUAL_NODES = 64  # Points per worker on the hash ring; more points spread channels more evenly
+SHARD_HEARTBEAT_INTERVAL = 1.0  # Seconds between worker status reports
+SHARD_WORKER_TIMEOUT = 5.0  # A worker silent for this long is considered dead and replaced
+SHARD_HOT_CHANNEL_RATE = 50  # Chat lines per second above which a channel may be moved to a quieter worker
+SHARD_IMBALANCE = 1.5  # A worker is overloaded when its chat rate is this many times the average
+SHARD_LEADERBOARD_REFRESH_INTERVAL = 5.0  # Seconds between re-reading the scores every worker saved, for !rank and !top
+
+# Class implementing a consistent hash ring that maps channels to workers
+class HashRing:
+    def __init__(self, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self.points = []  # Sorted hashes
+        self.owners = {}  # Hash -> worker ID
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def add(self, worker_id):
+        for replica in range(self.virtual_nodes):
+            point = self.hash(f"{worker_id}:{replica}")
+            self.owners[point] = worker_id
+            bisect.insort(self.points, point)
+
+    def remove(self, worker_id):
+        self.points = [point for point in self.points if self.owners[point] != worker_id]
+        self.owners = {point: owner for point, owner in self.owners.items() if owner != worker_id}
+
+    # Function to find the worker that owns a channel
+    def owner(self, channel):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, self.hash(channel)) % len(self.points)
+        return self.owners[self.points[index]]
+
+# Function run in each worker process: plays the games for the channels the coordinator assigns. The worker's
+# files are named after its slot, which a replacement worker takes over.
+def run_worker(worker_id, slot, conn, settings):
+    for name, value in settings.items():
+        if name != 'ACCESS_TOKEN':
+            setattr(bot, name, value)
+    bot.TWITCH_CHANNELS = []
+    if settings.get('ACCESS_TOKEN'):
+        bot.APP_TOKEN.set(settings['ACCESS_TOKEN'], 365 * 24 * 3600)
+    bot.MYSTERY_POOL = bot.MysteryPool(f"{bot.MYSTERY_CACHE_FILE}.worker{slot}", bot.MYSTERY_POOL_SIZE,
+                                       bot.MYSTERY_POOL_MAX_AGE, bot.MYSTERY_REPEAT_WINDOW)
+    if bot.MYSTERY_POOL_SIZE:
+        bot.MYSTERY_POOL.start()
+    bot.GAME_JOURNAL = bot.GameJournal(f"{bot.GAME_JOURNAL_FILE}.worker{slot}", bot.GAME_JOURNAL_COMMIT_INTERVAL,
+                                       bot.GAME_JOURNAL_COMPACT_RECORDS)
+    if bot.GAME_JOURNAL_FILE:
+        bot.GAME_JOURNAL.start()
+    bot.TRACER = bot.Tracer(f"{bot.TRACE_FILE}.worker{slot}", bot.TRACE_FLUSH_INTERVAL)
+    if bot.TRACE_FILE:
+        bot.TRACER.start()
+    # Workers share the database; WAL lets their batches interleave, and each re-reads the others' results
+    bot.LEADERBOARD = bot.Leaderboard(bot.LEADERBOARD_DB_FILE, bot.LEADERBOARD_FLUSH_INTERVAL, bot.LEADERBOARD_TOP_K,
+                                      SHARD_LEADERBOARD_REFRESH_INTERVAL)
+    if bot.LEADERBOARD_DB_FILE:
+        bot.LEADERBOARD.start()
+    bot.start_chat(daemon=True)
+
+    counted = {}  # Channel -> chat lines at the last heartbeat
+    last_heartbeat = time.time()
+    while True:
+        try:
+            if conn.poll(SHARD_HEARTBEAT_INTERVAL):
+                command, payload = conn.recv()
+                if command == 'join':
+                    for channel, broadcaster_id, saved in payload:
+                        game = bot.add_game(channel)
+                        if broadcaster_id:
+                            game.broadcaster_id = broadcaster_id
+                            bot.GAMES_BY_BROADCASTER[broadcaster_id] = game
+                        if saved is not None:  # Handed over from a dead worker's journal
+                            bot.GAME_JOURNAL.restorable[channel] = saved
+                            game.journal('restore', game=saved)
+                    bot.resume_games()
+                    threading.Thread(target=bot.join_channels, args=(bot.IRC_SOCKET, [channel for channel, _, _ in payload]), daemon=True).start()
+                elif command == 'part':
+                    for channel in payload:
+                        bot.remove_game(channel)
+                        counted.pop(channel, None)
+                    bot.part_channels(bot.IRC_SOCKET, payload)
+                elif command == 'event':
+                    bot.handle_event(payload)
+            now = time.time()
+            if now - last_heartbeat >= SHARD_HEARTBEAT_INTERVAL:
+                stats = {}
+                for channel, game in list(bot.GAMES.items()):
+                    rate = (game.chat_lines - counted.get(channel, game.chat_lines)) / (now - last_heartbeat)
+                    counted[channel] = game.chat_lines
+                    stats[channel] = {'rate': rate, 'state': game.state}
+                conn.send(('heartbeat', stats))
+                last_heartbeat = now
+        except (EOFError, OSError):
+            print(f"Worker {worker_id} lost its coordinator, exiting.")
+            return
+
+# Class that assigns channels to worker processes and forwards EventSub notifications to them
+class Coordinator:
+    def __init__(self, channels, workers=SHARD_WORKERS, settings=None):
+        self.channels = list(channels)
+        self.worker_count = workers
+        self.settings = settings or {}
+        self.context = multiprocessing.get_context('spawn')  # Never fork a process that runs threads
+        self.ring = HashRing()
+        self.workers = {}  # Worker ID -> {'process', 'conn', 'lock', 'slot', 'last_seen', 'stats'}
+        self.assignments = {}  # Channel -> worker ID
+        self.pinned = {}  # Channel -> worker ID for hot channels moved off their hashed worker
+        self.broadcasters = {}  # Broadcaster ID -> channel
+        self.handoffs = {}  # Channel -> game saved by a dead worker, sent to the channel's next owner
+        self.next_worker_id = 0
+        self.lock = threading.RLock()
+
+    # Function to start the workers and the monitor
+    def start(self):
+        with self.lock:
+            for slot in range(self.worker_count):
+                self.spawn_worker(slot)
+            self.rebalance()
+        threading.Thread(target=self.monitor, daemon=True).start()
+
+    # Function to start one worker process in a slot and add it to the ring. The ring places workers by slot, so a
+    # replacement owns the channels the worker it replaces did, and a restarted coordinator's workers find the
+    # channels in their journals again.
+    def spawn_worker(self, slot):
+        worker_id = self.next_worker_id
+        self.next_worker_id += 1
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=run_worker, args=(worker_id, slot, child_conn, self.settings), daemon=True)
+        process.start()
+        child_conn.close()
+        self.workers[worker_id] = {'process': process, 'conn': parent_conn, 'lock': threading.Lock(), 'slot': slot,
+                                   'last_seen': time.time(), 'stats': {}}
+        self.ring.add(slot)
+        print(f"Started worker {worker_id} (pid {process.pid}).")
+        return worker_id
+
+    # Function to send a command to a worker over its pipe
+    def send(self, worker_id, command, payload):
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            return False
+        try:
+            with worker['lock']:
+                worker['conn'].send((command, payload))
+            return True
+        except (OSError, ValueError) as e:
+            print(f"Could not reach worker {worker_id}: {e}")
+            return False
+
+    # Function to find the worker that should own a channel
+    def owner(self, channel):
+        pinned = self.pinned.get(channel)
+        if pinned in self.workers:
+            return pinned
+        slot = self.ring.owner(channel)
+        return next((worker_id for worker_id, worker in self.workers.items() if worker['slot'] == slot), None)
+
+    # Function to move every channel whose owner changed to its new worker
+    def rebalance(self):
+        with self.lock:
+            joins = {}
+            parts = {}
+            for channel in self.channels:
+                owner = self.owner(channel)
+                current = self.assignments.get(channel)
+                if owner == current:
+                    continue
+                if current in self.workers:
+                    if self.workers[current]['stats'].get(channel, {}).get('state') is not None:
+                        continue  # Let the running game finish; the move is retried on the next pass
+                    parts.setdefault(current, []).append(channel)
+                joins.setdefault(owner, []).append(channel)
+                self.assignments[channel] = owner
+            channel_ids = {channel: broadcaster_id for broadcaster_id, channel in self.broadcasters.items()}
+            for worker_id, channels in parts.items():
+                self.send(worker_id, 'part', channels)
+            for worker_id, channels in joins.items():
+                self.send(worker_id, 'join', [(channel, channel_ids.get(channel), self.handoffs.pop(channel, None))
+                                              for channel in channels])
+                print(f"Assigned {len(channels)} channels to worker {worker_id}.")
+
+    # Function run by the monitor thread: reads heartbeats and replaces dead workers
+    def monitor(self):
+        while True:
+            with self.lock:
+                conns = {worker['conn']: worker_id for worker_id, worker in self.workers.items()}
+            for conn in multiprocessing.connection.wait(list(conns), timeout=SHARD_HEARTBEAT_INTERVAL):
+                worker_id = conns[conn]
+                try:
+                    command, stats = conn.recv()
+                except (EOFError, OSError):
+                    continue
+                if command == 'heartbeat':
+                    with self.lock:
+                        worker = self.workers.get(worker_id)
+                        if worker is not None:
+                            worker['last_seen'] = time.time()
+                            worker['stats'] = stats
+            now = time.time()
+            with self.lock:
+                for worker_id, worker in list(self.workers.items()):
+                    if not worker['process'].is_alive() or now - worker['last_seen'] > SHARD_WORKER_TIMEOUT:
+                        self.replace_worker(worker_id)
+                self.move_hot_channels()
+                self.rebalance()
+
+    # Function to replace a dead or stuck worker and hand its channels to the others
+    def replace_worker(self, worker_id):
+        worker = self.workers.pop(worker_id)
+        print(f"Worker {worker_id} stopped responding, reassigning its channels.")
+        if worker['process'].is_alive():
+            worker['process'].terminate()
+            worker['process'].join(SHARD_WORKER_TIMEOUT)
+        worker['conn'].close()
+        self.ring.remove(worker['slot'])
+        self.pinned = {channel: owner for channel, owner in self.pinned.items() if owner != worker_id}
+        self.take_journal(worker['slot'])
+        # Survivors take the orphaned channels first so chat is served again as soon as possible, resuming the
+        # games the dead worker saved; the replacement then picks up its share of the ring as those channels go idle
+        self.rebalance()
+        self.spawn_worker(worker['slot'])
+
+    # Function to read the games a dead worker's journal saved, to hand them to their channels' new owners, and
+    # remove the journal so the replacement starts an empty one
+    def take_journal(self, slot):
+        journal_file = self.settings.get('GAME_JOURNAL_FILE', bot.GAME_JOURNAL_FILE)
+        if not journal_file:
+            return
+        journal = bot.GameJournal(f"{journal_file}.worker{slot}", 0, 0)
+        journal.load()
+        channels = set(self.channels)
+        self.handoffs.update((channel, saved) for channel, saved in journal.restorable.items() if channel in channels)
+        for path in (journal.journal_file, journal.snapshot_file):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    # Function to move a busy channel off an overloaded worker
+    def move_hot_channels(self):
+        loads = {worker_id: sum(stat['rate'] for stat in worker['stats'].values()) for worker_id, worker in self.workers.items()}
+        if len(loads) < 2:
+            return
+        average = sum(loads.values()) / len(loads)
+        busiest = max(loads, key=loads.get)
+        quietest = min(loads, key=loads.get)
+        if average == 0 or loads[busiest] < average * SHARD_IMBALANCE:
+            return
+        # Only move channels without a game running; their state lives in the worker
+        candidates = [(stat['rate'], channel) for channel, stat in self.workers[busiest]['stats'].items()
+                      if stat['rate'] >= SHARD_HOT_CHANNEL_RATE and stat['state'] is None]
+        if not candidates:
+            return
+        rate, channel = max(candidates)
+        if loads[quietest] + rate >= loads[busiest]:
+            return  # Moving it would just make the other worker the busiest
+        print(f"Moving #{channel} ({rate:.0f} lines/s) from worker {busiest} to worker {quietest}.")
+        self.pinned[channel] = quietest
+        self.workers[busiest]['stats'].pop(channel, None)
+
+    # Function to look up broadcaster IDs so notifications can be routed
+    def resolve_broadcasters(self):
+        for start in range(0, len(self.channels), bot.UserLookupBatcher.MAX_LOGINS_PER_CALL):
+            users = bot.get_users_info(self.channels[start:start + bot.UserLookupBatcher.MAX_LOGINS_PER_CALL])
+            for channel, user_info in users.items():
+                self.broadcasters[user_info['id']] = channel
+
+    # Function to forward an EventSub notification to the worker that owns its channel
+    def route_event(self, event):
+        channel = self.broadcasters.get(event['event'].get('broadcaster_user_id')) or event['event'].get('broadcaster_user_login')
+        with self.lock:
+            worker_id = self.assignments.get(channel)
+        if worker_id is None or not self.send(worker_id, 'event', event):
+            print(f"Dropping an event for #{channel}: no worker owns it.")
+            return False
+        return True
+
+    # Function to create the Flask app that receives EventSub notifications for every worker, along with /metrics
+    def create_app(self):
+        return bot.create_app(bot.EventWorker(self.route_event).submit)
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description="Run the mystery bot for many channels across worker processes.")
+    parser.add_argument('--workers', type=int, default=SHARD_WORKERS)
+    parser.add_argument('--channels', nargs='+', default=bot.TWITCH_CHANNELS)
+    parser.add_argument('--irc-host', default=bot.TWITCH_IRC_SERVER, help="Point at a fake IRC server for local testing")
+    parser.add_argument('--irc-port', type=int, default=bot.TWITCH_IRC_PORT)
+    parser.add_argument('--access-token', help="Use this token instead of fetching one, e.g. for a fake IRC server")
+    parser.add_argument('--no-eventsub', action='store_true', help="Skip EventSub subscriptions and the webhook")
+    args = parser.parse_args()
+
+    settings = {'TWITCH_IRC_SERVER': args.irc_host, 'TWITCH_IRC_PORT': args.irc_port}
+    if args.access_token:
+        settings['ACCESS_TOKEN'] = args.access_token
+    coordinator = Coordinator(args.channels, args.workers, settings)
+    if not args.no_eventsub:
+        coordinator.resolve_broadcasters()
+    coordinator.start()
+    if args.no_eventsub:
+        threading.Event().wait()
+        return
+    for channel in args.channels:
+        bot.add_game(channel)
+    webhook_ready = threading.Event()
+    threading.Thread(target=bot.subscribe_to_eventsub, kwargs={'webhook_ready': webhook_ready}, daemon=True).start()
+    serve = bot.bind_webhook_server(coordinator.create_app(), bot.WEBHOOK_PORT)
+    webhook_ready.set()  # Twitch checks the callback as soon as a subscription is created
+    serve()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+import enhancedMysteryVersionWithEventsub as bot
+
+MAX = bot.MESSAGE_MAX_BYTES
+
+SUSPECTS = """1. Lady Ashford - the widow, who inherits everything
+2. Colonel Mustard (retired), an old friend of the family
+3. Dr. Voss: the family doctor"""
+
+
+# parse_irc_line and parse_irc_tags
+
+def test_parse_privmsg_with_tags():
+    line = "@badge-info=;display-name=Some\\sUser;tmi-sent-ts=1 :some_user!some_user@some_user.tmi.twitch.tv PRIVMSG #chan :it was :voss"
+    message = bot.parse_irc_line(line)
+    assert message.command == 'PRIVMSG'
+    assert message.nick == 'some_user'
+    assert message.channel == 'chan'
+    assert message.text == 'it was :voss'  # Only the first colon starts the trailing parameter
+    assert bot.parse_irc_tags(message.tags) == {'badge-info': '', 'display-name': 'Some User', 'tmi-sent-ts': '1'}
+
+
+def test_parse_line_without_tags_or_prefix():
+    message = bot.parse_irc_line("PING :tmi.twitch.tv")
+    assert (message.tags, message.prefix, message.command, message.channel, message.text) == ('', '', 'PING', '', 'tmi.twitch.tv')
+
+
+def test_parse_tags_unescapes_values():
+    tags = bot.parse_irc_tags("a=semi\\:colon;b=back\\\\slash;c=line\\r\\nbreak;d=unknown\\x;e=trailing\\;f")
+    assert tags == {'a': 'semi;colon', 'b': 'back\\slash', 'c': 'line\r\nbreak', 'd': 'unknownx', 'e': 'trailing', 'f': ''}
+
+
+def test_parse_tags_keeps_escaped_equals_sign_in_value():
+    assert bot.parse_irc_tags("system-msg=a=b\\sc") == {'system-msg': 'a=b c'}
+
+
+# pack_message
+
+def test_pack_sentences_across_line_breaks():
+    packed = bot.pack_message("First line.\nSecond line!\n\n  Third?  ")
+    assert packed.lines == ["First line. Second line! Third?"]
+    assert packed.unpacked == 3
+
+
+def test_pack_breaks_between_sentences_not_inside():
+    first = "a" * 300 + "."
+    second = "b" * 300 + "."
+    assert bot.pack_message(f"{first} {second}").lines == [first, second]
+
+
+def test_pack_breaks_after_closing_quote():
+    first = "He said \"" + "a" * 300 + ".\""
+    second = "b" * 300 + "."
+    assert bot.pack_message(f"{first} {second}").lines == [first, second]
+
+
+def test_pack_fills_message_to_exact_byte_limit():
+    word = "é" * (MAX // 2)  # Two bytes each: exactly MAX bytes
+    packed = bot.pack_message(word)
+    assert packed.encoded == [word.encode('utf-8')]
+
+
+def test_pack_never_cuts_multibyte_character():
+    word = "日" * (MAX // 3 + 5)  # Three bytes each, and MAX is not a multiple of three
+    packed = bot.pack_message(word)
+    assert all(len(line) <= MAX for line in packed.encoded)
+    assert len(packed.encoded[0]) == MAX - MAX % 3
+    assert ''.join(packed.lines) == word
+    assert [line.encode('utf-8') for line in packed.lines] == packed.encoded
+
+
+def test_pack_long_sentence_word_by_word():
+    words = ["word%03d" % index for index in range(120)]
+    packed = bot.pack_message(' '.join(words))
+    assert len(packed.lines) > 1
+    assert all(len(line) <= MAX for line in packed.encoded)
+    assert ' '.join(packed.lines).split() == words
+
+
+def test_pack_empty_message():
+    packed = bot.pack_message(" \n \n")
+    assert (packed.lines, packed.encoded, packed.unpacked) == ([], [], 0)
+
+
+# GuessTally
+
+def test_tally_counts_and_moves_votes():
+    tally = bot.GuessTally(8)
+    tally.vote(None, 'voss')
+    tally.vote(None, 'voss')
+    tally.vote(None, 'ashford')
+    tally.vote('voss', 'ashford')  # A chatter changes their guess
+    assert tally.counts() == {'voss': 1, 'ashford': 2}
+    assert tally.leaders(2) == [('ashford', 2), ('voss', 1)]
+
+
+def test_tally_leaders_in_order_guesses_reached_count():
+    tally = bot.GuessTally(8)
+    for guess in ('a', 'b', 'b', 'a', 'c'):
+        tally.vote(None, guess)
+    assert tally.leaders(3) == [('b', 2), ('a', 2), ('c', 1)]  # b reached 2 votes before a
+
+
+def test_tally_evicts_oldest_guess_with_fewest_votes():
+    tally = bot.GuessTally(2)
+    for guess in ('a', 'b', 'b', 'c'):
+        tally.vote(None, guess)
+    # c takes over a's slot and count, as Space-Saving overestimates rather than drops a popular guess
+    assert tally.counts() == {'b': 2, 'c': 2}
+    tally.vote(None, 'd')  # b and c are tied; b reached 2 votes first, so it is evicted
+    assert tally.counts() == {'c': 2, 'd': 3}
+
+
+def test_tally_ignores_vote_moved_from_evicted_guess():
+    tally = bot.GuessTally(1)
+    tally.vote(None, 'a')
+    tally.vote(None, 'b')  # Evicts a
+    tally.vote('a', 'c')  # a already lost its votes, so b's are not touched; c then evicts b
+    assert tally.counts() == {'c': 3}
+
+
+def test_tally_counts_queued_votes_in_batches():
+    tally = bot.GuessTally(4)
+    for _ in range(bot.GuessTally.BATCH):
+        tally.vote(None, 'voss')
+    assert not tally.pending  # The batch was counted by the voting thread
+    assert tally.counts() == {'voss': bot.GuessTally.BATCH}
+
+
+# SuspectIndex
+
+def test_suspects_parsed_from_list():
+    assert bot.SuspectIndex(SUSPECTS).suspects == ['Lady Ashford', 'Colonel Mustard', 'Dr. Voss']
+
+
+def test_suspects_parsed_from_one_line():
+    assert bot.SuspectIndex("Lady Ashford, Colonel Mustard and Dr. Voss").suspects == ['Lady Ashford', 'Colonel Mustard', 'Dr. Voss']
+
+
+def test_suspect_matches_names_titles_and_prefixes():
+    index = bot.SuspectIndex(SUSPECTS)
+    assert index.match('Ashford') == 'Lady Ashford'
+    assert index.match('lady ashford!') == 'Lady Ashford'
+    assert index.match('colonel mustard') == 'Colonel Mustard'
+    assert index.match('dr voss') == 'Dr. Voss'
+    assert index.match('must') == 'Colonel Mustard'
+
+
+def test_suspect_matches_inside_sentence_and_typos():
+    index = bot.SuspectIndex(SUSPECTS)
+    assert index.match('i think it was voss') == 'Dr. Voss'
+    assert index.match('ashfrod') == 'Lady Ashford'
+    assert index.match('voss or mustard') is None  # Naming two suspects is no guess
+    assert index.match('was it') is None
+    assert index.match('') is None
+
+
+def test_suspect_shared_names_are_ambiguous():
+    index = bot.SuspectIndex("Lady Ashford; Lord Ashford")
+    assert index.match('ashford') is None
+    assert index.match('lord ashford') == 'Lord Ashford'
+
+
+def test_add_suspect_missing_from_list():
+    index = bot.SuspectIndex(SUSPECTS)
+    assert index.add_suspect('Miss Scarlet') == 'Miss Scarlet'
+    assert index.match('scarlet') == 'Miss Scarlet'
+
+
+# MysterySectionParser
+
+SAMPLE_SECTIONS = [
+    ('Backstory', "A storm traps the guests at Ashford Manor."),
+    ('The Murder', "The host is found dead in the library."),
+    ('Suspects', SUSPECTS),
+    ('Clue Phase', "A torn glove lies by the fireplace."),
+    ('Murderer', "Dr. Voss"),
+    ('The Reveal', "The glove was the doctor's."),
+]
+SAMPLE_TEXT = '\n\n'.join(f"{label}: {text}" for label, text in SAMPLE_SECTIONS)
+
+
+def parse_in_chunks(text, size):
+    sections = []
+    parser = bot.MysterySectionParser(lambda label, section: sections.append((label, section)))
+    for start in range(0, len(text), size):
+        parser.feed(text[start:start + size])
+    parser.close()
+    return sections
+
+
+def test_section_parser_emits_every_section_in_order():
+    assert parse_in_chunks(SAMPLE_TEXT, len(SAMPLE_TEXT)) == SAMPLE_SECTIONS
+
+
+def test_section_parser_handles_labels_split_across_chunks():
+    for size in (1, 2, 3, 7):
+        assert parse_in_chunks(SAMPLE_TEXT, size) == SAMPLE_SECTIONS
+
+
+def test_section_parser_emits_section_once_next_label_arrives():
+    sections = []
+    parser = bot.MysterySectionParser(lambda label, section: sections.append(label))
+    parser.feed("Backstory: A storm.\nThe Murder:")
+    assert sections == []  # The text after the label may still be coming
+    parser.feed(" The host")
+    assert sections == ['Backstory']
+
+
+def test_section_parser_stream_ending_after_label():
+    assert parse_in_chunks("Backstory: A storm.\nThe Murder:", 4) == [('Backstory', 'A storm.'), ('The Murder', '')]
+
+
+def test_section_parser_agrees_with_whole_response_parser():
+    parsed = bot.parse_mystery_sections(SAMPLE_TEXT)
+    assert tuple(section for _, section in parse_in_chunks(SAMPLE_TEXT, 5)) == parsed
+
+
+# MessageDeduplicator
+
+def test_deduplicator_reports_repeated_ids():
+    dedup = bot.MessageDeduplicator(60, 10)
+    assert dedup.seen('a') is False
+    assert dedup.seen('b') is False
+    assert dedup.seen('a') is True
+
+
+def test_deduplicator_evicts_oldest_when_full():
+    dedup = bot.MessageDeduplicator(60, 2)
+    dedup.seen('a')
+    dedup.seen('b')
+    dedup.seen('c')  # Evicts a
+    assert dedup.seen('b') is True
+    assert dedup.seen('a') is False
+
+
+def test_deduplicator_forgets_ids_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: now[0])
+    dedup = bot.MessageDeduplicator(10, 100)
+    dedup.seen('a')
+    now[0] += 5
+    dedup.seen('b')
+    now[0] += 6  # a is 11 seconds old, b 6
+    assert dedup.seen('a') is False
+    assert dedup.seen('b') is True
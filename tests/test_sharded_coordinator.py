@@ -0,0 +1,51 @@
+import shardedMysteryCoordinator as sharding
+
+CHANNELS = [f"channel{index}" for index in range(500)]
+
+
+def ring_with(workers, virtual_nodes=sharding.SHARD_VIRTUAL_NODES):
+    ring = sharding.HashRing(virtual_nodes)
+    for worker in workers:
+        ring.add(worker)
+    return ring
+
+
+def test_empty_ring_has_no_owner():
+    assert sharding.HashRing().owner('channel') is None
+
+
+def test_owner_is_stable_and_independent_of_insertion_order():
+    first = ring_with([0, 1, 2, 3])
+    second = ring_with([3, 1, 0, 2])
+    assert [first.owner(channel) for channel in CHANNELS] == [second.owner(channel) for channel in CHANNELS]
+
+
+def test_channels_spread_over_every_worker():
+    ring = ring_with([0, 1, 2, 3])
+    counts = {}
+    for channel in CHANNELS:
+        owner = ring.owner(channel)
+        counts[owner] = counts.get(owner, 0) + 1
+    assert sorted(counts) == [0, 1, 2, 3]
+    assert min(counts.values()) > len(CHANNELS) / 4 / 2
+
+
+def test_removing_worker_moves_only_its_channels():
+    ring = ring_with([0, 1, 2, 3])
+    before = {channel: ring.owner(channel) for channel in CHANNELS}
+    ring.remove(2)
+    assert len(ring.points) == 3 * ring.virtual_nodes
+    for channel, owner in before.items():
+        if owner == 2:
+            assert ring.owner(channel) != 2
+        else:
+            assert ring.owner(channel) == owner
+
+
+def test_adding_worker_takes_channels_only_for_itself():
+    ring = ring_with([0, 1, 2])
+    before = {channel: ring.owner(channel) for channel in CHANNELS}
+    ring.add(3)
+    moved = [channel for channel in CHANNELS if ring.owner(channel) != before[channel]]
+    assert moved
+    assert all(ring.owner(channel) == 3 for channel in moved)